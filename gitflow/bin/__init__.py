@@ -25,19 +25,14 @@ import sys
 import argparse
 import subprocess as sub
 
-from gitflow.core import GitFlow, info, GitCommandError
+from gitflow.core import info, GitCommandError, shared_gitflow
 from gitflow.util import itersubclasses
-from gitflow.jenkins import Jenkins, DeploymentRequestError
 from gitflow.exceptions import (GitflowError, AlreadyInitialized,
                                 NotInitialized, BranchTypeExistsError,
                                 BaseNotOnBranch, NoSuchBranchError,
                                 BaseNotAllowed, BranchExistsError,
                                 IllegalVersionFormat, InconsistencyDetected,
                                 OperationsError)
-import gitflow.pivotal as pivotal
-import gitflow.review as review
-from gitflow.review import (BranchReview, ReviewNotAcceptedYet,
-                            get_feature_ancestor)
 
 __copyright__ = "2010-2011 Vincent Driessen; 2012 Hartmut Goebel"
 __license__ = "BSD"
@@ -88,7 +83,7 @@ class StatusCommand(GitFlowCommand):
 
     @staticmethod
     def run(args):
-        gitflow = GitFlow()
+        gitflow = shared_gitflow()
         for name, hexsha, is_active_branch in gitflow.status():
             if is_active_branch:
                 prefix = '*'
@@ -147,7 +142,7 @@ class FeatureCommand(GitFlowCommand):
 
     @staticmethod
     def run_list(args):
-        gitflow = GitFlow()
+        gitflow = shared_gitflow()
         gitflow.start_transaction()
         gitflow.list('feature', 'name', use_tagname=False,
                      verbose=args.verbose, include_remote=args.all)
@@ -167,9 +162,10 @@ class FeatureCommand(GitFlowCommand):
 
     @staticmethod
     def run_start(args):
+        import gitflow.pivotal as pivotal
         if args.for_release:
             pivotal.check_version_format(args.for_release)
-        gitflow = GitFlow()
+        gitflow = shared_gitflow()
         git     = gitflow.git
 
         base = None
@@ -285,7 +281,9 @@ class FeatureCommand(GitFlowCommand):
 
     @staticmethod
     def run_finish(args):
-        gitflow = GitFlow()
+        import gitflow.pivotal as pivotal
+        from gitflow.review import BranchReview, get_feature_ancestor
+        gitflow = shared_gitflow()
         repo = gitflow.repo
         git = repo.git
 
@@ -364,7 +362,8 @@ class FeatureCommand(GitFlowCommand):
 
     @staticmethod
     def run_purge(args):
-        gitflow = GitFlow()
+        import gitflow.pivotal as pivotal
+        gitflow = shared_gitflow()
         git = gitflow.git
         mgr = gitflow.managers['feature']
         origin_name = gitflow.origin_name()
@@ -454,7 +453,7 @@ class FeatureCommand(GitFlowCommand):
 
     @staticmethod
     def run_checkout(args):
-        gitflow = GitFlow()
+        gitflow = shared_gitflow()
         # NB: Does not default to the current branch as `nameprefix` is required
         branch = gitflow.checkout('feature', args.nameprefix)
         print 'Checking out feature {0}.'.format(branch.name)
@@ -469,7 +468,7 @@ class FeatureCommand(GitFlowCommand):
 
     @staticmethod
     def run_diff(args):
-        gitflow = GitFlow()
+        gitflow = shared_gitflow()
         name = gitflow.nameprefix_or_current('feature', args.nameprefix)
         gitflow.start_transaction('diff for feature branch %s' % name)
         gitflow.diff('feature', name)
@@ -486,7 +485,7 @@ class FeatureCommand(GitFlowCommand):
 
     @staticmethod
     def run_rebase(args):
-        gitflow = GitFlow()
+        gitflow = shared_gitflow()
         name = gitflow.nameprefix_or_current('feature', args.nameprefix)
         gitflow.start_transaction('rebasing feature branch %s' % name)
         gitflow.rebase('feature', name, args.interactive)
@@ -501,7 +500,7 @@ class FeatureCommand(GitFlowCommand):
 
     @staticmethod
     def run_publish(args):
-        gitflow = GitFlow()
+        gitflow = shared_gitflow()
         git     = gitflow.git
         name = gitflow.nameprefix_or_current('feature', args.nameprefix)
         gitflow.start_transaction('publishing feature branch %s' % name)
@@ -533,7 +532,7 @@ class FeatureCommand(GitFlowCommand):
 
     @staticmethod
     def run_pull(args):
-        gitflow = GitFlow()
+        gitflow = shared_gitflow()
         name = gitflow.name_or_current('feature', args.name, must_exist=False)
         gitflow.start_transaction('pulling remote feature branch %s '
                                   'into local banch %s' % (args.remote, name))
@@ -549,7 +548,7 @@ class FeatureCommand(GitFlowCommand):
 
     @staticmethod
     def run_track(args):
-        gitflow = GitFlow()
+        gitflow = shared_gitflow()
         # NB: `args.name` is required since the branch must not yet exist
         gitflow.start_transaction('tracking remote feature branch %s'
                                   % args.name)
@@ -588,7 +587,7 @@ class ReleaseCommand(GitFlowCommand):
 
     @staticmethod
     def run_list(args):
-        gitflow = GitFlow()
+        gitflow = shared_gitflow()
         gitflow.start_transaction()
         gitflow.list('release', 'version', use_tagname=True,
                      verbose=args.verbose)
@@ -603,6 +602,7 @@ class ReleaseCommand(GitFlowCommand):
 
     @staticmethod
     def run_list_stories(args):
+        import gitflow.pivotal as pivotal
         print
         if args.version is None:
             pivotal.Release.dump_all_releases()
@@ -621,7 +621,8 @@ class ReleaseCommand(GitFlowCommand):
 
     @staticmethod
     def run_start(args):
-        gitflow = GitFlow()
+        import gitflow.pivotal as pivotal
+        gitflow = shared_gitflow()
         base = gitflow.develop_name()
 
         #+ Pivotal Tracker modifications.
@@ -667,11 +668,12 @@ class ReleaseCommand(GitFlowCommand):
 
     @staticmethod
     def run_append(args):
+        import gitflow.pivotal as pivotal
         # Print info and ask for confirmation.
         pivotal.prompt_user_to_confirm_release(args.version)
 
         # Merge, push and insert PT labels.
-        gitflow = GitFlow()
+        gitflow = shared_gitflow()
         git = gitflow.git
         current_branch = gitflow.repo.active_branch
 
@@ -714,10 +716,12 @@ class ReleaseCommand(GitFlowCommand):
 
     @staticmethod
     def run_stage(args):
+        import gitflow.pivotal as pivotal
+        import gitflow.review as review
         assert args.version
         pivotal.check_version_format(args.version)
 
-        gitflow = GitFlow()
+        gitflow = shared_gitflow()
 
         # Check the repository if CircleCI is enabled.
         if gitflow.is_circleci_enabled():
@@ -788,7 +792,9 @@ class ReleaseCommand(GitFlowCommand):
 
     @staticmethod
     def run_finish(args):
-        gitflow = GitFlow()
+        import gitflow.pivotal as pivotal
+        import gitflow.review as review
+        gitflow = shared_gitflow()
         git     = gitflow.git
         origin  = gitflow.origin()
         version = gitflow.name_or_current('release', args.version)
@@ -845,6 +851,7 @@ class ReleaseCommand(GitFlowCommand):
         feature_prefix = gitflow.get_prefix('feature')
         # refs = [<type>/<id>/...]
         refs = [str(ref)[len(origin_prefix):] for ref in origin.refs]
+        branch_index = pivotal.get_story_branch_index()
         for story in pt_release:
             if story.is_rejected():
                 continue
@@ -854,7 +861,7 @@ class ReleaseCommand(GitFlowCommand):
             try:
                 name = gitflow.nameprefix_or_current('feature', prefix)
                 local_branches.append(feature_prefix + name)
-                if base_marker in gitflow.repo.refs:
+                if branch_index.base_marker(story.get_id()) is not None:
                     local_branches.append(base_marker)
             except NoSuchBranchError:
                 pass
@@ -922,7 +929,7 @@ class ReleaseCommand(GitFlowCommand):
 
     @staticmethod
     def run_track(args):
-        gitflow = GitFlow()
+        gitflow = shared_gitflow()
         # NB: `args.version` is required since the branch must not yet exist
         gitflow.start_transaction('tracking remote release branch %s'
                                   % args.version)
@@ -935,7 +942,7 @@ class ReleaseCommand(GitFlowCommand):
 
     @staticmethod
     def rollback(tag=None, master_hexsha=None, develop_hexsha=None):
-        gitflow = GitFlow()
+        gitflow = shared_gitflow()
 
         try:
             if not tag is None:
@@ -996,7 +1003,7 @@ class HotfixCommand(GitFlowCommand):
 
     @staticmethod
     def run_list(args):
-        gitflow = GitFlow()
+        gitflow = shared_gitflow()
         gitflow.start_transaction()
         gitflow.list('hotfix', 'version', use_tagname=True,
                      verbose=args.verbose)
@@ -1014,7 +1021,7 @@ class HotfixCommand(GitFlowCommand):
 
     @staticmethod
     def run_start(args):
-        gitflow = GitFlow()
+        gitflow = shared_gitflow()
         # NB: `args.version` is required since the branch must not yet exist
         # :fixme: get default value for `base`
         gitflow.start_transaction('create hotfix branch %s (from %s)' % \
@@ -1066,7 +1073,7 @@ class HotfixCommand(GitFlowCommand):
 
     @staticmethod
     def run_finish(args):
-        gitflow = GitFlow()
+        gitflow = shared_gitflow()
         version = gitflow.name_or_current('hotfix', args.version)
         gitflow.start_transaction('finishing hotfix branch %s' % version)
         tagging_info = None
@@ -1090,7 +1097,7 @@ class HotfixCommand(GitFlowCommand):
 
     @staticmethod
     def run_publish(args):
-        gitflow = GitFlow()
+        gitflow = shared_gitflow()
         version = gitflow.name_or_current('hotfix', args.version)
         gitflow.start_transaction('publishing hotfix branch %s' % version)
         branch = gitflow.publish('hotfix', version)
@@ -1124,7 +1131,7 @@ class SupportCommand(GitFlowCommand):
 
     @staticmethod
     def run_list(args):
-        gitflow = GitFlow()
+        gitflow = shared_gitflow()
         gitflow.start_transaction()
         gitflow.list('support', 'version', use_tagname=True,
                      verbose=args.verbose)
@@ -1141,7 +1148,7 @@ class SupportCommand(GitFlowCommand):
 
     @staticmethod
     def run_start(args):
-        gitflow = GitFlow()
+        gitflow = shared_gitflow()
         # NB: `args.name` is required since the branch must not yet exist
         # :fixme: get default value for `base`
         gitflow.start_transaction('create support branch %s (from %s)' %
@@ -1204,11 +1211,14 @@ class DeployCommand(GitFlowCommand):
 
     @staticmethod
     def run_release(args):
+        import gitflow.pivotal as pivotal
+        import gitflow.review as review
+        from gitflow.jenkins import DeploymentRequestError
         assert args.version
         assert args.environ
         pivotal.check_version_format(args.version)
 
-        gitflow = GitFlow()
+        gitflow = shared_gitflow()
 
         # Fetch remote refs.
         if not args.no_fetch:
@@ -1217,7 +1227,7 @@ class DeployCommand(GitFlowCommand):
             print('OK')
 
         # Check the environ argument.
-        branch = GitFlow().managers['release'].full_name(args.version)
+        branch = shared_gitflow().managers['release'].full_name(args.version)
         if args.environ not in ('qa', 'stage'):
             raise DeploymentRequestError(branch, args.environ)
 
@@ -1254,7 +1264,7 @@ class DeployCommand(GitFlowCommand):
         if args.environ in ('qa', 'stage'):
             assert args.version
 
-        gitflow = GitFlow()
+        gitflow = shared_gitflow()
 
         branches = {
                 'develop':    gitflow.develop_name(),
@@ -1321,6 +1331,7 @@ def _deploy_circleci(gitflow, branches, environ):
     print('OK')
 
 def _deploy_jenkins(gitflow, branches, environ):
+    from gitflow.jenkins import Jenkins
     # Make sure that the branch being deployed exists in origin.
     branch = branches[environ]
     sys.stderr.write("Checking whether branch '{0}' exists in origin ... " \
@@ -1329,7 +1340,7 @@ def _deploy_jenkins(gitflow, branches, environ):
     print('OK')
 
     # Trigger the job.
-    jenkins = Jenkins.from_prompt()
+    jenkins = Jenkins.from_prompt(gitflow)
 
     print('Triggering the deployment job (env being {0}) ... job {1} ... ' \
             .format(environ, jenkins.get_deploy_job_name(environ)))
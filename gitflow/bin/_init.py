@@ -19,7 +19,7 @@ except:
     # readline is optional and may not be available on all installations
     pass
 
-from gitflow.core import GitFlow as CoreGitFlow, warn, info
+from gitflow.core import GitFlow as CoreGitFlow, warn, info, shared_gitflow
 from gitflow.prompt import pick, ask
 
 from gitflow.exceptions import (AlreadyInitialized, NotInitialized,
@@ -47,7 +47,7 @@ def _ensure_SSH():
         origin_url = origin_url[6:].replace('/', ':', 1)
     if not origin_url.endswith('.git'):
         origin_url += '.git'
-    CoreGitFlow().git.remote('set-url', gitflow_origin, origin_url)
+    gitflow.git.remote('set-url', gitflow_origin, origin_url)
 
 class GitFlow(CoreGitFlow):
 
@@ -162,26 +162,26 @@ def _ask_name(args, name, question):
 
 def _ask_pt_projid(reuse_existing):
     pick('gitflow.pt.projectid', 'Pivotal Tracker projects', pt.list_projects,
-         reuse_existing=reuse_existing)
+         reuse_existing=reuse_existing, gitflow=gitflow)
 
 def _ask_pt_labels(reuse_existing):
     include = ask('gitflow.pt.includelabel',
                   'Pivotal Tracker label to associate this repository with: ',
-                  reuse_existing=reuse_existing)
+                  reuse_existing=reuse_existing, gitflow=gitflow)
     if include:
         gitflow.set('gitflow.pt.excludelabels', '')
         return
     ask('gitflow.pt.excludelabels',
         'Pivotal Tracker lables to exclude from this repository: ',
-        reuse_existing=reuse_existing)
+        reuse_existing=reuse_existing, gitflow=gitflow)
 
 def _ask_rb_repoid(reuse_existing):
     pick('gitflow.rb.repoid', 'Review Board repositories', rb.list_repos,
-         reuse_existing=reuse_existing)
+         reuse_existing=reuse_existing, gitflow=gitflow)
 
 def run_default(args):
     global gitflow
-    gitflow = GitFlow()
+    gitflow = shared_gitflow(GitFlow)
     gitflow._enforce_git_repo()
     gitflow._enforce_services()
 
@@ -192,69 +192,72 @@ def run_default(args):
     if args.use_defaults:
         warn("Using default branch names.")
 
-    #-- ask about Circle CI
-    _ask_name(args, 'circleci.enabled',
-            'Enable Circle CI integration [Y/n]')
+    # Collect all the answers first and write them into the repository
+    # config at once, the prompt helpers join this batch as well.
+    with gitflow.config_batch():
+        #-- ask about Circle CI
+        _ask_name(args, 'circleci.enabled',
+                'Enable Circle CI integration [Y/n]')
 
-    _ask_name(args, "origin", "Remote name to use as origin in git flow")
- 
-    # Make sure that origin uses SSH protocol for communication,
-    # otherwise Review Board is going to fail.
-    _ensure_SSH()
+        _ask_name(args, "origin", "Remote name to use as origin in git flow")
 
-    #-- add a master branch if no such branch exists yet
-    if gitflow.has_master_configured() and not args.force:
-        master_branch = gitflow.master_name()
-    else:
-        master_branch = _ask_branch(args,
-            'master',
-            'bringing forth production releases',
-            'production releases',
-            ['production', 'main', 'master'])
-
-    #-- add a develop branch if no such branch exists yet
-    if gitflow.has_develop_configured() and not args.force:
-        develop_branch = gitflow.develop_name()
-    else:
-        develop_branch = _ask_branch(args,
-            'develop',
-            'integration of the "next release"',
-            '"next release" development',
-            ['develop', 'int', 'integration', 'master'],
-            filter=[master_branch])
-
-    #-- ask for the staging branch in case CircleCI is enabled.
-    if gitflow.is_circleci_enabled():
-        if gitflow.has_stage_configured() and not args.force:
-            stage_branch = gitflow.stage_branch()
-        else:
-            stage_branch = _ask_branch(args,
-                'stage',
-                'release client acceptance',
-                'release client acceptance',
-                ['stage'])
-
-    if not gitflow.is_initialized() or args.force:
-        print
-        print "How to name your supporting branch prefixes?"
-
-    _ask_prefix(args, "feature", "Feature branches")
-    _ask_prefix(args, "release", "Release branches")
-    _ask_prefix(args, "hotfix", "Hotfix branches")
-    _ask_prefix(args, "support", "Support branches")
-    _ask_prefix(args, "versiontag", "Version tag prefix")
+        # Make sure that origin uses SSH protocol for communication,
+        # otherwise Review Board is going to fail.
+        _ensure_SSH()
 
-    _ask_name(args, 'release.versionmatcher',
-            'Regular expression for matching release numbers')
-
-    _ask_name(args, 'pagination',
-            'Number of stories to list on one page')
-
-    _ask_pt_projid(args.use_defaults)
-    _ask_pt_labels(args.use_defaults)
-    _ask_rb_repoid(args.use_defaults)
-
-    # assert the gitflow repo has been correctly initialized
-    assert gitflow.is_initialized()
+        #-- add a master branch if no such branch exists yet
+        if gitflow.has_master_configured() and not args.force:
+            master_branch = gitflow.master_name()
+        else:
+            master_branch = _ask_branch(args,
+                'master',
+                'bringing forth production releases',
+                'production releases',
+                ['production', 'main', 'master'])
+
+        #-- add a develop branch if no such branch exists yet
+        if gitflow.has_develop_configured() and not args.force:
+            develop_branch = gitflow.develop_name()
+        else:
+            develop_branch = _ask_branch(args,
+                'develop',
+                'integration of the "next release"',
+                '"next release" development',
+                ['develop', 'int', 'integration', 'master'],
+                filter=[master_branch])
+
+        #-- ask for the staging branch in case CircleCI is enabled.
+        if gitflow.is_circleci_enabled():
+            if gitflow.has_stage_configured() and not args.force:
+                stage_branch = gitflow.stage_branch()
+            else:
+                stage_branch = _ask_branch(args,
+                    'stage',
+                    'release client acceptance',
+                    'release client acceptance',
+                    ['stage'])
+
+        if not gitflow.is_initialized() or args.force:
+            print
+            print "How to name your supporting branch prefixes?"
+
+        _ask_prefix(args, "feature", "Feature branches")
+        _ask_prefix(args, "release", "Release branches")
+        _ask_prefix(args, "hotfix", "Hotfix branches")
+        _ask_prefix(args, "support", "Support branches")
+        _ask_prefix(args, "versiontag", "Version tag prefix")
+
+        _ask_name(args, 'release.versionmatcher',
+                'Regular expression for matching release numbers')
+
+        _ask_name(args, 'pagination',
+                'Number of stories to list on one page')
+
+        _ask_pt_projid(args.use_defaults)
+        _ask_pt_labels(args.use_defaults)
+        _ask_rb_repoid(args.use_defaults)
+
+        # assert the gitflow repo has been correctly initialized
+        assert gitflow.is_initialized()
 
     gitflow.init(master_branch, develop_branch)
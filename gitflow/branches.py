@@ -5,6 +5,8 @@
 # Distributed under a BSD-like license. For full terms see the file LICENSE.txt
 #
 
+import bisect
+import os
 try:
     from cStringIO import StringIO
 except ImportError:
@@ -26,6 +28,112 @@ def ensure_trailing_slash(s):
     return s + "/"
 
 
+class RefIndex(object):
+    """
+    Initializes an instance of :class:`RefIndex`.  A ref index keeps the
+    sorted names of all refs in the repository, as read by a single
+    `git for-each-ref` call, and answers prefix lookups by bisection.
+
+    The index is rebuilt once refs are added or removed, which is detected
+    by the modification times of `packed-refs` and of the directories the
+    looked up refs live in.  Only the directories below the prefix of a
+    lookup are checked, so a lookup costs a few `stat` calls, not one per
+    ref.
+
+    :param gitflow:
+        The :class:`gitflow.core.GitFlow` instance whose repository is
+        indexed.
+    """
+
+    def __init__(self, gitflow):
+        self.gitflow = gitflow
+        self._names = None
+        # The stamp of packed-refs and the modification times of the
+        # directories below refs/, as of the time the index was built.
+        self._packed_stamp = None
+        self._dir_stamps = {}
+
+    def _stat(self, path):
+        try:
+            st = os.stat(os.path.join(self.gitflow.repo.git_dir, path))
+        except OSError:
+            return None
+        return (st.st_mtime, st.st_size)
+
+    def _dirs(self, names, prefix=''):
+        """
+        Returns the directories whose entries decide which of `names`
+        exist and which refs starting with `prefix` may have been added:
+        the directory of the prefix, its parents and all directories
+        between it and the refs.
+        """
+        dirs = set()
+        if '/' not in prefix:
+            # New refs of any kind match, they go into these.
+            dirs.update(['refs', 'refs/heads', 'refs/remotes', 'refs/tags'])
+        for path in [prefix] + names:
+            parts = path.split('/')[:-1]
+            for k in range(1, len(parts) + 1):
+                dirs.add('/'.join(parts[:k]))
+        return dirs
+
+    def _is_fresh(self, prefix):
+        if self._names is None:
+            return False
+        if self._stat('packed-refs') != self._packed_stamp:
+            return False
+        names = self._slice(prefix)
+        for path in self._dirs(names, prefix):
+            if self._stat(path) != self._dir_stamps.get(path):
+                return False
+        return True
+
+    def _build(self, prefix=''):
+        # Stat packed-refs first, so that packing the refs while git reads
+        # them makes the index stale rather than getting lost.
+        self._packed_stamp = self._stat('packed-refs')
+        output = self.gitflow.repo.git.for_each_ref('--format=%(refname)')
+        names = sorted(output.splitlines())
+        self._dir_stamps = dict((path, self._stat(path))
+                                for path in self._dirs(names, prefix))
+        self._names = names
+
+    def _slice(self, prefix):
+        names = self._names
+        i = j = bisect.bisect_left(names, prefix)
+        while j < len(names) and names[j].startswith(prefix):
+            j += 1
+        return names[i:j]
+
+    def names(self, prefix=''):
+        """
+        :returns:
+            The sorted list of full names (e.g. `refs/heads/develop`) of
+            all refs in the repository starting with `prefix`.
+        """
+        if not self._is_fresh(prefix):
+            self._build(prefix)
+        return self._slice(prefix)
+
+    def iter_names(self, prefix):
+        """
+        :returns:
+            An iterator over the full names of all refs starting with
+            `prefix`, in sorted order.
+        """
+        for name in self.names(prefix):
+            yield name
+
+    def iter_refs(self, prefix):
+        """
+        :returns:
+            An iterator over the :class:`git.refs.Reference` instances of
+            all refs whose full name starts with `prefix`.
+        """
+        for name in self.iter_names(prefix):
+            yield Reference.from_path(self.gitflow.repo, name)
+
+
 class BranchManager(object):
     """
     Initializes an instance of :class:`BranchManager`.  A branch
@@ -111,11 +219,11 @@ class BranchManager(object):
         """
         if remote:
             nameprefix = self.gitflow.origin_name(self.full_name(nameprefix))
+            matches = self.gitflow.ref_index.iter_refs('refs/remotes/' + nameprefix)
         else:
             nameprefix = self.full_name(nameprefix)
-        matches = [b
-                   for b in self.iter(remote)
-                   if b.name.startswith(nameprefix)]
+            matches = self.gitflow.ref_index.iter_refs('refs/heads/' + nameprefix)
+        matches = list(matches)
         num_matches = len(matches)
         if num_matches == 1:
             return matches[0]
@@ -127,22 +235,23 @@ class BranchManager(object):
                     'matching the prefix "%s": %s' % (self.identifier,
                         nameprefix, matches))
 
+    def ref_prefix(self, remote=False):
+        """
+        :returns:
+            The prefix of the full names of the local or remote branches
+            of the type that this manager manages.
+        """
+        if remote:
+            return 'refs/remotes/' + self.gitflow.origin_name(self.prefix)
+        return 'refs/heads/' + self.prefix
+
     def iter(self, remote=False):
         """
         :returns:
             An iterator, iterating over all branches of the type that this
             manager manages.
         """
-        if remote:
-            refs = self.gitflow.repo.refs
-            prefix = self.gitflow.origin_name(self.prefix)
-        else:
-            refs = self.gitflow.repo.branches
-            prefix = self.prefix
-
-        for r in refs:
-            if r.name.startswith(prefix):
-                yield r
+        return self.gitflow.ref_index.iter_refs(self.ref_prefix(remote))
 
     def list(self, remote=False):
         """
@@ -218,9 +327,20 @@ class BranchManager(object):
         return branch
 
     def _is_single_commit_branch(self, from_, to):
-        git = self.gitflow.repo.git
-        commits = git.rev_list('%s...%s' % (from_, to), n=2).split()
-        return len(commits) == 1
+        repo = self.gitflow.repo
+        from_ = repo.rev_parse(str(from_)).hexsha
+        to = repo.rev_parse(str(to)).hexsha
+        if from_ == to:
+            return False
+        graph = self.gitflow._commit_graph()
+        # `from_...to` holds a single commit, iff one side is the
+        # other one's only commit on top of it.
+        for ancestor, descendant in ((from_, to), (to, from_)):
+            if (graph.is_ancestor(ancestor, descendant) and
+                all(graph.is_ancestor(parent, ancestor)
+                    for parent in graph.parents(descendant))):
+                return True
+        return False
 
     def merge(self, name, into, message=None):
         """
@@ -379,15 +499,10 @@ class FeatureBranchManager(BranchManager):
 
     def iter_markers(self, remote=False):
         if remote:
-            refs = self.gitflow.repo.refs
-            prefix = self.gitflow.origin_name() + '/base_feature/'
+            prefix = 'refs/remotes/' + self.gitflow.origin_name() + '/base_feature/'
         else:
-            refs = self.gitflow.repo.branches
-            prefix = 'base_feature/'
-
-        for r in refs:
-            if r.name.startswith(prefix):
-                yield r
+            prefix = 'refs/heads/base_feature/'
+        return self.gitflow.ref_index.iter_refs(prefix)
 
 
 class ReleaseBranchManager(BranchManager):
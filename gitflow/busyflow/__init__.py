@@ -1,6 +1,5 @@
-# See http://peak.telecommunity.com/DevCenter/setuptools#namespace-packages
-try:
-    __import__('pkg_resources').declare_namespace(__name__)
-except ImportError:
-    from pkgutil import extend_path
-    __path__ = extend_path(__path__, __name__)
+# See http://docs.python.org/2/library/pkgutil.html#pkgutil.extend_path
+# Declaring the namespace through pkg_resources would import it, which is
+# slow, on every use of the Pivotal Tracker client.
+from pkgutil import extend_path
+__path__ = extend_path(__path__, __name__)
@@ -1,16 +1,24 @@
+import os
+import re
 import time
-import pkg_resources
 import datetime
+import collections
+import functools
+import threading
 from poster.encode import multipart_encode
 from poster.encode import MultipartParam
-from dateutil import parser
 import httplib2
 import urllib
 import logging
 
 from xmlbuilder import XMLBuilder
 from xml.dom import minidom
+from xml.etree import cElementTree
 from xml.parsers.expat import ExpatError
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from StringIO import StringIO
 
 log = logging.getLogger(__name__)
 
@@ -66,19 +74,118 @@ def parse_csv(node):
     return value.split(",")
 
 
-_tzmap = None
-def get_tzmap():
-    global _tzmap
-    if _tzmap is None:
-        _tzmap = {}
-        tzmap_file = pkg_resources.resource_string('gitflow.busyflow.pivotal', 'tzmap.txt')
-        for line in tzmap_file.splitlines():
+def _load_tzmap():
+    # Read the file next to this module; importing pkg_resources to find
+    # it costs more than parsing all the timestamps of a payload.
+    tzmap = {}
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tzmap.txt')
+    with open(path) as fh:
+        for line in fh.read().splitlines():
             [short_name, long_name, offset] = line.split('\t')
-            _tzmap[short_name] = offset
+            tzmap[short_name] = offset
+    return tzmap
+
+
+class _FrozenMapping(collections.Mapping):
+    """
+    A read-only mapping, for module level lookup tables which the cached
+    parsers rely on.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self._data = dict(*args, **kwargs)
+
+    def __getitem__(self, key):
+        return self._data[key]
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+
+# Timezone abbreviations and their offsets, e.g. 'UTC+0100'.  Loaded once,
+# the results of `_parse_pivotal_dt` depend on it.
+_tzmap = _FrozenMapping(_load_tzmap())
+
+def get_tzmap():
+    """
+    Returns the read-only mapping of timezone abbreviations to offsets.
+    """
     return _tzmap
 
 
-def parse_string_to_dt(value):
+def _offset_delta(offset):
+    sign, hours, minutes = re.match(r'UTC([+-])(\d\d)(\d\d)$', offset).groups()
+    delta = datetime.timedelta(hours=int(hours), minutes=int(minutes))
+    if sign == '-':
+        return -delta
+    return delta
+
+
+def _load_offset_deltas():
+    deltas = dict((offset, _offset_delta(offset))
+                  for offset in set(_tzmap.itervalues())
+                  if re.match(r'UTC[+-]\d{4}$', offset))
+    # Unknown timezones are ignored.
+    deltas[''] = datetime.timedelta(0)
+    return deltas
+
+# The offsets of `_tzmap` as timedeltas.  Offsets which are not numeric,
+# like 'N/A', are left to dateutil.
+_offset_deltas = _FrozenMapping(_load_offset_deltas())
+
+_DT_PATTERN = re.compile(r'(\d{4})/(\d\d)/(\d\d) (\d\d):(\d\d):(\d\d) (\S+)$')
+
+
+def _lru_cache(maxsize):
+    """
+    Memoizes a function of a single argument, keeping the `maxsize`
+    most recently used results.
+    """
+    def decorator(func):
+        cache = collections.OrderedDict()
+        lock = threading.Lock()
+
+        @functools.wraps(func)
+        def wrapper(arg):
+            with lock:
+                if arg in cache:
+                    value = cache.pop(arg)
+                    cache[arg] = value
+                    return value
+            value = func(arg)
+            with lock:
+                cache[arg] = value
+                if len(cache) > maxsize:
+                    cache.popitem(last=False)
+            return value
+        return wrapper
+    return decorator
+
+
+def _parse_pivotal_dt(value):
+    """
+    Parses the '%Y/%m/%d %H:%M:%S TZ' format Pivotal Tracker uses.
+    Returns None if `value` is in another format or its timezone has no
+    numeric offset.
+    """
+    m = _DT_PATTERN.match(value)
+    if m is None:
+        return None
+    delta = _offset_deltas.get(_tzmap.get(m.group(7), ''))
+    if delta is None:
+        return None
+    try:
+        dt = datetime.datetime(*[int(field) for field in m.groups()[:6]])
+    except ValueError:
+        return None
+    return dt - delta
+
+
+def _parse_dateutil_dt(value):
+    from dateutil import parser
     try:
         parts = value.split(' ')
         dt = ' '.join(parts[:-1])
@@ -102,6 +209,17 @@ def parse_string_to_dt(value):
         time_tuple.tm_sec)
 
 
+@_lru_cache(4096)
+def parse_string_to_dt(value):
+    """
+    Converts a Pivotal Tracker timestamp to a naive datetime in UTC.
+    """
+    dt = _parse_pivotal_dt(value)
+    if dt is None:
+        dt = _parse_dateutil_dt(value)
+    return dt
+
+
 def parse_datetime(node):
     if len(node.childNodes) == 0:
         return None
@@ -141,6 +259,271 @@ NODE_PARSERS = {'array': parse_list,
                 'datetime': parse_datetime}
 
 
+def parse_minidom(content):
+    return parse_dict(minidom.parseString(content))
+
+
+def _etree_type(elem, has_children):
+    # Mirrors the type detection of `parse`.
+    obj_type = elem.get('type')
+    if obj_type is None:
+        if elem.tag in ["stories", "notes"]:
+            obj_type = "array"
+        elif elem.tag in ["labels"]:
+            obj_type = "csv"
+        elif has_children:
+            obj_type = "dictionary"
+        else:
+            obj_type = "string"
+    return obj_type
+
+
+def _etree_csv(elem):
+    if elem.text is None:
+        return []
+    return elem.text.strip().split(",")
+
+
+def _etree_datetime(elem):
+    if elem.text is None:
+        return None
+    return parse_string_to_dt(elem.text.strip())
+
+
+ETREE_LEAF_PARSERS = {'string': lambda elem: (elem.text or '').strip(),
+                      'integer': lambda elem: int((elem.text or '').strip()),
+                      'csv': _etree_csv,
+                      'datetime': _etree_datetime}
+
+
+def _etree_value(elem, values):
+    # Mirrors `parse` for an element whose children have already been
+    # converted to `values`, a list of (tag, value) pairs.
+    obj_type = _etree_type(elem, values)
+    if obj_type == "array":
+        return [value for tag, value in values]
+    elif obj_type in ETREE_LEAF_PARSERS:
+        return ETREE_LEAF_PARSERS[obj_type](elem)
+    return dict(values)
+
+
+def parse_etree(content):
+    """
+    Same as `parse_minidom`, but streams through the document with
+    `cElementTree.iterparse`, so no DOM of the whole payload is built.
+    Every element is converted as soon as it has been read and is then
+    dropped.
+    """
+    if isinstance(content, unicode):
+        content = content.encode('utf-8')
+    stack = [[]]
+    for event, elem in cElementTree.iterparse(StringIO(content),
+                                              events=('start', 'end')):
+        if event == 'start':
+            stack.append([])
+        else:
+            values = stack.pop()
+            stack[-1].append((elem.tag, _etree_value(elem, values)))
+            elem.clear()
+    return dict(stack[0])
+
+
+XML_PARSERS = {'minidom': parse_minidom,
+               'etree': parse_etree}
+
+
+def _lazy_value(elem):
+    obj_type = _etree_type(elem, len(elem))
+    if obj_type == "array":
+        value = LazyList(elem)
+    elif obj_type in ETREE_LEAF_PARSERS:
+        value = ETREE_LEAF_PARSERS[obj_type](elem)
+    else:
+        value = LazyDict(elem)
+    # The proxies hold the children themselves, so the element is not
+    # needed anymore; clearing it lets the parts of the tree which have
+    # been materialized be freed even while it is still referenced.
+    elem.clear()
+    return value
+
+
+class LazyDict(collections.MutableMapping):
+    """
+    Initializes an instance of :class:`LazyDict`, a dictionary of the
+    children of an XML element, which are converted just like
+    `parse_etree` does, but only once they are looked up.  Converted
+    values are kept, so they can be modified like those of a dict.
+
+    :param elem:
+        The `cElementTree` element.
+    """
+
+    def __init__(self, elem):
+        # Holds elements until they are converted, so that converted
+        # ones can be freed.
+        self._elements = dict((child.tag, child) for child in elem)
+        self._values = {}
+
+    def __getitem__(self, key):
+        try:
+            return self._values[key]
+        except KeyError:
+            pass
+        elem = self._elements.get(key)
+        if elem is None:
+            # Either missing, or converted by another thread meanwhile.
+            return self._values[key]
+        value = self._values.setdefault(key, _lazy_value(elem))
+        self._elements.pop(key, None)
+        return value
+
+    def __setitem__(self, key, value):
+        self._values[key] = value
+        self._elements.pop(key, None)
+
+    def __delitem__(self, key):
+        if self._elements.pop(key, None) is None:
+            del self._values[key]
+        else:
+            self._values.pop(key, None)
+
+    def __contains__(self, key):
+        return key in self._values or key in self._elements
+
+    def __iter__(self):
+        return iter(list(self._values) + list(self._elements))
+
+    def __len__(self):
+        return len(self._values) + len(self._elements)
+
+    def clear(self):
+        self._elements.clear()
+        self._values.clear()
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+
+class LazyList(collections.MutableSequence):
+    """
+    Initializes an instance of :class:`LazyList`, the list counterpart of
+    :class:`LazyDict`.
+
+    :param elem:
+        The `cElementTree` element.
+    """
+
+    def __init__(self, elem):
+        # Holds elements until they are converted.
+        self._items = list(elem)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in xrange(*index.indices(len(self)))]
+        item = self._items[index]
+        if isinstance(item, _ELEMENT_TYPE):
+            item = self._items[index] = _lazy_value(item)
+        return item
+
+    def __setitem__(self, index, value):
+        self._items[index] = value
+
+    def __delitem__(self, index):
+        del self._items[index]
+
+    def __len__(self):
+        return len(self._items)
+
+    def insert(self, index, value):
+        self._items.insert(index, value)
+
+    def __eq__(self, other):
+        if not isinstance(other, (list, LazyList)):
+            return NotImplemented
+        return list(self) == list(other)
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        if equal is NotImplemented:
+            return equal
+        return not equal
+
+    def __repr__(self):
+        return repr(list(self))
+
+
+_ELEMENT_TYPE = type(cElementTree.Element('x'))
+
+
+def parse_lazy(content):
+    """
+    Same as `parse_etree`, but returns :class:`LazyDict` and
+    :class:`LazyList` proxies, which convert the elements of the
+    response only when they are accessed.  Malformed values, e.g. of
+    integer elements, raise once accessed.
+    """
+    if isinstance(content, unicode):
+        content = content.encode('utf-8')
+    root = cElementTree.fromstring(content)
+    return {root.tag: _lazy_value(root)}
+
+
+class MultipartBody(object):
+    """
+    Initializes an instance of :class:`MultipartBody`, a file-like view
+    of the chunks `poster.encode.multipart_encode` yields.  httplib sends
+    such a body to the socket block by block, so files are uploaded
+    without being read into memory.
+
+    :param chunks:
+        The iterable of encoded chunks.
+
+    :param size:
+        The total size of the body, as sent in Content-Length.
+
+    :param progress:
+        A callable taking the number of bytes sent so far and `size`,
+        called after every block.
+    """
+
+    def __init__(self, chunks, size, progress=None):
+        self._chunks = iter(chunks)
+        self._buffer = ''
+        self.size = size
+        self.sent = 0
+        self.progress = progress
+
+    def __len__(self):
+        return self.size
+
+    def read(self, blocksize=-1):
+        while blocksize < 0 or len(self._buffer) < blocksize:
+            try:
+                self._buffer += next(self._chunks)
+            except StopIteration:
+                break
+        if blocksize < 0:
+            data, self._buffer = self._buffer, ''
+        else:
+            data, self._buffer = self._buffer[:blocksize], self._buffer[blocksize:]
+        self.sent += len(data)
+        if data and self.progress is not None:
+            self.progress(self.sent, self.size)
+        return data
+
+
+def multipart_body(params, progress=None):
+    """
+    Encodes `params` like `poster.encode.multipart_encode` does, but
+    returns a :class:`MultipartBody` to stream instead of the chunks,
+    together with the headers.
+    """
+    data, mp_headers = multipart_encode(params)
+    size = int(mp_headers['Content-Length'])
+    mp_headers['Content-Length'] = str(size)
+    return MultipartBody(data, size, progress), mp_headers
+
+
 class Endpoint(object):
     def __init__(self, pivotal):
         self.pivotal = pivotal
@@ -305,35 +688,56 @@ class StoryEndpoint(Endpoint):
                        filename,
                        file_obj,
                        filetype,
-                       filesize=None):
-        if isinstance(file_obj, basestring):
+                       filesize=None,
+                       progress=None):
+        """
+        Uploads `file_obj`, a file or a path, as an attachment of the
+        story.  The file is streamed; `filesize` is sent as its length,
+        if given, and `progress` is called with the number of bytes sent
+        so far and the total, see :class:`MultipartBody`.
+        """
+        opened = isinstance(file_obj, basestring)
+        if opened:
             file_obj = open(file_obj, 'rb')
-        file_data = MultipartParam(name='Filedata',
-                                   filename=filename,
-                                   filetype=filetype,
-                                   fileobj=file_obj,
-                                   filesize=filesize)
-
-        params = {'Filedata': file_data}
-        data, mp_headers = multipart_encode(params)
+        try:
+            file_data = MultipartParam(name='Filedata',
+                                       filename=filename,
+                                       filetype=filetype,
+                                       fileobj=file_obj,
+                                       filesize=filesize)
 
-        if 'Content-Length' in mp_headers:
-            mp_headers['Content-Length'] = str(mp_headers['Content-Length'])
+            params = {'Filedata': file_data}
+            body, mp_headers = multipart_body(params, progress)
 
-        return self._post("projects/%s/stories/%s/attachments" % (project_id, story_id),
-                          body="".join(list(data)),
-                          headers=mp_headers)
+            return self._post("projects/%s/stories/%s/attachments" % (project_id, story_id),
+                              body=body,
+                              headers=mp_headers)
+        finally:
+            if opened:
+                file_obj.close()
 
 
 class PivotalClient(object):
 
     def __init__(self, token,
                  base_url="https://www.pivotaltracker.com/services/v3/",
-                 parse_xml=True, cache=None, timeout=None, proxy_info=None):
+                 parse_xml=True, cache=None, timeout=None, proxy_info=None,
+                 client=None, xml_parser='minidom'):
         self.token = token
         self.base_url = base_url
         self.parse_xml = parse_xml
-        self.client = httplib2.Http(cache=cache, timeout=timeout, proxy_info=proxy_info)
+        # The XML parser used for responses, one of `XML_PARSERS`.  Both
+        # return the same structure; 'etree' is faster on large payloads.
+        # With `parse_xml='lazy'`, responses are converted on access by
+        # `parse_lazy` instead.
+        if xml_parser not in XML_PARSERS:
+            raise ValueError('Unknown XML parser: %r' % xml_parser)
+        self.xml_parser = xml_parser
+        # An `httplib2.Http` instance may be passed in, so several clients
+        # can share its kept-alive connections.
+        if client is None:
+            client = httplib2.Http(cache=cache, timeout=timeout, proxy_info=proxy_info)
+        self.client = client
 
         # connect endpoints
         self.projects = ProjectEndpoint(self)
@@ -349,7 +753,7 @@ class PivotalClient(object):
         cleaned_params = dict([(k, v) for k, v in params.iteritems() if v])
 
         headers = {'X-TrackerToken': self.token}
-        if method in ['POST', 'PUT'] and body:
+        if method in ['POST', 'PUT'] and body and 'Content-Type' not in _headers:
             headers['Content-type'] = 'application/xml'
 
         headers.update(_headers)
@@ -366,7 +770,7 @@ class PivotalClient(object):
         parsed_content = None
         try:
             parsed_content = self.parseContent(content)
-        except (ValueError, ExpatError):
+        except (ValueError, ExpatError, SyntaxError):
             log.error(resp)
             log.error(content)
 
@@ -385,10 +789,10 @@ class PivotalClient(object):
         return parsed_content
 
     def parseContent(self, content):
-        dom = minidom.parseString(content)
-
-        if self.parse_xml:
-            return parse_dict(dom)
+        if self.parse_xml == 'lazy':
+            return parse_lazy(content)
+        elif self.parse_xml:
+            return XML_PARSERS[self.xml_parser](content)
         else:
-            return dom
+            return minidom.parseString(content)
 
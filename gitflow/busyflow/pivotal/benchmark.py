@@ -0,0 +1,70 @@
+"""
+Compares the XML parsers of `PivotalClient` on recorded responses.
+
+Run it from the `gitflow` directory::
+
+    python -m busyflow.pivotal.benchmark [-n REPEAT] [-s SCALE] [FILE ...]
+
+Without files, the recorded responses in `fixtures` are used.  SCALE
+repeats the top level elements of every response, to simulate larger
+projects.
+"""
+import glob
+import optparse
+import os
+import time
+from xml.etree import cElementTree
+
+from busyflow.pivotal import XML_PARSERS
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+
+def load(path, scale=1):
+    with open(path, 'rb') as fh:
+        content = fh.read()
+    if scale == 1:
+        return content
+    root = cElementTree.fromstring(content)
+    for elem in list(root) * (scale - 1):
+        root.append(elem)
+    return cElementTree.tostring(root, encoding='UTF-8')
+
+
+def best_time(parse, content, repeat):
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        parse(content)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage='%prog [options] [FILE ...]')
+    parser.add_option('-n', '--repeat', type='int', default=5,
+                      help='parse every file REPEAT times, report the best')
+    parser.add_option('-s', '--scale', type='int', default=1,
+                      help='repeat the top level elements SCALE times')
+    opts, paths = parser.parse_args(argv)
+    if not paths:
+        paths = sorted(glob.glob(os.path.join(FIXTURES, '*.xml')))
+
+    for path in paths:
+        content = load(path, opts.scale)
+        results = dict((name, parse(content))
+                       for name, parse in XML_PARSERS.iteritems())
+        if results['etree'] != results['minidom']:
+            raise SystemExit('%s: the parsers disagree' % path)
+        print '%s (%d bytes)' % (os.path.basename(path), len(content))
+        times = dict((name, best_time(parse, content, opts.repeat))
+                     for name, parse in XML_PARSERS.iteritems())
+        for name in sorted(times):
+            print '  %-8s %8.1f ms  %5.2fx' % (
+                name, times[name] * 1000, times['minidom'] / times[name])
+
+
+if __name__ == '__main__':
+    main()
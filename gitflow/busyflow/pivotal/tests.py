@@ -1,9 +1,18 @@
 # -*- encoding: utf-8 -*-
+import os
+import json
 import unittest2
 import datetime
+import httplib2
 from textwrap import dedent
+from xml.etree import cElementTree
 
-from busyflow.pivotal import PivotalClient
+from busyflow.pivotal import PivotalClient, RequestError, LazyDict
+from busyflow.pivotal import (get_tzmap, parse_string_to_dt,
+                              _parse_pivotal_dt, _parse_dateutil_dt)
+from busyflow.pivotal import v5
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
 
 
 class TestPivotalClient(unittest2.TestCase):
@@ -93,3 +102,167 @@ class TestPivotalClient(unittest2.TestCase):
                         u'accepted_at': datetime.datetime(2012, 1, 1, 14, 0),
                         u'url': u'http://www.pivotaltracker.com/story/show/123'}})
 
+
+    def test_shared_http_client(self):
+        http = httplib2.Http()
+        client1 = PivotalClient('', client=http)
+        client2 = PivotalClient('', client=http)
+        self.assertIs(client1.client, http)
+        self.assertIs(client2.client, http)
+        self.assertIsNot(PivotalClient('').client, http)
+
+    def test_etree_parser_matches_minidom(self):
+        minidom_client = PivotalClient('')
+        etree_client = PivotalClient('', xml_parser='etree')
+        with open(os.path.join(FIXTURES, 'iterations.xml')) as fh:
+            content = fh.read()
+        iterations = etree_client.parseContent(content)
+        self.assertEqual(iterations, minidom_client.parseContent(content))
+        story = iterations['iterations'][1]['stories'][0]
+        self.assertEqual(story['name'], u'Archive old projects')
+        self.assertEqual(story['labels'], ['release-1.2', 'ux'])
+        self.assertEqual(len(story['notes']), 3)
+        self.assertRaises(SyntaxError, etree_client.parseContent, '<story>')
+        self.assertRaises(ValueError, PivotalClient, '', xml_parser='sax')
+
+    def test_lazy_parsing(self):
+        client = PivotalClient('')
+        lazy_client = PivotalClient('', parse_xml='lazy')
+        with open(os.path.join(FIXTURES, 'iterations.xml')) as fh:
+            content = fh.read()
+        iterations = lazy_client.parseContent(content)['iterations']
+        story = iterations[1]['stories'][0]
+        self.assertIsInstance(story, LazyDict)
+        self.assertEqual(story['name'], u'Archive old projects')
+        self.assertEqual(story.get('labels', []), ['release-1.2', 'ux'])
+        # Only what has been looked up is converted.
+        self.assertItemsEqual(story._values, ['name', 'labels'])
+        self.assertIn('notes', story)
+        story['labels'].append('qa+')
+        self.assertEqual(story['labels'], ['release-1.2', 'ux', 'qa+'])
+        del story['labels']
+        self.assertNotIn('labels', story)
+
+        expected = client.parseContent(content)['iterations']
+        del expected[1]['stories'][0]['labels']
+        self.assertEqual(iterations, expected)
+        self.assertEqual(expected, iterations)
+
+    def test_lazy_parsing_releases_elements(self):
+        root = cElementTree.fromstring(
+            '<story><name>A</name><notes type="array">'
+            '<note><text>Done</text></note></notes></story>')
+        name, notes = list(root)
+        story = LazyDict(root)
+        self.assertEqual(story['name'], 'A')
+        self.assertEqual(len(name.attrib) + len(name.text or ''), 0)
+        self.assertEqual(len(notes), 1)
+        self.assertEqual(story['notes'][0]['text'], 'Done')
+        # Materialized elements no longer hold their children.
+        self.assertEqual(len(notes), 0)
+        self.assertEqual(story._elements, {})
+
+    def test_add_attachment_streams_the_file(self):
+        http = FakeHttp(200, '<attachment>\n  <status>Pending</status>\n</attachment>')
+        client = PivotalClient('token', client=http)
+        path = os.path.join(FIXTURES, 'iterations.xml')
+        progress = []
+        result = client.stories.add_attachment(
+            456, 123, 'iterations.xml', path, 'text/xml',
+            progress=lambda sent, total: progress.append((sent, total)))
+        self.assertEqual(result, {'attachment': {'status': 'Pending'}})
+        url, method, body, headers = http.requests[0]
+        self.assertEqual(int(headers['Content-Length']), len(body))
+        self.assertTrue(headers['Content-Type'].startswith('multipart/form-data'))
+        self.assertNotIn('Content-type', headers)
+        with open(path, 'rb') as fh:
+            self.assertIn(fh.read(), body)
+        self.assertGreater(len(progress), 1)
+        self.assertEqual(progress[-1], (len(body), len(body)))
+
+    def test_fast_datetime_parsing_matches_dateutil(self):
+        for tz in [tz for tz in get_tzmap() if ' ' not in tz] + ['XYZ']:
+            value = '2012/12/31 23:30:00 ' + tz
+            dt = _parse_pivotal_dt(value)
+            if dt is not None:
+                self.assertEqual(dt, _parse_dateutil_dt(value), value)
+            self.assertEqual(parse_string_to_dt(value),
+                             _parse_dateutil_dt(value), value)
+        self.assertEqual(_parse_pivotal_dt('2012/12/31 23:30:00 EEST'),
+                         datetime.datetime(2012, 12, 31, 20, 30))
+        self.assertEqual(_parse_pivotal_dt('2012/12/31 23:30:00 EST'),
+                         datetime.datetime(2013, 1, 1, 4, 30))
+        self.assertIsNone(_parse_pivotal_dt('2012/12/31 23:30:00 MET'))
+        self.assertIsNone(_parse_pivotal_dt('2012-12-31T23:30:00Z'))
+
+    def test_tzmap_is_read_only(self):
+        tzmap = get_tzmap()
+        self.assertEqual(tzmap['EEST'], 'UTC+0300')
+        with self.assertRaises(TypeError):
+            tzmap['EEST'] = 'UTC+0000'
+        self.assertFalse(hasattr(tzmap, 'update'))
+        self.assertFalse(hasattr(tzmap, 'pop'))
+
+
+class FakeHttp(object):
+
+    def __init__(self, status, payload):
+        self.response = httplib2.Response({'status': status})
+        if isinstance(payload, basestring):
+            self.content = payload
+        else:
+            self.content = json.dumps(payload)
+        self.requests = []
+
+    def request(self, url, method='GET', body='', headers=None):
+        if hasattr(body, 'read'):
+            # Read the body like httplib does.
+            body = ''.join(iter(lambda: body.read(8192), ''))
+        self.requests.append((url, method, body, headers))
+        return self.response, self.content
+
+
+class TestV5PivotalClient(unittest2.TestCase):
+
+    def test_iterations_have_v3_structure(self):
+        http = FakeHttp(200, [{'kind': 'iteration', 'number': 4,
+                               'finish': '2013-04-30T07:00:00Z', 'stories': [
+            {'kind': 'story', 'id': 123, 'story_type': 'feature',
+             'labels': [{'name': 'release-1.0'}, {'name': 'qa+'}]}]}])
+        client = v5.PivotalClient('token', client=http)
+        self.assertEqual(
+            client.iterations.backlog(456, limit=2, offset=4),
+            {'iterations': [{'number': 4,
+                             'finish': datetime.datetime(2013, 4, 30, 7, 0),
+                             'stories': [
+                {'id': 123, 'story_type': 'feature', 'estimate': -1,
+                 'labels': ['release-1.0', 'qa+']}]}]})
+        url, method, body, headers = http.requests[0]
+        self.assertEqual(method, 'GET')
+        self.assertTrue(url.startswith(
+            'https://www.pivotaltracker.com/services/v5/projects/456/iterations?'))
+        self.assertIn('scope=backlog', url)
+        self.assertIn('fields=number%2Cstart%2Cfinish%2Cstories%28id%2Cname',
+                      url)
+        self.assertEqual(headers['X-TrackerToken'], 'token')
+
+    def test_update_sends_json(self):
+        http = FakeHttp(200, {'kind': 'story', 'id': 123, 'story_type': 'bug',
+                              'current_state': 'finished', 'labels': []})
+        client = v5.PivotalClient('token', client=http)
+        story = client.stories.update(456, 123, current_state='finished',
+                                      labels=['qa+'])
+        self.assertEqual(story['story']['current_state'], 'finished')
+        url, method, body, headers = http.requests[0]
+        self.assertEqual(method, 'PUT')
+        self.assertEqual(json.loads(body), {'current_state': 'finished',
+                                            'labels': [{'name': 'qa+'}]})
+
+    def test_errors_carry_a_message(self):
+        http = FakeHttp(403, {'kind': 'error', 'code': 'unauthorized_operation',
+                              'error': 'Authorization failure.'})
+        client = v5.PivotalClient('token', client=http)
+        with self.assertRaises(RequestError) as cm:
+            client.stories.update(456, 123, current_state='delivered')
+        self.assertEqual(cm.exception.parsed_body['message'],
+                         'Authorization failure.')
@@ -0,0 +1,377 @@
+"""
+A client for the Pivotal Tracker API v5.
+
+It offers the endpoints of :class:`busyflow.pivotal.PivotalClient` and
+returns the same structures the v3 XML parser builds, e.g.
+``{'story': {...}}`` or ``{'iterations': [{'stories': [...]}]}``, so the
+two clients can be used interchangeably.  Stories are downloaded with a
+`fields` projection and only carry the attributes in `STORY_FIELDS`.
+"""
+import base64
+import datetime
+import json
+import urllib
+
+import httplib2
+from poster.encode import MultipartParam
+
+from . import (RequestError, UnauthorizedError, error_from_response, log,
+               multipart_body)
+
+
+# The story attributes downloaded by default.
+STORY_FIELDS = 'id,name,url,story_type,current_state,labels(name),estimate'
+
+# The activity attributes needed by `ProjectEndpoint.activities`.
+ACTIVITY_FIELDS = ('kind,project_version,primary_resources(kind,id),'
+                   'changes(kind,id,new_values)')
+
+
+def story_from_json(story):
+    """
+    Converts a v5 story to the structure of a v3 story.
+
+        >>> sorted(story_from_json({'kind': 'story', 'id': 1,
+        ...     'story_type': 'feature', 'labels': [{'name': 'qa+'}]}).items())
+        [('estimate', -1), ('id', 1), ('labels', ['qa+']), ('story_type', 'feature')]
+    """
+    story = dict(story)
+    story.pop('kind', None)
+    if 'labels' in story:
+        story['labels'] = [label['name'] for label in story['labels']]
+    # v3 reports unestimated features with an estimate of -1, v5 leaves
+    # the estimate out.
+    if story.get('story_type') == 'feature' and 'estimate' not in story:
+        story['estimate'] = -1
+    return story
+
+
+def iteration_from_json(iteration):
+    """
+    Converts a v5 iteration to the structure of a v3 iteration.
+
+        >>> iteration_from_json({'kind': 'iteration', 'number': 4,
+        ...     'finish': '2013-04-30T07:00:00Z'})['finish']
+        datetime.datetime(2013, 4, 30, 7, 0)
+    """
+    iteration = dict(iteration)
+    iteration.pop('kind', None)
+    # v3 parses the dates to naive datetimes in UTC.
+    for key in ('start', 'finish'):
+        if key in iteration:
+            iteration[key] = datetime.datetime.strptime(
+                iteration[key], '%Y-%m-%dT%H:%M:%SZ')
+    iteration['stories'] = [story_from_json(story)
+                            for story in iteration.get('stories', [])]
+    return iteration
+
+
+def activity_from_json(activity):
+    """
+    Converts a v5 activity to the structure of a v3 activity.
+
+        >>> activity = activity_from_json({'kind': 'comment_create_activity',
+        ...     'project_version': 7,
+        ...     'primary_resources': [{'kind': 'story', 'id': 3}]})
+        >>> activity['event_type'], activity['version'], activity['stories']
+        ('note_create', 7, [{'id': 3}])
+
+    Like in v3, the stories carry the new values of changed attributes.
+
+        >>> activity_from_json({'kind': 'story_update_activity',
+        ...     'project_version': 8,
+        ...     'primary_resources': [{'kind': 'story', 'id': 3}],
+        ...     'changes': [{'kind': 'story', 'id': 3,
+        ...                  'new_values': {'estimate': 2}}]})['stories']
+        [{'estimate': 2, 'id': 3}]
+    """
+    event_type = activity['kind']
+    if event_type.endswith('_activity'):
+        event_type = event_type[:-len('_activity')]
+    if event_type.startswith('comment_'):
+        event_type = 'note_' + event_type[len('comment_'):]
+    stories = [{'id': resource['id']}
+               for resource in activity.get('primary_resources', [])
+               if resource.get('kind') == 'story']
+    by_id = dict((story['id'], story) for story in stories)
+    for change in activity.get('changes', []):
+        story = by_id.get(change.get('id'))
+        if change.get('kind') == 'story' and story is not None:
+            story.update((key, value) for key, value
+                         in change.get('new_values', {}).iteritems()
+                         if key != 'id')
+    return {'version': activity['project_version'],
+            'event_type': event_type,
+            'stories': stories}
+
+
+class Endpoint(object):
+    def __init__(self, pivotal):
+        self.pivotal = pivotal
+
+    def _get(self, endpoint, **params):
+        return self.pivotal._apicall(endpoint, 'GET', **params)
+
+    def _post(self, endpoint, **params):
+        return self.pivotal._apicall(endpoint, 'POST', **params)
+
+    def _put(self, endpoint, **params):
+        return self.pivotal._apicall(endpoint, 'PUT', **params)
+
+    def _delete(self, endpoint, **params):
+        return self.pivotal._apicall(endpoint, 'DELETE', **params)
+
+
+class ProjectEndpoint(Endpoint):
+
+    def get(self, project_id):
+        return {'project': self._get("projects/%s" % project_id)}
+
+    def all(self):
+        return {'projects': self._get("projects")}
+
+    def activities(self, project_id, limit=None, occurred_since_date=None, newer_than_version=None):
+        activities = self._get("projects/%s/activity" % project_id, limit=limit,
+                               occurred_after=occurred_since_date,
+                               since_version=newer_than_version,
+                               fields=ACTIVITY_FIELDS)
+        return {'activities': map(activity_from_json, activities)}
+
+    def post(self, name, iteration_length, point_scale):
+        return {'project': self._post("projects", name=name,
+                                      iteration_length=iteration_length,
+                                      point_scale=point_scale)}
+
+
+class IterationEndpoint(Endpoint):
+
+    def _iterations(self, project_id, scope, limit, offset):
+        iterations = self._get("projects/%s/iterations" % project_id,
+                               scope=scope, limit=limit, offset=offset,
+                               fields=self.pivotal.iteration_fields)
+        return {'iterations': map(iteration_from_json, iterations)}
+
+    def all(self, project_id, limit=None, offset=None):
+        return self._iterations(project_id, None, limit, offset)
+
+    def done(self, project_id, limit=None, offset=None):
+        return self._iterations(project_id, 'done', limit, offset)
+
+    def current(self, project_id, limit=None, offset=None):
+        return self._iterations(project_id, 'current', limit, offset)
+
+    def backlog(self, project_id, limit=None, offset=None):
+        return self._iterations(project_id, 'backlog', limit, offset)
+
+    def current_backlog(self, project_id, limit=None, offset=None):
+        return self._iterations(project_id, 'current_backlog', limit, offset)
+
+
+class ActivityEndpoint(Endpoint):
+
+    def all(self, limit=None, occurred_since_date=None, newer_than_version=None):
+        activities = self._get("my/activity", limit=limit,
+                               occurred_after=occurred_since_date,
+                               since_version=newer_than_version,
+                               fields=ACTIVITY_FIELDS)
+        return {'activities': map(activity_from_json, activities)}
+
+
+class TokenEndpoint(Endpoint):
+
+    def active(self, username, password):
+        auth = base64.b64encode('%s:%s' % (username, password))
+        me = self._get('me', headers={'Authorization': 'Basic ' + auth})
+        return {'token': {'guid': me['api_token']}}
+
+
+class StoryEndpoint(Endpoint):
+
+    def make_story_json(self, name=None, description=None, story_type=None,
+                        owned_by=None, requested_by=None, estimate=None, current_state=None, labels=None):
+        """
+        Returns the parameters of a story.  Unlike v3, v5 identifies
+        people by their ids, so `owned_by` and `requested_by` are person
+        ids.
+        """
+        story = {'name': name,
+                 'description': description,
+                 'story_type': story_type,
+                 'owned_by_id': owned_by,
+                 'requested_by_id': requested_by,
+                 'estimate': estimate,
+                 'current_state': current_state}
+        if labels is not None:
+            story['labels'] = [{'name': label} for label in labels]
+        return story
+
+    def _story(self, story):
+        return {'story': story_from_json(story)}
+
+    def all(self, project_id, query=None, limit=None, offset=None):
+        stories = self._get("projects/%s/stories" % project_id, filter=query,
+                            limit=limit, offset=offset,
+                            fields=self.pivotal.story_fields)
+        return {'stories': map(story_from_json, stories)}
+
+    def get(self, project_id, story_id):
+        return self._story(self._get("projects/%s/stories/%s" % (project_id, story_id),
+                                     fields=self.pivotal.story_fields))
+
+    def post(self, project_id, name, description, story_type,
+             owned_by=None, requested_by=None, estimate=None,
+             current_state=None, labels=None):
+        params = self.make_story_json(name, description, story_type,
+                                      owned_by=owned_by,
+                                      requested_by=requested_by,
+                                      estimate=estimate,
+                                      current_state=current_state,
+                                      labels=labels)
+        return self._story(self._post("projects/%s/stories" % project_id,
+                                      fields=self.pivotal.story_fields,
+                                      **params))
+
+    def update(self, project_id, story_id,
+               name=None, description=None, owned_by=None, requested_by=None,
+               story_type=None, estimate=None, current_state=None, labels=None):
+        params = self.make_story_json(name, description, story_type,
+                                      owned_by=owned_by,
+                                      requested_by=requested_by,
+                                      estimate=estimate,
+                                      current_state=current_state,
+                                      labels=labels)
+        return self._story(self._put("projects/%s/stories/%s" % (project_id, story_id),
+                                     fields=self.pivotal.story_fields,
+                                     **params))
+
+    def deliver_all_finished_stories(self, project_id):
+        stories = self._put("projects/%s/stories/deliver_all_finished" % project_id,
+                            fields=self.pivotal.story_fields)
+        return {'stories': map(story_from_json, stories or [])}
+
+    def delete(self, project_id, story_id):
+        return self._delete("projects/%s/stories/%s" % (project_id, story_id))
+
+    def move(self, project_id, story_id, target_id, move='after'):
+        params = {'%s_id' % move: target_id}
+        return self._story(self._put("projects/%s/stories/%s" % (project_id, story_id),
+                                     fields=self.pivotal.story_fields,
+                                     **params))
+
+    def add_comment(self, project_id, story_id, text, author=None):
+        return {'note': self._post("projects/%s/stories/%s/comments" % (project_id, story_id),
+                                   text=text, person_id=author)}
+
+    def add_attachment(self, project_id, story_id,
+                       filename,
+                       file_obj,
+                       filetype,
+                       filesize=None,
+                       progress=None):
+        # Files are uploaded to the project first and then attached to
+        # a new comment of the story.
+        opened = isinstance(file_obj, basestring)
+        if opened:
+            file_obj = open(file_obj, 'rb')
+        try:
+            file_data = MultipartParam(name='file',
+                                       filename=filename,
+                                       filetype=filetype,
+                                       fileobj=file_obj,
+                                       filesize=filesize)
+
+            body, mp_headers = multipart_body({'file': file_data}, progress)
+
+            upload = self._post("projects/%s/uploads" % project_id,
+                                body=body,
+                                headers=mp_headers)
+        finally:
+            if opened:
+                file_obj.close()
+        return {'attachment': self._post(
+            "projects/%s/stories/%s/comments" % (project_id, story_id),
+            file_attachments=[upload])}
+
+
+class PivotalClient(object):
+
+    def __init__(self, token,
+                 base_url="https://www.pivotaltracker.com/services/v5/",
+                 cache=None, timeout=None, proxy_info=None,
+                 client=None, story_fields=STORY_FIELDS):
+        self.token = token
+        self.base_url = base_url
+        # The `fields` projections of downloaded stories and iterations.
+        self.story_fields = story_fields
+        self.iteration_fields = 'number,start,finish,stories(%s)' % (
+            story_fields)
+        if client is None:
+            client = httplib2.Http(cache=cache, timeout=timeout, proxy_info=proxy_info)
+        self.client = client
+
+        # connect endpoints
+        self.projects = ProjectEndpoint(self)
+        self.stories = StoryEndpoint(self)
+        self.activities = ActivityEndpoint(self)
+        self.iterations = IterationEndpoint(self)
+        self.tokens = TokenEndpoint(self)
+
+    def _apicall(self, endpoint, method, **params):
+        url = '%s%s' % (self.base_url, endpoint)
+        body = params.pop('body', None)
+        _headers = params.pop('headers', {})
+        cleaned_params = dict([(k, v) for k, v in params.iteritems() if v is not None])
+
+        headers = {}
+        if self.token:
+            headers['X-TrackerToken'] = self.token
+
+        # The projection is always part of the query, other parameters
+        # are sent as JSON unless reading.
+        query = {}
+        if 'fields' in cleaned_params:
+            query['fields'] = cleaned_params.pop('fields')
+        if method in ['GET', 'DELETE']:
+            query.update(cleaned_params)
+        elif body is None:
+            body = json.dumps(cleaned_params)
+            headers['Content-Type'] = 'application/json'
+        if query:
+            url = '%s?%s' % (url, urllib.urlencode(query))
+
+        headers.update(_headers)
+
+        resp, content = self.client.request(url, method=method, body=body or '',
+                                            headers=headers)
+
+        parsed_content = None
+        try:
+            parsed_content = self.parseContent(content)
+        except ValueError:
+            log.error(resp)
+            log.error(content)
+
+        error_cls = RequestError
+        if resp.status == 401:
+            error_cls = UnauthorizedError
+
+        if resp.status not in (200, 204):
+            if isinstance(parsed_content, dict):
+                # v3 errors carry a message, v5 ones an error and maybe
+                # a more general problem description.
+                parsed_content.setdefault(
+                    'message', parsed_content.get('general_problem')
+                    or parsed_content.get('error'))
+            raise error_from_response(resp, error_cls,
+                                      content, parsed_content)
+
+        if parsed_content is None and content:
+            # generate the error once more
+            self.parseContent(content)
+
+        return parsed_content
+
+    def parseContent(self, content):
+        if not content:
+            return None
+        return json.loads(content)
@@ -0,0 +1,252 @@
+#
+# This file is part of `gitflow`.
+# Copyright (c) 2010-2011 Vincent Driessen
+# Copyright (c) 2012 Hartmut Goebel
+# Distributed under a BSD-like license. For full terms see the file LICENSE.txt
+#
+
+import heapq
+import os
+import subprocess
+
+from git import GitCommandError
+
+__copyright__ = "2010-2011 Vincent Driessen; 2012 Hartmut Goebel"
+__license__ = "BSD"
+
+
+class CommitGraph(object):
+    """
+    Initializes an instance of :class:`CommitGraph`.  A commit graph
+    records the parents and generation number of every commit gitflow
+    has asked about, together with all of their ancestors, so ancestry
+    questions can be answered without spawning git.
+
+    The graph is persisted in `.git/gitflow/commit-graph`, one commit
+    per line.  Commits never change, so the file only ever grows:
+    unknown commits are read with a single `git rev-list` that stops at
+    the commits already recorded, and appended to it.  Recorded commits
+    may get pruned, though, e.g. after a rebase; only then they are
+    looked for, and skipped, and if git still chokes on the graph, it is
+    rebuilt.
+
+    :param repo:
+        The :class:`git.Repo` whose commits are recorded.
+    """
+
+    # The line following an incomplete one.
+    INCOMPLETE = '-'
+
+    def __init__(self, repo):
+        self.repo = repo
+        self.path = os.path.join(repo.git_dir, 'gitflow', 'commit-graph')
+        self._parents = None
+        self._generation = None
+        self._heads = None
+
+    def _load(self):
+        self._parents = {}
+        self._generation = {}
+        self._heads = set()
+        try:
+            with open(self.path) as fh:
+                lines = fh.read().split('\n')
+        except IOError:
+            return
+        # The last line is incomplete (or empty), if a writer got
+        # interrupted.  Writers coming later mark such a line by
+        # following it with a line of its own.
+        for line, next_line in zip(lines, lines[1:]):
+            if line == self.INCOMPLETE or next_line == self.INCOMPLETE:
+                continue
+            fields = line.split()
+            self._add(fields[0], fields[2:], int(fields[1]))
+
+    def _add(self, sha, parents, generation):
+        if sha in self._parents:
+            # Recorded by two processes at once.
+            return
+        self._parents[sha] = parents
+        self._generation[sha] = generation
+        self._heads.add(sha)
+        self._heads.difference_update(parents)
+
+    def _extend(self, shas):
+        """
+        Records all of `shas` and their ancestors which are not yet part
+        of the graph.
+        """
+        if self._parents is None:
+            self._load()
+        missing = [sha for sha in shas if sha not in self._parents]
+        if not missing:
+            return
+        try:
+            out = self._rev_list(missing, self._heads)
+        except GitCommandError:
+            try:
+                # Some of the recorded commits have been pruned.
+                self._heads = self._existing_heads()
+                out = self._rev_list(missing, self._heads)
+            except GitCommandError:
+                # The recorded history does not match the repository
+                # any more, start over.
+                self._discard()
+                out = self._rev_list(list(set(shas)), ())
+        new = [line.split() for line in out.splitlines()]
+        lines = []
+        for fields in reversed(new):
+            sha, parents = fields[0], fields[1:]
+            if sha in self._parents:
+                continue
+            generation = 1 + max([self._generation[p] for p in parents] or [0])
+            self._add(sha, parents, generation)
+            lines.append('%s %d %s\n' % (sha, generation, ' '.join(parents)))
+        self._save(lines)
+
+    def _rev_list(self, shas, heads):
+        # Everything reachable from a recorded commit is recorded, too.
+        revs = list(shas) + ['^' + sha for sha in heads]
+        return self.repo.git.rev_list('--topo-order', '--parents', *revs)
+
+    def _existing_heads(self):
+        """
+        Returns the recorded commits to stop at when reading the history.
+        Heads which have been pruned, e.g. after a rebase, are replaced
+        by their nearest ancestors which still exist.
+        """
+        heads = set()
+        seen = set(self._heads)
+        todo = self._heads
+        while todo:
+            missing = self._missing_objects(todo)
+            heads.update(todo - missing)
+            todo = set(p for sha in missing for p in self._parents.get(sha, [])
+                       if p in self._parents and p not in seen)
+            seen.update(todo)
+        return heads
+
+    def _missing_objects(self, shas):
+        """
+        Returns the subset of `shas` which do not exist in the repository,
+        as found by a single `git cat-file --batch-check`.
+        """
+        if not shas:
+            return set()
+        proc = subprocess.Popen(
+            ['git', '--git-dir', self.repo.git_dir, 'cat-file',
+             '--batch-check'],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        out, _ = proc.communicate(''.join(sha + '\n' for sha in shas))
+        return set(line.split()[0] for line in out.splitlines()
+                   if line.endswith(' missing'))
+
+    def _discard(self):
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+        self._parents = {}
+        self._generation = {}
+        self._heads = set()
+
+    def _save(self, lines):
+        """
+        Appends `lines` to the graph file by a single write, so the lines
+        of concurrent gitflow processes cannot interleave.
+        """
+        if not lines:
+            return
+        data = ''.join(lines)
+        try:
+            with open(self.path, 'rb') as fh:
+                fh.seek(-1, os.SEEK_END)
+                if fh.read(1) != '\n':
+                    data = '\n%s\n%s' % (self.INCOMPLETE, data)
+        except IOError:
+            # Missing or empty.
+            pass
+        try:
+            dirname = os.path.dirname(self.path)
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                         0666)
+            try:
+                os.write(fd, data)
+            finally:
+                os.close(fd)
+        except OSError:
+            # The graph is only a cache.
+            pass
+
+    def parents(self, sha):
+        """
+        Returns the list of parent hexshas of commit `sha`.
+        """
+        self._extend([sha])
+        return self._parents[sha]
+
+    def is_ancestor(self, ancestor, descendant):
+        """
+        Checks whether commit `ancestor` is reachable from commit
+        `descendant`, like `git merge-base --is-ancestor` does.
+
+        :param ancestor:
+            The hexsha of the supposed ancestor.
+
+        :param descendant:
+            The hexsha of the supposed descendant.
+        """
+        self._extend([ancestor, descendant])
+        generation = self._generation
+        min_generation = generation[ancestor]
+        seen = set()
+        todo = [descendant]
+        while todo:
+            sha = todo.pop()
+            if sha == ancestor:
+                return True
+            for parent in self._parents[sha]:
+                # Ancestors have lower generation numbers, so there is
+                # no need to descend below `ancestor`.
+                if parent not in seen and generation[parent] >= min_generation:
+                    seen.add(parent)
+                    todo.append(parent)
+        return False
+
+    def merge_bases(self, sha1, sha2):
+        """
+        Returns the list of best common ancestors of commits `sha1` and
+        `sha2`, like `git merge-base --all` does.  The list is empty, if
+        the commits have no common history.
+        """
+        self._extend([sha1, sha2])
+        generation = self._generation
+        # Walk both histories at once, highest generation first, and
+        # paint each commit with the side(s) it can be reached from.
+        # Commits reached from both sides are common ancestors; their
+        # own ancestors are no longer interesting.
+        LEFT, RIGHT, STALE = 1, 2, 4
+        flags = {sha1: LEFT}
+        flags[sha2] = flags.get(sha2, 0) | RIGHT
+        queue = [(-generation[sha], sha) for sha in set([sha1, sha2])]
+        heapq.heapify(queue)
+        candidates = []
+        while any(not flags[sha] & STALE for _, sha in queue):
+            _, sha = heapq.heappop(queue)
+            flag = flags[sha]
+            if flag & (LEFT | RIGHT) == LEFT | RIGHT and not flag & STALE:
+                candidates.append(sha)
+                flag |= STALE
+            for parent in self._parents[sha]:
+                old = flags.get(parent)
+                new = (old or 0) | flag
+                if old is None:
+                    heapq.heappush(queue, (-generation[parent], parent))
+                flags[parent] = new
+        # A common ancestor found early may still be an ancestor of one
+        # found later.
+        return [c for c in candidates
+                if not any(c != o and self.is_ancestor(c, o)
+                           for o in candidates)]
@@ -11,13 +11,15 @@ import os
 import sys
 import time
 import traceback
+from contextlib import contextmanager
 from functools import wraps
 
 import git
 from git import (Git, Repo, InvalidGitRepositoryError, RemoteReference,
                  GitCommandError)
 
-from gitflow.branches import BranchManager
+from gitflow.branches import BranchManager, RefIndex
+from gitflow.commitgraph import CommitGraph
 from gitflow.util import itersubclasses
 
 from gitflow.exceptions import (NotInitialized, BranchExistsError,
@@ -32,6 +34,28 @@ __license__ = "BSD"
 # A magic string to be used for encoding '-' in git config.
 MAGIC_STRING = 'dKkvQvtBsd9DkQfMJkya'
 
+# Parsed git configuration shared by all GitFlow instances of this process,
+# keyed by the repository's git dir.  Each entry is a pair of the stamps of
+# the config files the snapshot was read from and the snapshot itself.
+_config_snapshots = {}
+
+# Config changes queued by open `GitFlow.config_batch` blocks, keyed by the
+# repository's git dir.  Each change is a (section, option, value) triple,
+# where a value of `_NONE` stands for removing the option.
+_config_batches = {}
+
+# Results of ancestry checks, keyed by (ancestor sha, descendant sha).  Both
+# commits are immutable, so an answer never goes stale.
+_ancestry_memo = {}
+
+# Commit graphs shared by all GitFlow instances of this process, keyed by
+# the repository's git dir.
+_commit_graphs = {}
+
+# GitFlow instances handed out by `shared_gitflow`, keyed by the directory
+# they were created in.
+_shared_gitflows = {}
+
 def datetime_to_timestamp(d):
     return time.mktime(d.timetuple()) + d.microsecond / 1e6
 
@@ -66,11 +90,57 @@ def warn(*texts):
     for txt in texts:
         print >> sys.stderr, txt
 
+def shared_gitflow(cls=None):
+    """
+    Returns the :class:`GitFlow` instance for the current directory.  It is
+    created on first use and then shared by all modules of this process
+    which are not handed an instance explicitly.
+
+    :param cls:
+        The :class:`GitFlow` subclass the instance has to be of.  If the
+        shared instance is not, it is replaced by a new instance of `cls`.
+    """
+    cls = cls or GitFlow
+    cwd = os.getcwd()
+    gitflow = _shared_gitflows.get(cwd)
+    # Retry until the directory has become a repository.
+    if gitflow is None or gitflow.repo is None or not isinstance(gitflow, cls):
+        gitflow = _shared_gitflows[cwd] = cls()
+    return gitflow
+
 
 class _NONE:
     pass
 
 
+def _config_value(valuestr):
+    """
+    Converts a raw git config string into a properly typed value, the same
+    way :meth:`git.config.GitConfigParser.get_value` does it.
+    """
+    for numtype in (long, float):
+        try:
+            value = numtype(valuestr)
+            # truncated value?
+            if value != float(valuestr):
+                continue
+            return value
+        except (ValueError, TypeError):
+            continue
+    if valuestr.lower() == 'false':
+        return False
+    if valuestr.lower() == 'true':
+        return True
+    return valuestr
+
+
+def _apply_config_change(snapshot, section, option, value):
+    if value is _NONE:
+        snapshot.get(section, {}).pop(option, None)
+    else:
+        snapshot.setdefault(section, {})[option] = _config_value(str(value))
+
+
 class GitFlow(object):
     """
     Creates a :class:`GitFlow` instance.
@@ -105,6 +175,7 @@ class GitFlow(object):
         except InvalidGitRepositoryError:
             pass
 
+        self.ref_index = RefIndex(self)
         self.managers = self._discover_branch_managers()
         self.defaults = {
             'gitflow.branch.master': 'master',
@@ -122,22 +193,23 @@ class GitFlow(object):
 
     def _init_config(self, master=None, develop=None, prefixes={}, names={},
                      force_defaults=False):
-        for setting, default in self.defaults.items():
-            if force_defaults:
-                value = default
-            elif setting == 'gitflow.branch.master':
-                value = master
-            elif setting == 'gitflow.branch.develop':
-                value = develop
-            elif setting.startswith('gitflow.prefix.'):
-                name = setting[len('gitflow.prefix.'):]
-                value = prefixes.get(name, None)
-            else:
-                name = setting[len('gitflow.'):]
-                value = names.get(name, None)
-            if value is None:
-                value = self.get(setting, default)
-            self.set(setting, value)
+        with self.config_batch():
+            for setting, default in self.defaults.items():
+                if force_defaults:
+                    value = default
+                elif setting == 'gitflow.branch.master':
+                    value = master
+                elif setting == 'gitflow.branch.develop':
+                    value = develop
+                elif setting.startswith('gitflow.prefix.'):
+                    name = setting[len('gitflow.prefix.'):]
+                    value = prefixes.get(name, None)
+                else:
+                    name = setting[len('gitflow.'):]
+                    value = names.get(name, None)
+                if value is None:
+                    value = self.get(setting, default)
+                self.set(setting, value)
 
     def _init_initial_commit(self):
         master = self.master_name()
@@ -197,6 +269,7 @@ class GitFlow(object):
         if self.repo is None:
             self.git.init(self.working_dir)
             self.repo = Repo(self.working_dir)
+            _config_snapshots.pop(self.repo.git_dir, None)
 
 
     def _enforce_services(self):
@@ -271,11 +344,125 @@ Git config '%s' missing, please fill it in by executing
             raise ValueError('Invalid setting name: %s' % setting)
         return (section, option)
 
+    def _config_stamps(self):
+        stamps = []
+        for level in self.repo.config_level:
+            try:
+                st = os.stat(self.repo._get_config_path(level))
+                stamps.append((st.st_mtime, st.st_size))
+            except OSError:
+                stamps.append(None)
+        return stamps
+
+    @requires_repo
+    def _config_snapshot(self):
+        """
+        Returns the git configuration as a dictionary mapping sections to
+        dictionaries of typed option values.
+
+        The configuration files are parsed only once per process; the
+        snapshot is re-read only when the modification time of any of them
+        (e.g. `.git/config` or `~/.gitconfig`) changes.
+        """
+        stamps = self._config_stamps()
+        cached = _config_snapshots.get(self.repo.git_dir)
+        if cached is not None and cached[0] == stamps:
+            return cached[1]
+        reader = self.repo.config_reader()
+        snapshot = {}
+        for section in reader.sections():
+            snapshot[section] = dict((option, reader.get_value(section, option))
+                                     for option in reader.options(section))
+        # Changes queued by an open batch are not on disk yet.
+        for change in _config_batches.get(self.repo.git_dir, []):
+            _apply_config_change(snapshot, *change)
+        _config_snapshots[self.repo.git_dir] = (stamps, snapshot)
+        return snapshot
+
+    def _write_config(self, changes):
+        """
+        Writes the given (section, option, value) changes into the
+        repository config file within a single lock/write cycle.
+        """
+        git_dir = self.repo.git_dir
+        # Only a snapshot of the files as they are now mirrors the changes.
+        # Re-reading them here would miss changes of a batch, which has
+        # already been closed.
+        cached = _config_snapshots.get(git_dir)
+        if cached is not None and cached[0] != self._config_stamps():
+            cached = None
+        writer = self.repo.config_writer()
+        # Use the plain RawConfigParser methods, GitConfigParser would
+        # rewrite the whole file after every single change.
+        writer.read()
+        for section, option, value in changes:
+            if value is _NONE:
+                if writer.has_section(section):
+                    ConfigParser.RawConfigParser.remove_option(
+                            writer, section, option)
+            else:
+                if not writer.has_section(section):
+                    ConfigParser.RawConfigParser.add_section(writer, section)
+                ConfigParser.RawConfigParser.set(
+                        writer, section, option, str(value))
+        # The writer flushes the changes and releases the lock once it
+        # vanishes.
+        del writer
+        if cached is not None:
+            # The snapshot already mirrors the changes, so just record the
+            # new stamps to avoid re-reading the files.
+            _config_snapshots[git_dir] = (self._config_stamps(), cached[1])
+        else:
+            # The files were changed by someone else, read them again.
+            _config_snapshots.pop(git_dir, None)
+
+    def _change_config(self, section, option, value):
+        snapshot = self._config_snapshot()
+        _apply_config_change(snapshot, section, option, value)
+        batch = _config_batches.get(self.repo.git_dir)
+        if batch is None:
+            self._write_config([(section, option, value)])
+        else:
+            batch.append((section, option, value))
+
+    @contextmanager
+    @requires_repo
+    def config_batch(self):
+        """
+        Context manager queueing all :meth:`set` and :meth:`delete` calls
+        made within its block and writing them into the repository config
+        at once when the block is left.  If the block raises, the queued
+        changes are discarded.
+
+        Values set within the block are visible to :meth:`get` right away.
+        The batch is shared by all :class:`GitFlow` instances working on
+        the same repository, nested blocks join the outermost one.
+        """
+        git_dir = self.repo.git_dir
+        if git_dir in _config_batches:
+            yield self
+            return
+        _config_batches[git_dir] = []
+        try:
+            yield self
+        except:
+            del _config_batches[git_dir]
+            _config_snapshots.pop(git_dir, None)
+            raise
+        changes = _config_batches.pop(git_dir)
+        if changes:
+            self._write_config(changes)
+
     @requires_repo
     def get(self, setting, default=_NONE):
         section, option = self._parse_setting(setting)
         try:
-            value = self.repo.config_reader().get_value(section, option)
+            snapshot = self._config_snapshot()
+            if section not in snapshot:
+                raise ConfigParser.NoSectionError(section)
+            if option not in snapshot[section]:
+                raise ConfigParser.NoOptionError(option, section)
+            value = snapshot[section][option]
             # git config value cannot contain '-', so it is encoded as
             # MAGIC_STRING and we have to replace it with '-' when we read a
             # value.
@@ -296,7 +483,7 @@ Git config '%s' missing, please fill it in by executing
         if isinstance(value, basestring):
             value = value.replace('-', MAGIC_STRING)
         section, option = self._parse_setting(setting)
-        self.repo.config_writer().set_value(section, option, value)
+        self._change_config(section, option, value)
 
     def is_set(self, setting):
         return self.get(setting, None) is not None
@@ -304,7 +491,7 @@ Git config '%s' missing, please fill it in by executing
     @requires_repo
     def delete(self, setting):
         section, option = self._parse_setting(setting)
-        self.repo.config_writer().remove(section, option)
+        self._change_config(section, option, _NONE)
 
     @requires_repo
     def _safe_get(self, setting_name):
@@ -567,13 +754,48 @@ Git config '%s' missing, please fill it in by executing
         except git.BadObject:
             raise BadObjectError(commit)
         if isinstance(target_branch, git.RemoteReference):
-            target_branch = 'remotes/' + target_branch.name
+            target_branch = 'refs/remotes/' + target_branch.name
         elif isinstance(target_branch, git.SymbolicReference):
-            target_branch = target_branch.name
-        # :todo: implement this more efficiently
-        return target_branch in [
-            b.lstrip('* ')
-            for b in self.git.branch('-a', '--contains', commit).splitlines()]
+            target_branch = 'refs/heads/' + target_branch.name
+        elif target_branch.startswith('remotes/'):
+            target_branch = 'refs/' + target_branch
+        else:
+            target_branch = 'refs/heads/' + target_branch
+        try:
+            target = self.git.rev_parse('--verify', '--quiet',
+                                        target_branch + '^{commit}')
+        except GitCommandError:
+            # `target_branch` is not a branch, so it contains nothing.
+            return False
+        return self._is_ancestor(commit.hexsha, target)
+
+    def _is_ancestor(self, ancestor, descendant):
+        """
+        Checks whether commit `ancestor` is reachable from commit
+        `descendant`. Results are memoized per process.
+
+        :param ancestor:
+            The hexsha of the supposed ancestor.
+
+        :param descendant:
+            The hexsha of the supposed descendant.
+        """
+        key = (ancestor, descendant)
+        if key not in _ancestry_memo:
+            _ancestry_memo[key] = self._commit_graph().is_ancestor(
+                ancestor, descendant)
+        return _ancestry_memo[key]
+
+    @requires_repo
+    def _commit_graph(self):
+        """
+        Returns the :class:`CommitGraph` of this repository, which is
+        shared by all GitFlow instances of this process.
+        """
+        git_dir = self.repo.git_dir
+        if git_dir not in _commit_graphs:
+            _commit_graphs[git_dir] = CommitGraph(self.repo)
+        return _commit_graphs[git_dir]
 
 
     def must_be_uptodate(self, branch):
@@ -601,16 +823,15 @@ Git config '%s' missing, please fill it in by executing
             raise NoSuchBranchError('Branch {0} not found'.format(e.args[0]))
         if commit1 == commit2:
             return 0
-        try:
-            base = self.repo.git.merge_base(commit1, commit2)
-        except GitCommandError:
-            return 4
-        if base == commit1:
+        commit1, commit2 = commit1.hexsha, commit2.hexsha
+        if self._is_ancestor(commit1, commit2):
             return 1
-        elif base == commit2:
+        elif self._is_ancestor(commit2, commit1):
             return 2
-        else:
+        elif self._commit_graph().merge_bases(commit1, commit2):
             return 3
+        else:
+            return 4
 
 
     @requires_repo
@@ -643,6 +864,46 @@ Git config '%s' missing, please fill it in by executing
             kwargs['u'] = signingkey
         self.repo.create_tag(tagname, commit, message=message or None, **kwargs)
 
+    def _merge_bases(self, base, commits):
+        """
+        Returns a dict mapping each of `commits` to its merge base
+        with `base`, as `git merge-base` would report it.  The merge
+        bases are found in the commit graph, so no process is spawned
+        per commit.
+
+        :param base:
+            The hexsha of the base commit.
+
+        :param commits:
+            A list of commit hexshas.
+        """
+        graph = self._commit_graph()
+        result = {}
+        for sha in set(commits):
+            candidates = graph.merge_bases(base, sha)
+            if len(candidates) == 1:
+                result[sha] = candidates[0]
+            else:
+                # Criss-cross merges: leave the choice to git.
+                result[sha] = self.git.merge_base(base, sha)
+        return result
+
+    def _tag_names(self, commits):
+        """
+        Returns a dict mapping each of `commits` to a name relative to
+        the nearest tag, or to None if no tag contains it.
+
+        :param commits:
+            A list of commit hexshas.
+        """
+        commits = sorted(set(commits))
+        if not commits:
+            return {}
+        names = self.git.name_rev('--tags', '--name-only',
+                                  *commits).splitlines()
+        return dict((sha, name if name != 'undefined' else None)
+                    for sha, name in zip(commits, names))
+
     #
     #====== sub commands =====
     #
@@ -690,6 +951,17 @@ Git config '%s' missing, please fill it in by executing
 
         basebranch_sha = repo.branches[manager.default_base()].commit.hexsha
 
+        if verbose:
+            # Resolve all merge bases and tag names up-front, so the
+            # number of git calls does not grow with the number of
+            # branches.
+            branch_shas = [b.commit.hexsha for b in branches]
+            base_shas = self._merge_bases(basebranch_sha, branch_shas)
+            if use_tagname:
+                tagnames = self._tag_names(
+                    [base_shas[sha] for sha in branch_shas
+                     if sha != basebranch_sha])
+
         for branch in branches:
             if repo.active_branch == branch:
                 prefix = '* '
@@ -702,16 +974,11 @@ Git config '%s' missing, please fill it in by executing
             if verbose:
                 name = name.ljust(width)
                 branch_sha = branch.commit.hexsha
-                base_sha = repo.git.merge_base(basebranch_sha, branch_sha)
+                base_sha = base_shas[branch_sha]
                 if branch_sha == basebranch_sha:
                     extra_info = '(no commits yet)'
-                elif use_tagname:
-                    try:
-                        extra_info = self.git.name_rev('--tags','--name-only',
-                                                       '--no-undefined', base_sha)
-                        extra_info = '(based on %s)' % extra_info
-                    except GitCommandError:
-                        pass
+                elif use_tagname and tagnames.get(base_sha):
+                    extra_info = '(based on %s)' % tagnames[base_sha]
                 if not extra_info:
                     if base_sha == branch_sha:
                         extra_info = '(is behind %s, may ff)' % manager.default_base()
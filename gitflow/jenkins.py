@@ -6,7 +6,7 @@ import signal
 import sys
 import urlparse
 
-from .core import GitFlow, requires_initialized
+from .core import requires_initialized, shared_gitflow
 from .prompt import ask, pick
 from .exceptions import (ObjectError, GitflowError)
 
@@ -21,10 +21,10 @@ class DeploymentRequestError(GitflowError):
                 .format(self.args)
 
 class Jenkins(object):
-    def __init__(self, username, password):
+    def __init__(self, username, password, gitflow=None):
         assert username
         assert password
-        self._G = GitFlow()
+        self._G = gitflow or shared_gitflow()
         self._J = jenkinsapi.jenkins.Jenkins(self._get_jenkins_url(),
                 username, password)
 
@@ -54,7 +54,8 @@ class Jenkins(object):
         try:
             value = ask('gitflow.jenkins.url',
                         'Insert the Jenkins server url: ',
-                        set_globally=True, is_valid=is_valid)
+                        set_globally=True, is_valid=is_valid,
+                        gitflow=self._G)
         except EOFError:
             raise SystemExit('Operation canceled')
 
@@ -70,12 +71,14 @@ class Jenkins(object):
     def get_deploy_job_name(self, environ):
         return pick('gitflow.jenkins.deployjobname-' + environ,
                 'Jenkins jobs as the deploy job',
-                lambda: [(k, k) for k in self._J.keys()])
+                lambda: [(k, k) for k in self._J.keys()],
+                gitflow=self._G)
 
     def _get_deploy_job_token(self, environ):
         req = 'Insert the security token for Jenkins job {0}: ' \
               .format(self.get_deploy_job_name(environ))
-        raw = ask('gitflow.jenkins.deployjobtoken-' + environ, req, secret=True)
+        raw = ask('gitflow.jenkins.deployjobtoken-' + environ, req, secret=True,
+                  gitflow=self._G)
 
     def get_url_for_next_invocation(self, environ):
         prefix = self._get_jenkins_url()
@@ -87,11 +90,11 @@ class Jenkins(object):
         return urlparse.urljoin(prefix, 'job/{0}/{1}/'.format(job_name, build_number))
 
     @classmethod
-    def from_prompt(cls):
+    def from_prompt(cls, gitflow=None):
         username = None
         password = None
         while username is None or username == '':
             username = raw_input('Jenkins username: ')
         while password is None or password == '':
             password = getpass.getpass('Jenkins password: ')
-        return cls(username, password)
+        return cls(username, password, gitflow)
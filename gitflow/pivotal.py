@@ -1,23 +1,32 @@
-from gitflow.core import GitFlow
+from gitflow.core import shared_gitflow
 import httplib2
 import busyflow.pivotal as pt
+import busyflow.pivotal.v5 as pt_v5
 import string
 from colorama import Style
 from colorama import init
 init()
 import sys
+import os
 import re
+import threading
+import time
+import datetime
 import itertools
+import collections
 import json
+import Queue
+from multiprocessing.pool import ThreadPool
+
+from git import Reference
 
 from gitflow.exceptions import (NotInitialized, GitflowError,
                                 ReleaseAlreadyAssigned, IllegalVersionFormat,
-                                StatusError, NoSuchBranchError, PointMeError)
+                                StatusError, PointMeError)
 
 
 PT_V5_ENDPOINT = 'https://www.pivotaltracker.com/services/v5'
 
-_gitflow = GitFlow()
 
 def check_version_format(version):
     matcher = _get_version_matcher()
@@ -25,21 +34,424 @@ def check_version_format(version):
         raise IllegalVersionFormat(matcher)
 
 def _get_version_matcher():
-    return _gitflow._safe_get('gitflow.release.versionmatcher')
+    return shared_gitflow()._safe_get('gitflow.release.versionmatcher')
 
 def _get_token():
-    return _gitflow._safe_get('gitflow.pt.token')
+    return shared_gitflow()._safe_get('gitflow.pt.token')
+
+# Compiled release label patterns, keyed by the version matcher.
+_release_label_patterns = {}
+
+def _get_release_label_pattern():
+    matcher = _get_version_matcher()
+    if matcher not in _release_label_patterns:
+        _release_label_patterns[matcher] = re.compile(
+            'release-(' + matcher + ')$')
+    return _release_label_patterns[matcher]
+
+# The HTTP session shared by all Pivotal Tracker requests of a thread, and
+# the clients using it, keyed by token.  `httplib2.Http` keeps its
+# connections alive, so they are reused, but it must not be used by several
+# threads at once.
+_local = threading.local()
+
+def get_http():
+    if not hasattr(_local, 'http'):
+        _local.http = httplib2.Http()
+    return _local.http
+
+def _get_api_version():
+    try:
+        return int(shared_gitflow().get('gitflow.pt.apiversion'))
+    except Exception:
+        return 5
+
+def get_client(token=None):
+    if token is None:
+        token = shared_gitflow()._safe_get('gitflow.pt.token')
+    clients = _local.__dict__.setdefault('clients', {})
+    if token not in clients:
+        # The v5 JSON API is used unless gitflow.pt.apiversion says 3.
+        if _get_api_version() == 3:
+            # Stories and iterations are converted once they are looked
+            # at, most of their attributes never are.
+            clients[token] = pt.PivotalClient(
+                token=token, client=get_http(), parse_xml='lazy')
+        else:
+            clients[token] = pt_v5.PivotalClient(
+                token=token, client=get_http())
+    return clients[token]
+
+def _get_workers():
+    try:
+        return max(1, int(shared_gitflow().get('gitflow.pt.workers')))
+    except Exception:
+        return 4
+
+def _get_rate_limit():
+    try:
+        return float(shared_gitflow().get('gitflow.pt.ratelimit'))
+    except Exception:
+        return 5.0
+
+
+class RateLimiter(object):
+    """
+    Initializes an instance of :class:`RateLimiter`, which spaces out
+    requests made from any number of threads.
+
+    :param rate:
+        The number of requests allowed per second.  Zero or less means
+        no limit.
+    """
 
-def get_client():
-    return pt.PivotalClient(token=_gitflow._safe_get('gitflow.pt.token'))
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate > 0 else 0
+        self._lock = threading.Lock()
+        self._next = 0
+
+    def wait(self):
+        """
+        Blocks until the next request may be sent.
+        """
+        with self._lock:
+            now = time.time()
+            delay = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+def map_stories(func, stories):
+    """
+    Calls `func` for each of `stories` on a pool of `gitflow.pt.workers`
+    threads, sending at most `gitflow.pt.ratelimit` requests per second.
+    Returns the list of (result, exception) pairs in the order of
+    `stories`.
+
+    The stories are submitted in order.  Once a call has failed, `func`
+    is not called for the stories that have not been started yet, and
+    both items of their pairs are None.
+    """
+    if not stories:
+        return []
+    limiter = RateLimiter(_get_rate_limit())
+    failed = threading.Event()
+
+    def call(story):
+        limiter.wait()
+        if failed.is_set():
+            return None, None
+        try:
+            return func(story), None
+        except Exception as e:
+            failed.set()
+            return None, e
+
+    pool = ThreadPool(min(_get_workers(), len(stories)))
+    try:
+        return pool.map(call, stories, chunksize=1)
+    finally:
+        pool.close()
 
 def _get_project_id():
-    return _gitflow._safe_get('gitflow.pt.projectid')
+    return shared_gitflow()._safe_get('gitflow.pt.projectid')
+
+def _get_cache_max_age():
+    try:
+        return int(shared_gitflow().get('gitflow.pt.cachemaxage'))
+    except Exception:
+        return 0
+
 
-def iter_current_stories():
-    client = get_client()
-    pid = _get_project_id()
-    iterations = client.iterations.current(pid)
+class StoryCache(object):
+    """
+    Initializes an instance of :class:`StoryCache`.  The story cache keeps
+    the current and backlog iterations of the Pivotal Tracker project in
+    `.git/gitflow/pt-cache`, together with the version of the latest
+    project activity they reflect.
+
+    Once the cache is older than the requested maximum age, it is
+    revalidated through the project's activity feed: only the stories
+    changed since the recorded version are downloaded again.  Activities
+    which may change what the iterations contain (created, deleted or
+    moved stories) make the iterations be downloaded as a whole.
+
+    Stories also move between the current and backlog iterations without
+    any activity of their own, when the current iteration is over or
+    Tracker's automatic planning reshuffles them.  So the iterations are
+    downloaded again once the current iteration has finished, and after
+    changes of the state, estimate or type of any story, which is what
+    the velocity and planning depend on.
+
+    The cache is checked once per process; it is trusted for the rest of
+    the command.
+
+    :param gitflow:
+        The :class:`gitflow.core.GitFlow` instance of the repository.
+
+    :param client:
+        The :class:`busyflow.pivotal.PivotalClient` to use for downloads.
+
+    :param project_id:
+        The Pivotal Tracker project id.
+    """
+
+    # Activities after which updating the changed stories suffices.
+    PATCHABLE_EVENTS = ('story_update', 'note_create')
+
+    # The number of activities to ask for at most; more of them make the
+    # iterations be downloaded as a whole.
+    MAX_ACTIVITIES = 100
+
+    # The story and iteration attributes gitflow reads.  Only these are
+    # written to disk, so lazily parsed payloads are not converted any
+    # further than that.
+    STORY_FIELDS = ('id', 'name', 'url', 'story_type', 'current_state',
+                    'labels', 'estimate')
+    ITERATION_FIELDS = ('number', 'start', 'finish')
+
+    # The story attributes whose changes may move stories between
+    # iterations.
+    MOVING_FIELDS = ('current_state', 'estimate', 'story_type')
+
+    def __init__(self, gitflow, client, project_id):
+        self.path = os.path.join(gitflow.repo.git_dir, 'gitflow', 'pt-cache')
+        self.client = client
+        self.project_id = project_id
+        self._data = None
+        # Whether the cache has been checked by this process.
+        self._checked = False
+        # Guards the cached stories against concurrent updates.
+        self.lock = threading.RLock()
+
+    def _load(self):
+        try:
+            with open(self.path) as fh:
+                data = json.load(fh, object_hook=_decode_datetime)
+        except (IOError, ValueError):
+            data = None
+        if data is None or data.get('project_id') != str(self.project_id):
+            data = None
+        self._data = data
+
+    def _to_json(self):
+        data = dict(self._data)
+        data['stories'] = dict(
+            (story_id, _cached_fields(story, self.STORY_FIELDS))
+            for story_id, story in self._data['stories'].iteritems())
+        for name in ('current', 'backlog'):
+            if 'iterations' not in data.get(name, {}):
+                continue
+            iterations = []
+            for iteration in data[name]['iterations']:
+                stored = _cached_fields(iteration, self.ITERATION_FIELDS)
+                stored['stories'] = [
+                    _cached_fields(story, self.STORY_FIELDS)
+                    for story in iteration.get('stories', [])]
+                iterations.append(stored)
+            data[name] = {'iterations': iterations}
+        return data
+
+    def save(self):
+        """
+        Writes the cache to disk.
+        """
+        if self._data is None:
+            return
+        dirname = os.path.dirname(self.path)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        tmp_path = self.path + '.tmp'
+        with self.lock:
+            with open(tmp_path, 'w') as fh:
+                json.dump(self._to_json(), fh, default=_encode_datetime)
+            os.rename(tmp_path, self.path)
+
+    def _latest_version(self, activities):
+        versions = [a['version'] for a in activities.get('activities', [])]
+        return max(versions or [0])
+
+    def _download(self):
+        # Ask for the version first, so no activity can slip in between.
+        version = self._latest_version(
+            self.client.projects.activities(self.project_id, limit=1))
+        # The iterations themselves are downloaded once asked for.
+        self._data = {
+            'project_id': str(self.project_id),
+            'version': version,
+            'stories': {},
+            }
+
+    def _iter_cached_stories(self):
+        for name in ('current', 'backlog'):
+            for iteration in self._data.get(name, {}).get('iterations', []):
+                for story in iteration['stories']:
+                    yield story
+        for story in self._data['stories'].itervalues():
+            yield story
+
+    def _current_finish(self):
+        # The backlog starts where the current iteration finishes.
+        for name, key in (('current', 'finish'), ('backlog', 'start')):
+            iterations = self._data.get(name, {}).get('iterations', [])
+            if iterations and iterations[0].get(key) is not None:
+                return iterations[0][key]
+        return None
+
+    def _moves_stories(self, activity):
+        event_type = activity.get('event_type')
+        if event_type == 'note_create':
+            return False
+        if event_type != 'story_update':
+            return True
+        for story in activity.get('stories', []):
+            changes = set(story) - set(['id', 'url'])
+            # Without the changed attributes, e.g. for moved stories,
+            # nothing can be told.
+            if not changes or changes.intersection(self.MOVING_FIELDS):
+                return True
+        return False
+
+    def _iterations_moved(self, activities):
+        if any(self._moves_stories(a) for a in activities):
+            return True
+        finish = self._current_finish()
+        return finish is not None and finish <= datetime.datetime.utcnow()
+
+    def _revalidate(self):
+        activities = self.client.projects.activities(
+            self.project_id, limit=self.MAX_ACTIVITIES,
+            newer_than_version=self._data['version']).get('activities', [])
+        if self._iterations_moved(activities):
+            # They are downloaded again once asked for.
+            self._data.pop('current', None)
+            self._data.pop('backlog', None)
+        if not activities:
+            return
+        changed = set()
+        for activity in activities:
+            if activity.get('event_type') not in self.PATCHABLE_EVENTS:
+                changed = None
+                break
+            for story in activity.get('stories', []):
+                changed.add(story['id'])
+        cached = dict((story['id'], story)
+                      for story in self._iter_cached_stories())
+        if len(activities) >= self.MAX_ACTIVITIES or changed is None:
+            self._download()
+            return
+        # Stories which are not cached need not be downloaded; a story
+        # moving into the iterations made them be dropped above.
+        for story_id in changed.intersection(cached):
+            payload = self.client.stories.get(self.project_id, story_id)
+            # Update in place, the story is referenced by the iterations.
+            story = cached[story_id]
+            story.clear()
+            story.update(payload['story'])
+        self._data['version'] = self._latest_version(
+            {'activities': activities})
+
+    def refresh(self, max_age=0):
+        """
+        Makes sure the cache is no older than `max_age` seconds, unless
+        it has been checked by this process already.
+        """
+        with self.lock:
+            if self._checked:
+                return
+            if self._data is None:
+                self._load()
+            if self._data is None:
+                self._download()
+            elif time.time() - self._data.get('validated', 0) > max_age:
+                self._revalidate()
+            else:
+                self._checked = True
+                return
+            self._checked = True
+            self._data['validated'] = time.time()
+            self.save()
+
+    def iterations(self, name, max_age=0):
+        """
+        Returns the payload of the `current` or `backlog` iterations.
+        """
+        self.refresh(max_age)
+        if name not in self._data:
+            endpoint = getattr(self.client.iterations, name)
+            self.store_iterations(name, endpoint(self.project_id))
+        return self._data[name]
+
+    def has_iterations(self, name, max_age=0):
+        """
+        Checks whether the `current` or `backlog` iterations are cached.
+        """
+        self.refresh(max_age)
+        return name in self._data
+
+    def store_iterations(self, name, payload):
+        """
+        Stores the payload of the `current` or `backlog` iterations
+        downloaded elsewhere.
+        """
+        with self.lock:
+            self._data[name] = payload
+            self.save()
+
+    def get_story(self, story_id, max_age=0):
+        """
+        Returns the story with the given id, downloading it only if it
+        is not part of the cache yet.
+        """
+        self.refresh(max_age)
+        for story in self._iter_cached_stories():
+            if str(story['id']) == str(story_id):
+                return story
+        story = self.client.stories.get(self.project_id, story_id)['story']
+        self._data['stories'][str(story['id'])] = story
+        self.save()
+        return story
+
+
+def _cached_fields(obj, fields):
+    # Picks `fields` out of a story or iteration, which may be lazily
+    # parsed; the other attributes are left as they are.
+    result = {}
+    for key in fields:
+        if key in obj:
+            value = obj[key]
+            if isinstance(value, collections.Sequence) \
+                    and not isinstance(value, basestring):
+                value = list(value)
+            result[key] = value
+    return result
+
+def _encode_datetime(obj):
+    if isinstance(obj, datetime.datetime):
+        return {'__datetime__': obj.strftime('%Y-%m-%dT%H:%M:%S')}
+    raise TypeError(repr(obj) + ' is not JSON serializable')
+
+def _decode_datetime(obj):
+    if '__datetime__' in obj:
+        return datetime.datetime.strptime(obj['__datetime__'],
+                                          '%Y-%m-%dT%H:%M:%S')
+    return obj
+
+
+# Story caches of this process, keyed by the repository's git dir.
+_story_caches = {}
+
+def get_story_cache():
+    gitflow = shared_gitflow()
+    git_dir = gitflow.repo.git_dir
+    if git_dir not in _story_caches:
+        _story_caches[git_dir] = StoryCache(gitflow, get_client(),
+                                            _get_project_id())
+    return _story_caches[git_dir]
+
+def iter_current_stories(max_age=0):
+    iterations = get_story_cache().iterations('current', max_age)
     if 'iterations' not in iterations:
         return
     for iteration in iterations['iterations']:
@@ -48,31 +460,123 @@ def iter_current_stories():
             if s.is_feature() or s.is_bug():
                 yield s
 
-def iter_backlog_stories():
-    client = get_client()
-    pid = _get_project_id()
-    iterations = client.iterations.backlog(pid)
+def iter_backlog_stories(max_age=0, prefetcher=None):
+    passed = 0
+    if prefetcher is not None:
+        # Pass on the backlog page by page while it is being downloaded,
+        # and keep it once it is complete.
+        collected = []
+        try:
+            for iteration in prefetcher:
+                collected.append(iteration)
+                for story in iteration['stories']:
+                    s = Story.from_dict(story)
+                    if s.is_feature() or s.is_bug():
+                        yield s
+        except Exception:
+            # Download the backlog at once instead, leaving out the
+            # iterations passed on already.
+            passed = len(collected)
+        else:
+            get_story_cache().store_iterations('backlog',
+                                               {'iterations': collected})
+            return
+    iterations = get_story_cache().iterations('backlog', max_age)
     if 'iterations' not in iterations:
         return
-    for iteration in iterations['iterations']:
+    for iteration in iterations['iterations'][passed:]:
         for story in iteration['stories']:
             s = Story.from_dict(story)
             if s.is_feature() or s.is_bug():
                 yield s
 
-def iter_stories():
+
+class BacklogPrefetcher(threading.Thread):
+    """
+    Initializes an instance of :class:`BacklogPrefetcher`, a thread which
+    downloads the backlog iterations in pages of `PAGE_SIZE` iterations,
+    so they are at hand by the time they are asked for.  Iterating over
+    the prefetcher yields the iterations in order.
+
+    :param token:
+        The Pivotal Tracker token.
+
+    :param project_id:
+        The Pivotal Tracker project id.
+    """
+
+    # The number of iterations downloaded by a single request.
+    PAGE_SIZE = 2
+
+    # The number of pages downloaded ahead of the consumer.
+    PAGES_AHEAD = 2
+
+    def __init__(self, token, project_id):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.token = token
+        self.project_id = project_id
+        self._pages = Queue.Queue(self.PAGES_AHEAD)
+        self._cancelled = threading.Event()
+
+    def _put(self, item):
+        while not self._cancelled.is_set():
+            try:
+                self._pages.put(item, timeout=0.1)
+                return
+            except Queue.Full:
+                pass
+
+    def run(self):
+        client = get_client(self.token)
+        offset = 0
+        try:
+            while not self._cancelled.is_set():
+                payload = client.iterations.backlog(
+                    self.project_id, limit=self.PAGE_SIZE, offset=offset)
+                iterations = payload.get('iterations', [])
+                self._put((iterations, None))
+                if len(iterations) < self.PAGE_SIZE:
+                    break
+                offset += len(iterations)
+        except Exception as e:
+            self._put((None, e))
+        self._put(([], None))
+
+    def __iter__(self):
+        try:
+            while True:
+                iterations, error = self._pages.get()
+                if error is not None:
+                    raise error
+                if not iterations:
+                    # The backlog is exhausted.
+                    return
+                for iteration in iterations:
+                    yield iteration
+        finally:
+            self._cancelled.set()
+
+def iter_stories(max_age=0):
     # Load the PT include/exclude labels from git config.
     # Use string.lower() since PT labels are case insensitive.
-    include = _gitflow.get('gitflow.pt.includelabel', None)
+    include = shared_gitflow().get('gitflow.pt.includelabel', None)
     if include is not None:
         include = include.lower()
 
-    exclude = _gitflow.get('gitflow.pt.excludelabels', None)
+    exclude = shared_gitflow().get('gitflow.pt.excludelabels', None)
     if exclude is not None:
         exclude = exclude.lower()
         exclude = exclude.split(',')
 
-    for s in itertools.chain(iter_current_stories(), iter_backlog_stories()):
+    # Start downloading the backlog right away, unless it is cached.
+    prefetcher = None
+    if not get_story_cache().has_iterations('backlog', max_age):
+        prefetcher = BacklogPrefetcher(_get_token(), _get_project_id())
+        prefetcher.start()
+
+    for s in itertools.chain(iter_current_stories(max_age),
+                             iter_backlog_stories(max_age, prefetcher)):
         if include and not s.is_labeled(include):
             continue
         if exclude and any([l for l in exclude if s.is_labeled(l)]):
@@ -86,11 +590,15 @@ def list_projects():
 class Story(object):
     def __init__(self, story_id, _skip_story_download=False):
         self._project_id = _get_project_id()
-        self._client = get_client()
         if _skip_story_download:
             return
-        payload = self._client.stories.get(self._project_id, story_id)
-        self._story = payload['story']
+        self._story = get_story_cache().get_story(story_id)
+
+    @property
+    def _client(self):
+        # Stories may be updated from several threads, which must not
+        # share a client.
+        return get_client()
 
     def get_id(self):
         return self._story['id']
@@ -114,7 +622,8 @@ class Story(object):
         return self._story.get('labels', [])
 
     def add_label(self, label):
-        labels = self.get_labels()
+        # The cached labels are replaced once the update has succeeded.
+        labels = list(self.get_labels())
         if label in labels:
             return
         labels.append(label)
@@ -143,7 +652,7 @@ class Story(object):
 
         # Download /me
         endpoint = PT_V5_ENDPOINT + '/me'
-        resp, content = httplib2.Http().request(
+        resp, content = get_http().request(
                 endpoint,
                 headers=headers)
         if resp.status != 200:
@@ -161,7 +670,7 @@ class Story(object):
                    .format(PT_V5_ENDPOINT, _get_project_id(), self.get_id())
         req_content = json.dumps({'owned_by_id': my_id})
         headers['Content-Type'] = 'application/json'
-        rep, rep_content = httplib2.Http().request(
+        rep, rep_content = get_http().request(
                 endpoint,
                 body=req_content,
                 method='PUT',
@@ -204,8 +713,9 @@ class Story(object):
 
     def get_release(self):
         assert self.is_feature() or self.is_bug()
+        pattern = _get_release_label_pattern()
         for label in self.get_labels():
-            m = re.match('release-(' + _get_version_matcher() + ')$', label)
+            m = pattern.match(label)
             if m:
                 return m.groups()[0]
 
@@ -216,17 +726,26 @@ class Story(object):
             raise ReleaseAlreadyAssigned('Story already assigned to a release')
         self.add_label('release-' + release)
 
-    def get_branch(self):
+    def get_branch(self, index=None):
+        """
+        Returns the local feature branch of this story or, if there is
+        none, the remote one.  Returns None if neither exists.
+
+        :param index:
+            A :class:`StoryBranchIndex` to look the branch up in.  If
+            not given, the one of the shared GitFlow is used.
+        """
         assert self.is_feature() or self.is_bug()
-        mgr = _gitflow.managers['feature']
-        try:
-            return mgr.by_name_prefix(str(self.get_id()))
-        except NoSuchBranchError:
-            pass
-        try:
-            return mgr.by_name_prefix(str(self.get_id()), remote=True)
-        except NoSuchBranchError:
-            pass
+        if index is None:
+            index = get_story_branch_index()
+        mgr = shared_gitflow().managers['feature']
+        for remote in (False, True):
+            branches = index.branches(self.get_id(), remote=remote)
+            if len(branches) == 1:
+                return branches[0]
+            elif branches:
+                # Let the manager complain about the ambiguity.
+                mgr.by_name_prefix(str(self.get_id()), remote=remote)
         return None
     #--- Bug- & Feature-specific stuff
 
@@ -273,7 +792,10 @@ class Story(object):
             msg += '\n\nMake sure that you are allowed to update this story!'
             raise GitflowError(msg)
         # Commit changes into our internal story instance as well.
-        self._story.update(kwargs)
+        cache = get_story_cache()
+        with cache.lock:
+            self._story.update(kwargs)
+            cache.save()
 
     def to_dict(self):
         return self._story
@@ -284,6 +806,92 @@ class Story(object):
         return t(0, _skip_story_download=True)
 
 
+def _deliver_all_finished(stories):
+    try:
+        get_client().stories.deliver_all_finished_stories(_get_project_id())
+    except pt.RequestError, e:
+        msg  = e.parsed_body['message']
+        msg += '\n\nMake sure that you are allowed to update this story!'
+        raise GitflowError(msg)
+    cache = get_story_cache()
+    with cache.lock:
+        for story in stories:
+            story.to_dict()['current_state'] = 'delivered'
+        cache.save()
+
+
+StoryBranches = collections.namedtuple('StoryBranches',
+                                       'local remote base_marker')
+
+
+class StoryBranchIndex(object):
+    """
+    Initializes an instance of :class:`StoryBranchIndex`, which maps story
+    ids to their local and remote feature branches and to their base
+    markers.  The lookups are answered by bisection in the ref index of
+    `gitflow`, so they cost no git calls as long as the refs do not change.
+
+    As with :meth:`gitflow.branches.BranchManager.by_name_prefix`, the
+    branches of a story are all feature branches whose name starts with
+    the story id.
+
+    :param gitflow:
+        The :class:`gitflow.core.GitFlow` instance of the repository.
+    """
+
+    def __init__(self, gitflow):
+        self.gitflow = gitflow
+
+    def _refs(self, prefix):
+        return [Reference.from_path(self.gitflow.repo, name)
+                for name in self.gitflow.ref_index.names(prefix)]
+
+    def branches(self, story_id, remote=False):
+        """
+        Returns the list of local or remote feature branches of the
+        story with the given id.
+        """
+        mgr = self.gitflow.managers['feature']
+        return self._refs(mgr.ref_prefix(remote) + str(story_id))
+
+    def base_marker(self, story_id, remote=False):
+        """
+        Returns the local or remote base marker of the story with the
+        given id, or None if there is none.
+        """
+        mgr = self.gitflow.managers['feature']
+        name = mgr.base_marker_name(mgr.prefix + str(story_id))
+        if remote:
+            name = 'refs/remotes/' + self.gitflow.origin_name(name)
+        else:
+            name = 'refs/heads/' + name
+        for ref in self._refs(name):
+            if ref.path == name:
+                return ref
+        return None
+
+    def lookup(self, story_id):
+        """
+        Returns the :class:`StoryBranches` of the story with the given
+        id: its local and remote feature branches and its local base
+        marker.
+        """
+        return StoryBranches(self.branches(story_id),
+                             self.branches(story_id, remote=True),
+                             self.base_marker(story_id))
+
+
+def get_story_branch_index():
+    """
+    Returns the :class:`StoryBranchIndex` of the shared GitFlow, creating
+    it on first use.
+    """
+    gitflow = shared_gitflow()
+    if getattr(gitflow, 'story_branch_index', None) is None:
+        gitflow.story_branch_index = StoryBranchIndex(gitflow)
+    return gitflow.story_branch_index
+
+
 class Release(object):
     def __init__(self, version, _skip_story_download=False):
         check_version_format(version)
@@ -291,11 +899,11 @@ class Release(object):
 
         # Load the PT include/exclude labels from git config.
         # Use string.lower() since PT labels are case insensitive.
-        self._include_label = _gitflow.get('gitflow.pt.includelabel', None)
+        self._include_label = shared_gitflow().get('gitflow.pt.includelabel', None)
         if self._include_label is not None:
             self._include_label = self._include_label.lower()
 
-        self._exclude_labels = _gitflow.get('gitflow.pt.excludelables', None)
+        self._exclude_labels = shared_gitflow().get('gitflow.pt.excludelables', None)
         if self._exclude_labels is not None:
             self._exclude_labels = self._exclude_labels.lower()
             self._exclude_labels = self._exclude_labels.split(',')
@@ -303,6 +911,8 @@ class Release(object):
         if _skip_story_download:
             return
         self._current_stories = list(iter_current_stories())
+        # All of the current iteration, not only the stories of a release.
+        self._iteration_stories = self._current_stories
 
     def __iter__(self):
         for story in self._current_stories:
@@ -327,8 +937,12 @@ class Release(object):
         return self._version
 
     def start(self):
-        for story in self.iter_candidates():
-            story.assign_to_release(self._version)
+        stories = list(self.iter_candidates())
+        results = map_stories(
+            lambda story: story.assign_to_release(self._version), stories)
+        for result, error in results:
+            if error is not None:
+                raise error
 
     def try_stage(self):
         err = False
@@ -359,14 +973,59 @@ class Release(object):
     def stage(self):
         print 'Following stories were staged for client acceptance as of release %s:' \
               % self._version
-        for story in self:
-            if not story.is_delivered() \
-                    and not story.is_accepted() \
-                    and not story.is_rejected():
-                story.deliver()
+        stories = list(self)
+        to_deliver = [s for s in stories
+                      if not s.is_delivered()
+                      and not s.is_accepted()
+                      and not s.is_rejected()]
+        # Stories after one that cannot be delivered are left alone, just
+        # like delivering them one by one would do.
+        for i, story in enumerate(to_deliver):
+            if not story.is_finished():
+                to_deliver = to_deliver[:i + 1]
+                stories = stories[:stories.index(story) + 1]
+                break
+
+        if to_deliver and self._delivers_all_finished(
+                to_deliver, getattr(self, '_iteration_stories', None)):
+            _deliver_all_finished(to_deliver)
+            errors = []
+        else:
+            results = map_stories(lambda story: story.deliver(), to_deliver)
+            errors = [error for result, error in results if error is not None]
+
+        if errors:
+            # No more stories are delivered after an error, but those
+            # delivered concurrently until then stay delivered.
+            print '    (delivering failed, only the stories below were delivered)'
+            for story in to_deliver:
+                if story.is_delivered():
+                    sys.stdout.write('        ')
+                    story.dump()
+            raise errors[0]
+        for story in stories:
             sys.stdout.write('    ')
             story.dump()
 
+    def _delivers_all_finished(self, stories, iteration_stories):
+        """
+        Checks whether `stories` are all the finished stories of the
+        project, so they can be delivered by a single request.  Tracker
+        keeps the stories in progress in the current iteration, so it
+        suffices to look at `iteration_stories`, the stories of the
+        current iteration.  If they are None, the stories are not known
+        and False is returned.
+        """
+        if iteration_stories is None:
+            return False
+        if not all(story.is_finished() for story in stories):
+            return False
+        ids = set(story.get_id() for story in stories)
+        for story in iteration_stories:
+            if story.is_finished() and story.get_id() not in ids:
+                return False
+        return True
+
     def try_finish(self):
         self.try_stage()
         err = False
@@ -406,7 +1065,7 @@ class Release(object):
     @classmethod
     def dump_all_releases(cls):
         stories = dict()
-        for story in iter_current_stories():
+        for story in iter_current_stories(_get_cache_max_age()):
             if story.is_feature() or story.is_bug():
                 release = story.get_release()
                 if release:
@@ -456,20 +1115,21 @@ def prompt_user_to_select_story(match=None):
         except Exception as ex:
             raise GitflowError('failed to parse --match flag: {0}'.format(ex))
     try:
-        page_size = int(_gitflow.get('gitflow.pagination'))
+        page_size = int(shared_gitflow().get('gitflow.pagination'))
     except Exception:
         page_size = 10
 
     index = ""
+    branch_index = get_story_branch_index()
     print Style.DIM + "--------- Stories -----------" + Style.RESET_ALL
-    for story in iter_stories():
+    for story in iter_stories(_get_cache_max_age()):
         if story.is_feature() and not story.is_estimated():
             continue
         # You do not start a story if its branch is present or it is
         # assigned to a release, unless it is rejected.
         # If it is not rejected, use checkout instead.
         if (story.get_release() is not None \
-                or story.get_branch() is not None) \
+                or story.get_branch(branch_index) is not None) \
                 and not story.is_rejected():
             continue
         # Make sure the story state is one of the accepted states.
@@ -573,18 +1233,18 @@ def slugify(story_name, max_length=25):
 
 
 def get_iterations():
-    token = _gitflow.get('gitflow.pt.token')
-    project_id = _gitflow.get('gitflow.pt.projectid')
-    client = pt.PivotalClient(token=token)
+    token = shared_gitflow().get('gitflow.pt.token')
+    project_id = shared_gitflow().get('gitflow.pt.projectid')
+    client = get_client(token)
     current = client.iterations.current(project_id)
     backlog = client.iterations.backlog(project_id)
     return [current, backlog]
 
 
 def update_story(story_id, **kwargs):
-    token = _gitflow.get('gitflow.pt.token')
-    project_id = _gitflow.get('gitflow.pt.projectid')
-    client = pt.PivotalClient(token=token)
+    token = shared_gitflow().get('gitflow.pt.token')
+    project_id = shared_gitflow().get('gitflow.pt.projectid')
+    client = get_client(token)
     try:
         client.stories.update(
             project_id=project_id, story_id=story_id, **kwargs)
@@ -595,17 +1255,17 @@ def update_story(story_id, **kwargs):
 
 
 def add_comment_to_story(story_id, msg):
-    token = _gitflow.get('gitflow.pt.token')
-    project_id = _gitflow.get('gitflow.pt.projectid')
-    client = pt.PivotalClient(token=token)
+    token = shared_gitflow().get('gitflow.pt.token')
+    project_id = shared_gitflow().get('gitflow.pt.projectid')
+    client = get_client(token)
     client.stories.add_comment(
         project_id=project_id, story_id=story_id, text =msg)
 
 
 def get_story(story_id):
-    token = _gitflow.get('gitflow.pt.token')
-    project_id = _gitflow.get('gitflow.pt.projectid')
-    client = pt.PivotalClient(token=token)
+    token = shared_gitflow().get('gitflow.pt.token')
+    project_id = shared_gitflow().get('gitflow.pt.projectid')
+    client = get_client(token)
     return client.stories.get(project_id=project_id, story_id=story_id)
 
 
@@ -2,12 +2,13 @@ import ConfigParser
 import getpass
 import sys
 
-from .core import GitFlow, MAGIC_STRING
+from .core import MAGIC_STRING, shared_gitflow
 
 def ask(option, question, set_globally=False, secret=False, is_valid=None,
-        reuse_existing=True):
+        reuse_existing=True, gitflow=None):
 
-    gitflow = GitFlow()
+    if gitflow is None:
+        gitflow = shared_gitflow()
     git = gitflow.repo.git
 
     answer = None
@@ -34,9 +35,10 @@ def ask(option, question, set_globally=False, secret=False, is_valid=None,
             gitflow.set(option, raw_answer)
     return answer
 
-def pick(option, title, source, reuse_existing=True):
+def pick(option, title, source, reuse_existing=True, gitflow=None):
+    if gitflow is None:
+        gitflow = shared_gitflow()
     # Try to get the option from config first.
-    gitflow = GitFlow()
     try:
         if not reuse_existing:
             raise ConfigParser.NoOptionError(option, 'Not using the existing value')
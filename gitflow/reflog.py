@@ -0,0 +1,82 @@
+#
+# This file is part of `gitflow`.
+# Copyright (c) 2010-2011 Vincent Driessen
+# Copyright (c) 2012 Hartmut Goebel
+# Distributed under a BSD-like license. For full terms see the file LICENSE.txt
+#
+
+import mmap
+import os
+from collections import namedtuple
+
+__copyright__ = "2010-2011 Vincent Driessen; 2012 Hartmut Goebel"
+__license__ = "BSD"
+
+
+# An entry of a reflog: the commits the ref pointed to before and after
+# the update, and the message describing it, e.g. 'commit: Fix odd()'.
+ReflogEntry = namedtuple('ReflogEntry', 'old new message')
+
+
+def reflog_path(git_dir, ref):
+    """
+    Returns the path of the reflog of `ref`, which is either a branch
+    name or a full ref name.
+    """
+    if not ref.startswith('refs/'):
+        ref = 'refs/heads/' + ref
+    return os.path.join(git_dir, 'logs', *ref.split('/'))
+
+
+def iter_lines_reversed(path):
+    """
+    Yields the lines of the file at `path`, last one first, without their
+    line endings.  The file is mapped into memory, so only the part which
+    is actually looked at is read.
+    """
+    with open(path, 'rb') as fh:
+        try:
+            data = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty files cannot be mapped.
+            return
+        try:
+            end = len(data)
+            while end > 0:
+                start = data.rfind('\n', 0, end - 1) + 1
+                line = data[start:end].rstrip('\r\n')
+                if line:
+                    yield line
+                end = start
+        finally:
+            data.close()
+
+
+def _parse_entry(line):
+    header, _, message = line.partition('\t')
+    old, new = header.split(' ', 2)[:2]
+    return ReflogEntry(old, new, message)
+
+
+def iter_reflog(git_dir, ref, reverse=True):
+    """
+    Yields the :class:`ReflogEntry` objects of `ref`, the most recent one
+    first unless `reverse` is False.  This is what ``git reflog show``
+    lists, but the reflog file is read directly, so walking the recent
+    history of a ref does not cost more for refs with long reflogs.
+
+    Refs without a reflog have no entries.
+    """
+    path = reflog_path(git_dir, ref)
+    try:
+        if reverse:
+            for line in iter_lines_reversed(path):
+                yield _parse_entry(line)
+        else:
+            with open(path, 'rb') as fh:
+                for line in fh:
+                    line = line.rstrip('\r\n')
+                    if line:
+                        yield _parse_entry(line)
+    except IOError:
+        return
@@ -3,41 +3,58 @@ import subprocess as sub
 import difflib as diff
 import gitflow.pivotal as pivotal
 import reviewboard.extensions as rb_ext
+import reviewboard.rb as rb
 import gitflow.core as core
+import gitflow.reflog as reflog
+import itertools
 import sys
+import tempfile
+import urllib2
+from multiprocessing.pool import ThreadPool
 
-from gitflow.core import GitFlow
+from gitflow.core import shared_gitflow
 from gitflow.exceptions import (GitflowError, MultipleReviewRequestsForBranch,
                                 NoSuchBranchError, AncestorNotFound, EmptyDiff,
                                 PostReviewError, SubmitReviewError)
 
-class ReviewRequestLimitError(GitflowError):
-    def __str__(self):
-        return 'Too many code review requests: {0}'.format(self.args[0])
-
 class ReviewNotAcceptedYet(GitflowError): pass
 
 
-_gitflow = GitFlow()
 
 def _get_repo_id():
-    return _gitflow._safe_get('gitflow.rb.repoid')
+    return shared_gitflow()._safe_get('gitflow.rb.repoid')
 
 def _get_server():
-    return _gitflow._safe_get('reviewboard.server')
+    return shared_gitflow()._safe_get('reviewboard.server')
 
 def _get_url():
-    return _gitflow._safe_get('reviewboard.url')
+    return shared_gitflow()._safe_get('reviewboard.url')
 
 def _get_client():
     return rb_ext.make_rbclient(_get_server(), '', '')
 
+def _to_unicode(s):
+    try:
+        return unicode(s)
+    except UnicodeDecodeError:
+        return unicode(s, encoding='utf8')
+
+def _to_string(us):
+    try:
+        return str(us)
+    except UnicodeEncodeError:
+        return us.encode(encoding='utf8')
+
+def _get_post_method():
+    # Either 'native' or 'rbt'.
+    return shared_gitflow().get('gitflow.rb.post', 'native')
+
 def _get_develop_name():
-    return _gitflow.develop_name()
+    return shared_gitflow().develop_name()
 
 def _get_branch(identifier, name):
-    prefix = _gitflow.get_prefix(identifier)
-    name = _gitflow.nameprefix_or_current(identifier, name)
+    prefix = shared_gitflow().get_prefix(identifier)
+    name = shared_gitflow().nameprefix_or_current(identifier, name)
     return prefix + name
 
 
@@ -46,11 +63,15 @@ def list_repos():
     return [(r.id, r.name) for r in repos]
 
 
+def _get_pending_requests(client):
+    return client.get_pending_requests(_get_repo_id())
+
+
 class BranchReview(object):
-    def __init__(self, branch, rev_range=None):
+    def __init__(self, branch, rev_range=None, client=None):
         assert rev_range is None or len(rev_range) == 2
         self._branch = branch
-        self._client = _get_client()
+        self._client = client or _get_client()
         if rev_range:
             self._rev_range = rev_range
 
@@ -79,24 +100,9 @@ class BranchReview(object):
     def post(self, story, summary_from_story=True):
         assert self._rev_range
 
-        def to_unicode(s):
-            try:
-                return unicode(s)
-            except UnicodeDecodeError:
-                return unicode(s, encoding='utf8')
-
-        def to_string(us):
-            try:
-                return str(us)
-            except UnicodeEncodeError:
-                return us.encode(encoding='utf8')
-
-        cmd = ['rbt', 'post',
-               '--branch', self._branch]
-
         self._check_for_existing_review()
 
-        desc_cmd = ['git', 'log',
+        log = shared_gitflow().repo.git.log(
                     "--pretty="
                         "--------------------%n"
                         "Author:    %an <%ae>%n"
@@ -104,9 +110,9 @@ class BranchReview(object):
                         "%n"
                         "%s%n%n"
                         "%b",
-                    '{0[0]}...{0[1]}'.format(self._rev_range)]
+                    '{0[0]}...{0[1]}'.format(self._rev_range))
         desc_prefix = u'> Story being reviewed: {0}\n'.format(story.get_url())
-        desc = desc_prefix + u'\nCOMMIT LOG\n' + to_unicode(sub.check_output(desc_cmd))
+        desc = desc_prefix + u'\nCOMMIT LOG\n' + _to_unicode(log) + u'\n'
 
         if summary_from_story:
             summary = story.get_name()
@@ -125,20 +131,82 @@ class BranchReview(object):
             for line in lines:
                 if line.startswith('> Story being reviewed'):
                     break
-                kept_desc.append(to_unicode(line))
-            desc = u'\n'.join(kept_desc) + u'\n' + to_unicode(desc)
+                kept_desc.append(_to_unicode(line))
+            desc = u'\n'.join(kept_desc) + u'\n' + _to_unicode(desc)
 
         if self._rid:
             sys.stdout.write('updating %s ... ' % str(self._rid))
-            cmd.append('--review-request-id')
-            cmd.append(str(self._rid))
         else:
             sys.stdout.write('new review ... ')
 
-        cmd.append(u'--summary=' + to_unicode(summary))
-        cmd.append(u'--description=' + to_unicode(desc))
+        if self._can_post_natively():
+            self._post_native(_to_string(_to_unicode(summary)),
+                              _to_string(_to_unicode(desc)))
+        else:
+            self._post_rbt(_to_unicode(summary), _to_unicode(desc), desc_prefix)
+
+        # Keep the pending requests in line, so the request is found
+        # without downloading them again.
+        _get_pending_requests(self._client).add({
+            'id': int(self._rid),
+            'branch': self._branch,
+            'status': 'pending',
+            'summary': _to_unicode(summary),
+            'description': _to_unicode(desc)})
+
+    def _can_post_natively(self):
+        """
+        Returns whether the review request can be posted through the
+        Review Board client of this process instead of ``rbt post``.
+        """
+        return (_get_post_method() != 'rbt'
+                and isinstance(self._client, rb.Api20Client)
+                and shared_gitflow().is_set('gitflow.rb.repoid'))
+
+    def _post_native(self, summary, desc):
+        """
+        Uploads the diff of the review range and updates the draft of the
+        review request, creating the request first if there is none.
+        Like ``rbt post``, this leaves the draft unpublished.
+        """
+        patch, parent_patch = _make_diffs(self._rev_range)
+        fields = {'summary': summary,
+                  'description': desc,
+                  'branch': self._branch}
+        try:
+            if self._rid:
+                self._client.update_request(self._rid, fields=fields,
+                                            diff=patch,
+                                            parentdiff=parent_patch,
+                                            publish=False)
+            else:
+                self._rid = self._client.new_request(_get_repo_id(),
+                                                     fields=fields,
+                                                     diff=patch,
+                                                     parentdiff=parent_patch)
+        except (rb.ReviewBoardError, urllib2.URLError) as e:
+            print('FAIL')
+            print(e)
+            print('Set gitflow.rb.post to rbt to post with rbt instead.')
+            raise PostReviewError('Failed to post review request.')
+        finally:
+            for diff_file in (patch, parent_patch):
+                if hasattr(diff_file, 'close'):
+                    diff_file.close()
+        print('OK')
+        self._url = '{0}r/{1}/'.format(_get_url(), self._rid)
+
+    def _post_rbt(self, summary, desc, desc_prefix):
+        cmd = ['rbt', 'post',
+               '--branch', self._branch]
+        if self._rid:
+            cmd.append('--review-request-id')
+            cmd.append(str(self._rid))
+
+        cmd.append(u'--summary=' + summary)
+        cmd.append(u'--description=' + desc)
         cmd.extend([str(rev) for rev in self._rev_range])
-        cmd = [to_string(itm) for itm in cmd]
+        cmd = [_to_string(itm) for itm in cmd]
 
         p = sub.Popen(cmd, stdout=sub.PIPE, stderr=sub.PIPE)
         (outdata, errdata) = p.communicate()
@@ -202,9 +270,7 @@ class BranchReview(object):
         self._client.update_request(self.get_id(), fields=kwargs, publish=True)
 
     def _branch_to_rid(self, branch):
-        options = dict(repository=_get_repo_id())
-        reviews = self._client.get_review_requests(options=options,
-                                                   branch=self._branch)
+        reviews = _get_pending_requests(self._client).by_branch(branch)
         if len(reviews) > 1:
             raise MultipleReviewRequestsForBranch(self._branch)
         elif len(reviews) == 1:
@@ -220,13 +286,12 @@ class BranchReview(object):
     @classmethod
     def from_prefix(cls, prefix):
         client = _get_client()
-        options = {'repository': _get_repo_id(), 'status': 'pending', 'max-results': 200}
-        requests = client.get_review_requests(options=options)
-        if len(requests) == 200:
-            raise ReviewRequestLimitError(200)
+        return cls._from_pending(_get_pending_requests(client), prefix,
+                                 client)
 
-        reviews = [r for r in requests if r['branch'].startswith(prefix) and \
-                                          r['status'] != 'discarded']
+    @classmethod
+    def _from_pending(cls, pending, prefix, client):
+        reviews = pending.by_prefix(prefix)
         if len(reviews) == 0:
             raise NoSuchBranchError(
                     'No review request found for branch prefixed with ' + prefix)
@@ -234,22 +299,63 @@ class BranchReview(object):
             r = reviews[0]
             t = type('BranchReview', (cls,),
                     dict(_rid=r['id'], _status=r['status']))
-            return t(r['branch'])
+            return t(r['branch'], client=client)
         else:
             raise MultipleReviewRequestsForBranch(reviews[0]['branch'])
 
     @classmethod
     def from_identifier(cls, identifier, name, rev_range=None):
-        prefix = _gitflow.get_prefix(identifier)
-        name = _gitflow.nameprefix_or_current(identifier, name)
+        prefix = shared_gitflow().get_prefix(identifier)
+        name = shared_gitflow().nameprefix_or_current(identifier, name)
         return cls(prefix + name, rev_range)
 
 
 class Release(object):
+    # The number of review requests checked for a 'Ship it!' at once.
+    VERIFY_WORKERS = 8
+
     def __init__(self, stories):
-        self._G = GitFlow()
+        self._G = shared_gitflow()
         self._stories = stories
 
+    def _verify_reviews(self, prefixes):
+        """
+        Looks up and verifies the review requests of all `prefixes` at
+        once.  Returns a dict mapping each prefix to either its verified
+        :class:`BranchReview` or the ``sys.exc_info()`` of the exception
+        raised for it, so it can be raised again with its traceback.
+        """
+        if not prefixes:
+            return {}
+        results = {}
+        try:
+            client = _get_client()
+            pending = _get_pending_requests(client)
+        except Exception:
+            exc_info = sys.exc_info()
+            return dict((prefix, exc_info) for prefix in prefixes)
+        for prefix in prefixes:
+            try:
+                results[prefix] = BranchReview._from_pending(pending, prefix,
+                                                             client)
+            except Exception:
+                results[prefix] = sys.exc_info()
+
+        def verify(prefix):
+            try:
+                results[prefix].verify_submit()
+            except Exception:
+                results[prefix] = sys.exc_info()
+
+        found = [p for p in results if isinstance(results[p], BranchReview)]
+        if found:
+            pool = ThreadPool(min(self.VERIFY_WORKERS, len(found)))
+            try:
+                pool.map(verify, found)
+            finally:
+                pool.close()
+        return results
+
     def try_stage(self, ignore_missing_reviews):
         assert self._stories
         feature_prefix = self._G.get_prefix('feature')
@@ -258,21 +364,29 @@ class Release(object):
         reviews_expected = 0
         err = None
 
+        # Collect the stories to be checked, reporting them in order
+        # once all review requests have been verified.
+        checks = []
         for story in self._stories:
             label = None
             for l in ('no review', 'dupe', 'wontfix', 'cannot reproduce'):
                 if story.is_labeled(l):
                     label = l
-                    print("    Story {0} labeled '{1}', skipping...".format(story.get_id(), l))
                     break
+            checks.append((story, label, feature_prefix + str(story.get_id())))
+        results = self._verify_reviews(
+            [check[2] for check in checks if check[1] is None])
+
+        for story, label, prefix in checks:
             if label is not None:
+                print("    Story {0} labeled '{1}', skipping...".format(story.get_id(), label))
                 continue
 
-            prefix = feature_prefix + str(story.get_id())
             try:
                 reviews_expected += 1
-                review = BranchReview.from_prefix(prefix)
-                review.verify_submit()
+                review = results[prefix]
+                if isinstance(review, tuple):
+                    raise review[0], review[1], review[2]
                 print('    ' + str(review.get_id()))
                 self._reviews.append(review)
             except (ReviewNotAcceptedYet, NoSuchBranchError) as e:
@@ -297,10 +411,7 @@ def post_review(self, identifier, name, post_new):
     mgr = self.managers[identifier]
     branch = mgr.by_name_prefix(name)
 
-    sys.stdout.write("Walking the Git reflogs to find review request parent (might "
-        "take a couple seconds)...\n")
-    sys.stdout.flush()
-
+    parent = None
     if not post_new:
         parent = find_last_patch_parent(self.develop_name(), branch.name)
         if not parent:
@@ -326,7 +437,8 @@ def post_review(self, identifier, name, post_new):
         cmd += ['--summary', "'%s'" % story['story']['name']]
     else:
         req = rb_ext.get_latest_review_request_for_branch(
-            _gitflow.get('reviewboard.server'), branch.name)
+            shared_gitflow().get('reviewboard.server'), branch.name,
+            shared_gitflow().get('gitflow.rb.repoid', None))
         if req:
             # Update an existing request.
             cmd += ['-r', str(req['id'])]
@@ -354,36 +466,79 @@ core.GitFlow.post_review = post_review
 
 
 def get_branch_parent(branch_name):
-    proc = sub.Popen(
-        ['git', 'reflog', 'show', branch_name],
-        env={'GIT_PAGER': 'cat'}, stdout=sub.PIPE)
-    (out, err) = proc.communicate()
-    lines = out.strip().split('\n')
+    """
+    Returns the commit `branch_name` was created from, according to its
+    reflog, or the oldest commit in the reflog if its creation has been
+    forgotten.
+    """
+    # The creation is the oldest entry, so the reflog is read from the
+    # start this time.
+    entries = reflog.iter_reflog(shared_gitflow().repo.git_dir, branch_name,
+                                 reverse=False)
     parent = None
-    for line in lines:
-        parts = line.split(' ')
-        if len(parts) >= 3 and (parts[2]).startswith('branch'):
-            parent = parts[0]
-    if not parent:
-        parent = lines[-1].split(' ')[0]
+    for entry in entries:
+        if entry.message.startswith('branch'):
+            return entry.new
+        if parent is None:
+            parent = entry.new
     return parent
 
-
 def find_last_patch_parent(develop_name, branch_name):
-    proc = sub.Popen(
-        ['git', 'reflog', 'show', develop_name],
-        env={'GIT_PAGER': 'cat'}, stdout=sub.PIPE)
-    (out, err) = proc.communicate()
-    lines = out.strip().split('\n')
-    lines = [l for l in lines if ("merge %s" % branch_name) in l]
-    if len(lines) < 2:
+    """
+    Returns the commit of the second most recent merge of `branch_name`
+    into `develop_name`, or None if it has not been merged twice.
+    """
+    merge = "merge %s" % branch_name
+    merges = (entry.new for entry in
+              reflog.iter_reflog(shared_gitflow().repo.git_dir, develop_name)
+              if merge in entry.message)
+    return next(itertools.islice(merges, 1, None), None)
+
+# The options of ``rbt post`` for diffs of git repositories.
+_DIFF_OPTIONS = ['--no-color', '--full-index', '--ignore-submodules', '-M',
+                 '--no-ext-diff']
+
+def _git_diff(repo, base, tip):
+    """
+    Returns a temporary file which git has written the diff of
+    `base`..`tip` into, or None if the diff is empty.  Large diffs are
+    thus never held in memory; they are read from the file while being
+    uploaded.
+    """
+    patch = tempfile.TemporaryFile()
+    repo.git.diff(*(_DIFF_OPTIONS + ['{0}..{1}'.format(base, tip)]),
+                  output_stream=patch)
+    if not patch.tell():
+        patch.close()
         return None
-    else:
-        # Get the hash of the second most recent merge.
-        return lines[1].split(' ')[0]
+    patch.seek(0)
+    return patch
+
+def _make_diffs(rev_range):
+    """
+    Returns the diff of `rev_range` and its parent diff, the way ``rbt
+    post`` builds them.  The parent diff holds the changes between the
+    remote develop branch and the start of the range, which the server
+    does not know yet.  The diffs are returned as temporary files, an
+    empty parent diff as an empty string.
+    """
+    gitflow = shared_gitflow()
+    repo = gitflow.repo
+    base, tip = [str(rev) for rev in rev_range]
+    patch = _git_diff(repo, base, tip)
+    if patch is None:
+        raise EmptyDiff('There are no changes between {0} and {1}.' \
+                .format(base, tip))
+    parent_patch = ''
+    upstream = gitflow.origin_name(gitflow.develop_name())
+    if upstream in repo.refs:
+        parent_base = repo.git.merge_base(base, upstream)
+        if parent_base != repo.commit(base).hexsha:
+            parent_patch = _git_diff(repo, parent_base, base) or ''
+    return patch, parent_patch
 
 def get_feature_ancestor(feature, upstream):
-    repo = _gitflow.repo
+    repo = shared_gitflow().repo
 
     # Check if we are not looking for the ancestor of the same commit.
     # If that is the case, the algorithm used further fails.
@@ -393,7 +548,7 @@ def get_feature_ancestor(feature, upstream):
         raise EmptyDiff('{0} and {1} are pointing to the same commit.' \
                 .format(upstream, feature))
 
-    base_marker = _gitflow.managers['feature'].base_marker_name(feature)
+    base_marker = shared_gitflow().managers['feature'].base_marker_name(feature)
     for ref in repo.refs:
         if str(ref) == base_marker:
             return ref
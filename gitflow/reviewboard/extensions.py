@@ -1,6 +1,7 @@
 """ Extensions and utility functions for Python Review Board API.
 """
 
+import bisect
 import urllib
 from .rb import Api20Client, make_rbclient
 from operator import itemgetter
@@ -23,13 +24,16 @@ def is_story_approved(rb_server_url, story_id, auth=None):
     return (len(reviews_for_branch) > 0 and
         all(is_shipited(r) for r in reviews_for_branch))
 
-def get_latest_review_request_for_branch(rb_server_url, branch):
-    """ Returns the most recently created review request in Reviewboard
-        for a given branch (i.e., the request with the greatest id).
+def get_latest_review_request_for_branch(rb_server_url, branch,
+                                         repository=None):
+    """ Returns the most recently created pending review request in
+        Reviewboard for a given branch (i.e., the request with the
+        greatest id), looking only at @repository if it is given.
     """
     # Let the username and password be read from the cookie file.
     rb_api = make_rbclient(rb_server_url, '', '')
-    reviews_for_branch = rb_api.get_review_requests(options=None, branch=branch)
+    reviews_for_branch = rb_api.get_pending_requests(repository).by_branch(
+        branch)
     if reviews_for_branch:
         return max(reviews_for_branch, key=itemgetter('id'))
     else:
@@ -44,14 +48,84 @@ def get_reviews_for_review_request(self, rev_req_id):
 Api20Client.get_reviews_for_review_request = get_reviews_for_review_request
 
 
-def get_review_requests(self, options=None, branch=None):
-    options = options or {}
-    rsp = self._api_request(
-        'GET', '/api/review-requests/?%s' % urllib.urlencode(options))
-    requests = rsp['review_requests']
+def iter_review_requests(self, options=None, branch=None):
+    """ Yields the review requests matching @options page by page,
+        following the 'next' links of the result list.
+    """
+    options = dict(options or {})
     if branch:
-        return [r for r in requests if r['branch'] == branch]
-    else:
-        return requests
+        # Servers which do not know this filter just ignore it.
+        options['branch'] = branch
+    url = '/api/review-requests/?%s' % urllib.urlencode(options)
+    while url:
+        rsp = self._api_request('GET', url)
+        for r in rsp['review_requests']:
+            if not branch or r['branch'] == branch:
+                yield r
+        url = rsp.get('links', {}).get('next', {}).get('href')
+
+Api20Client.iter_review_requests = iter_review_requests
+
+
+def get_review_requests(self, options=None, branch=None):
+    return list(self.iter_review_requests(options, branch))
 
 Api20Client.get_review_requests = get_review_requests
+
+
+class PendingRequests(object):
+    """ Downloads all pending review requests of @repository, or of all
+        repositories if it is None, page by page, and indexes them by
+        branch.
+    """
+
+    def __init__(self, client, repository=None):
+        options = {'status': 'pending', 'max-results': 200}
+        if repository is not None:
+            options['repository'] = repository
+        self._by_branch = {}
+        for r in client.iter_review_requests(options=options):
+            if r['status'] != 'discarded':
+                self._by_branch.setdefault(r['branch'], []).append(r)
+        self._branches = sorted(self._by_branch)
+
+    def add(self, request):
+        """ Records @request, e.g. one which has just been posted, in
+            place of the previous version of it.
+        """
+        for branch, requests in self._by_branch.items():
+            requests[:] = [r for r in requests if r['id'] != request['id']]
+            if not requests:
+                del self._by_branch[branch]
+        self._by_branch.setdefault(request['branch'], []).append(request)
+        self._branches = sorted(self._by_branch)
+
+    def by_branch(self, branch):
+        """ Returns the list of pending review requests for @branch.
+        """
+        return self._by_branch.get(branch, [])
+
+    def by_prefix(self, prefix):
+        """ Returns the list of pending review requests for all branches
+            starting with @prefix.
+        """
+        requests = []
+        for branch in self._branches[bisect.bisect_left(self._branches, prefix):]:
+            if not branch.startswith(prefix):
+                break
+            requests.extend(self._by_branch[branch])
+        return requests
+
+
+def get_pending_requests(self, repository=None):
+    """ Returns the :class:`PendingRequests` of @repository.  They are
+        downloaded once per client, and clients are shared per server.
+    """
+    if repository is not None:
+        repository = str(repository)
+    indexes = self.__dict__.setdefault('_pending_requests', {})
+    if repository not in indexes:
+        indexes[repository] = PendingRequests(self, repository)
+    return indexes[repository]
+
+Api20Client.get_pending_requests = get_pending_requests
@@ -1,12 +1,23 @@
 # api code for the reviewboard extension, inspired/copied from reviewboard
 # post-review code.
 
+import atexit
 import cookielib
+import errno
 import getpass
+import httplib
 import mimetools
 import os
+import socket
+import tempfile
+import threading
+import time
 import urllib2
 import simplejson
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from StringIO import StringIO
 #import mercurial.ui
 from urlparse import urljoin, urlparse
 
@@ -117,27 +128,313 @@ class HttpErrorHandler(urllib2.HTTPDefaultErrorHandler):
             result.status = code
             return result
 
+class KeepAliveHandlerMixin:
+    """
+    Keeps the connection to every host open after a request, so the next
+    request of the same thread is sent over it, instead of urllib2's
+    default of one connection per request.  A kept connection which the
+    server has closed meanwhile is replaced, but only if it failed before
+    any of the response has been read and the request is idempotent.
+    Other requests, e.g. posting a review request, are sent over a new
+    connection, so they are never sent twice.
+    """
+    # The methods which may be sent again.
+    IDEMPOTENT_METHODS = ('GET', 'HEAD', 'PUT', 'DELETE')
+
+    def _is_stale(self, err):
+        """
+        Checks whether `err` tells that the server closed the connection
+        before answering.
+        """
+        if isinstance(err, httplib.BadStatusLine):
+            # The status line is empty if the server sent nothing; older
+            # Pythons report it as "''", newer ones with a message.
+            return err.line in ('', "''") or 'closed the connection' in err.line
+        return (isinstance(err, socket.error)
+                and err.errno in (errno.ECONNRESET, errno.EPIPE))
+
+    def _keepalive_open(self, conn_class, req, **conn_args):
+        if getattr(req, '_tunnel_host', None):
+            # Leave requests tunneled through a proxy to urllib2.
+            self._rewind(req)
+            return self.do_open(conn_class, req, **conn_args)
+        host = req.get_host()
+        if not host:
+            raise urllib2.URLError('no host given')
+        # Every thread has connections of its own.
+        local = self.__dict__.get('_local')
+        if local is None:
+            local = self.__dict__.setdefault('_local', threading.local())
+        connections = local.__dict__.setdefault('connections', {})
+
+        headers = dict(req.unredirected_hdrs)
+        headers.update((k, v) for k, v in req.headers.items()
+                       if k not in headers)
+        headers = dict((name.title(), val) for name, val in headers.items())
+
+        idempotent = req.get_method() in self.IDEMPOTENT_METHODS
+        while True:
+            conn = connections.pop(host, None)
+            if conn is not None and not idempotent:
+                conn.close()
+                conn = None
+            reused = conn is not None
+            if not reused:
+                conn = conn_class(host, timeout=req.timeout, **conn_args)
+            self._rewind(req)
+            r = None
+            try:
+                conn.request(req.get_method(), req.get_selector(), req.data,
+                             headers)
+                r = conn.getresponse()
+                # Read the whole response, the connection cannot be used
+                # again before.
+                data = r.read()
+            except (socket.error, httplib.HTTPException), err:
+                conn.close()
+                if reused and r is None and self._is_stale(err):
+                    continue
+                raise urllib2.URLError(err)
+            break
+
+        if r.will_close:
+            conn.close()
+        else:
+            connections[host] = conn
+        resp = urllib2.addinfourl(StringIO(data), r.msg, req.get_full_url())
+        resp.code = r.status
+        resp.msg = r.reason
+        return resp
+
+    def _rewind(self, req):
+        # Streamed bodies are read while being sent, so they must be
+        # rewound for every attempt, including those of the auth handlers.
+        if hasattr(req.data, 'seek'):
+            req.data.seek(0)
+
+class KeepAliveHTTPHandler(KeepAliveHandlerMixin, urllib2.HTTPHandler):
+    def http_open(self, req):
+        return self._keepalive_open(httplib.HTTPConnection, req)
+
+class KeepAliveHTTPSHandler(KeepAliveHandlerMixin, urllib2.HTTPSHandler):
+    def https_open(self, req):
+        return self._keepalive_open(httplib.HTTPSConnection, req,
+                                    context=self._context)
+
+class TrackingCookieJar(cookielib.MozillaCookieJar):
+    """
+    A cookie jar which knows whether its cookies have changed since they
+    were loaded or saved.
+    """
+    def __init__(self, *args, **kwargs):
+        cookielib.MozillaCookieJar.__init__(self, *args, **kwargs)
+        self.changed = False
+
+    def set_cookie(self, cookie):
+        try:
+            old = self._cookies[cookie.domain][cookie.path][cookie.name]
+        except KeyError:
+            old = None
+        if old is None or old.value != cookie.value \
+                or old.expires != cookie.expires:
+            self.changed = True
+        cookielib.MozillaCookieJar.set_cookie(self, cookie)
+
+    def clear(self, *args):
+        cookielib.MozillaCookieJar.clear(self, *args)
+        self.changed = True
+
+    def load(self, *args, **kwargs):
+        cookielib.MozillaCookieJar.load(self, *args, **kwargs)
+        self.changed = False
+
+    def save(self, *args, **kwargs):
+        cookielib.MozillaCookieJar.save(self, *args, **kwargs)
+        self.changed = False
+
+class MultipartFormData:
+    """
+    A multipart/form-data request body, which is read part by part
+    instead of being put together in memory.  Its length is known up
+    front, and it can be rewound, so it can be sent again.
+
+    :param fields:
+        A dict of form field names and values.
+
+    :param files:
+        A dict of form field names and dicts with a 'filename' and the
+        file's 'content', either a string or an open file.
+    """
+    def __init__(self, fields=None, files=None):
+        boundary = mimetools.choose_boundary()
+        self.content_type = "multipart/form-data; boundary=%s" % boundary
+        parts = []
+
+        fields = fields or {}
+        files = files or {}
+
+        for key in fields:
+            parts.append("--%s\r\n"
+                         "Content-Disposition: form-data; name=\"%s\"\r\n"
+                         "\r\n" % (boundary, key))
+            parts.append(str(fields[key]))
+            parts.append("\r\n")
+
+        for key in files:
+            parts.append("--%s\r\n"
+                         "Content-Disposition: form-data; name=\"%s\"; "
+                         "filename=\"%s\"\r\n"
+                         "\r\n" % (boundary, key, files[key]['filename']))
+            parts.append(files[key]['content'])
+            parts.append("\r\n")
+
+        parts.append("--%s--\r\n\r\n" % boundary)
+
+        self._parts = []
+        self._length = 0
+        for part in parts:
+            if isinstance(part, unicode):
+                part = part.encode('utf-8')
+            if hasattr(part, 'read'):
+                start = part.tell()
+                part.seek(0, os.SEEK_END)
+                size = part.tell() - start
+                part.seek(start)
+            else:
+                start = None
+                size = len(part)
+            self._parts.append((part, start))
+            self._length += size
+        self.seek(0)
+
+    def __len__(self):
+        return self._length
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        """
+        Rewinds the body; seeking elsewhere is not supported.
+        """
+        if (offset, whence) != (0, os.SEEK_SET):
+            raise IOError('multipart bodies can only be rewound')
+        self._index = 0
+        self._offset = 0
+        for part, start in self._parts:
+            if start is not None:
+                part.seek(start)
+
+    def read(self, size=-1):
+        chunks = []
+        while size != 0 and self._index < len(self._parts):
+            part, start = self._parts[self._index]
+            if start is not None:
+                data = part.read(size)
+                if not data:
+                    self._index += 1
+                    continue
+            else:
+                if size < 0:
+                    end = len(part)
+                else:
+                    end = self._offset + size
+                data = part[self._offset:end]
+                self._offset += len(data)
+                if self._offset >= len(part):
+                    self._index += 1
+                    self._offset = 0
+            chunks.append(data)
+            if size > 0:
+                size -= len(data)
+        return ''.join(chunks)
+
+def _get_home_path():
+    if 'APPDATA' in os.environ:
+        return os.environ["APPDATA"]
+    elif 'USERPROFILE' in os.environ:
+        return os.path.join(os.environ["USERPROFILE"], "Local Settings",
+                            "Application Data")
+    elif 'HOME' in os.environ:
+        return os.environ["HOME"]
+    else:
+        return ''
+
+class ServerInfoCache:
+    """
+    Remembers facts about Review Board servers which rarely change, like
+    the API version and the repositories, across gitflow runs.  Every
+    value expires `ttl` seconds after it has been stored.
+    """
+    # One day.
+    TTL = 24 * 60 * 60
+
+    def __init__(self, path=None, ttl=TTL):
+        if path is None:
+            path = os.path.join(_get_home_path(), ".gitflow-rb-cache.json")
+        self.path = path
+        self.ttl = ttl
+        self._lock = threading.Lock()
+
+    def _load(self):
+        try:
+            with open(self.path) as fh:
+                data = simplejson.load(fh)
+        except (IOError, ValueError):
+            return {}
+        if not isinstance(data, dict):
+            return {}
+        return data
+
+    def get(self, url, key):
+        """
+        Returns the value stored for `key` of the server at `url`, or
+        None if there is none or it has expired.
+        """
+        with self._lock:
+            entry = self._load().get(url, {}).get(key)
+        if not entry:
+            return None
+        stamp, value = entry
+        if not 0 <= time.time() - stamp < self.ttl:
+            return None
+        return value
+
+    def set(self, url, key, value):
+        with self._lock:
+            data = self._load()
+            data.setdefault(url, {})[key] = [time.time(), value]
+            # Write a new file and rename it over the old one, so that
+            # concurrent gitflow runs never read a partial cache.
+            dirname = os.path.dirname(self.path) or '.'
+            try:
+                fd, tmp = tempfile.mkstemp(prefix='.gitflow-rb-cache',
+                                           dir=dirname)
+                with os.fdopen(fd, 'w') as fh:
+                    simplejson.dump(data, fh)
+                if os.name == 'nt' and os.path.exists(self.path):
+                    os.remove(self.path)
+                os.rename(tmp, self.path)
+            except (IOError, OSError):
+                # The cache is an optimization only.
+                pass
+
 class HttpClient:
     def __init__(self, url, proxy=None):
         if not url.endswith('/'):
             url = url + '/'
         self.url       = url
-        if 'APPDATA' in os.environ:
-            homepath = os.environ["APPDATA"]
-        elif 'USERPROFILE' in os.environ:
-            homepath = os.path.join(os.environ["USERPROFILE"], "Local Settings",
-                                    "Application Data")
-        elif 'HOME' in os.environ:
-            homepath = os.environ["HOME"]
-        else:
-            homepath = ''
-        self.cookie_file = os.path.join(homepath, ".post-review-cookies.txt")
-        self._cj = cookielib.MozillaCookieJar(self.cookie_file)
+        self.cookie_file = os.path.join(_get_home_path(),
+                                        ".post-review-cookies.txt")
+        self._cj = TrackingCookieJar(self.cookie_file)
+        # Requests may be sent from several threads, which must not write
+        # the cookie file at the same time.
+        self._cj_lock = threading.Lock()
+        # The cookie file is written once, when gitflow exits.
+        atexit.register(self.save_cookies)
         self._password_mgr = ReviewBoardHTTPPasswordMgr(self.url)
         self._opener = opener = urllib2.build_opener(
                         urllib2.ProxyHandler(proxy),
                         urllib2.UnknownHandler(),
-                        urllib2.HTTPHandler(),
+                        KeepAliveHTTPHandler(),
+                        KeepAliveHTTPSHandler(),
                         HttpErrorHandler(),
                         urllib2.HTTPErrorProcessor(),
                         urllib2.HTTPCookieProcessor(self._cj),
@@ -149,6 +446,14 @@ class HttpClient:
     def set_credentials(self, username, password):
         self._password_mgr.set_credentials(username, password)
 
+    def save_cookies(self):
+        """
+        Writes the cookie file, if any cookie has changed.
+        """
+        with self._cj_lock:
+            if self._cj.changed:
+                self._cj.save(self.cookie_file)
+
     def api_request(self, method, url, fields=None, files=None):
         """
         Performs an API call using an HTTP request at the specified path.
@@ -217,9 +522,7 @@ class HttpClient:
             if type(url) == unicode:
                 url = url.encode('utf8')
             r = ApiRequest(method, url, body, headers)
-            data = urllib2.urlopen(r).read()
-            self._cj.save(self.cookie_file)
-            return data
+            return urllib2.urlopen(r).read()
         except urllib2.URLError, e:
             if not hasattr(e, 'code'):
                 raise
@@ -246,37 +549,28 @@ class HttpClient:
         """
         Encodes data for use in an HTTP POST.
         """
-        BOUNDARY = mimetools.choose_boundary()
-        content = ""
-
-        fields = fields or {}
-        files = files or {}
-
-        for key in fields:
-            content += "--" + BOUNDARY + "\r\n"
-            content += "Content-Disposition: form-data; name=\"%s\"\r\n" % key
-            content += "\r\n"
-            content += str(fields[key]) + "\r\n"
-
-        for key in files:
-            filename = files[key]['filename']
-            value = files[key]['content']
-            content += "--" + BOUNDARY + "\r\n"
-            content += "Content-Disposition: form-data; name=\"%s\"; " % key
-            content += "filename=\"%s\"\r\n" % filename
-            content += "\r\n"
-            content += value + "\r\n"
-
-        content += "--" + BOUNDARY + "--\r\n"
-        content += "\r\n"
-
-        content_type = "multipart/form-data; boundary=%s" % BOUNDARY
-
-        return content_type, content
+        body = MultipartFormData(fields, files)
+        return body.content_type, body
 
 class ApiClient:
-    def __init__(self, httpclient):
+    def __init__(self, httpclient, cache=None):
         self._httpclient = httpclient
+        self._cache = cache
+
+    def _cached_repositories(self, fetch):
+        """
+        Returns the repositories from the server info cache, or calls
+        `fetch` to download them and stores them in the cache.
+        """
+        if self._cache:
+            repos = self._cache.get(self._httpclient.url, 'repositories')
+            if repos is not None:
+                return [Repository(*r) for r in repos]
+        repos = fetch()
+        if self._cache:
+            self._cache.set(self._httpclient.url, 'repositories',
+                            [(r.id, r.name, r.tool, r.path) for r in repos])
+        return repos
 
     def _api_request(self, method, url, fields=None, files=None):
         return self._httpclient.api_request(method, url, fields, files)
@@ -286,8 +580,8 @@ class Api20Client(ApiClient):
     Implements the 2.0 version of the API
     """
 
-    def __init__(self, httpclient):
-        ApiClient.__init__(self, httpclient)
+    def __init__(self, httpclient, cache=None):
+        ApiClient.__init__(self, httpclient, cache)
         self._repositories = None
         self._requestcache = {}
 
@@ -297,12 +591,15 @@ class Api20Client(ApiClient):
 
     def repositories(self):
         if not self._repositories:
-            rsp = self._api_request('GET', '/api/repositories/?max-results=500')
-            self._repositories = [Repository(r['id'], r['name'], r['tool'],
-                                             r['path'])
-                                  for r in rsp['repositories']]
+            self._repositories = self._cached_repositories(
+                self._fetch_repositories)
         return self._repositories
 
+    def _fetch_repositories(self):
+        rsp = self._api_request('GET', '/api/repositories/?max-results=500')
+        return [Repository(r['id'], r['name'], r['tool'], r['path'])
+                for r in rsp['repositories']]
+
     def new_request(self, repo_id, fields={}, diff='', parentdiff=''):
         req = self._create_request(repo_id)
         self._set_request_details(req, fields, diff, parentdiff)
@@ -355,8 +652,8 @@ class Api10Client(ApiClient):
     Implements the 1.0 version of the API
     """
 
-    def __init__(self, httpclient):
-        ApiClient.__init__(self, httpclient)
+    def __init__(self, httpclient, cache=None):
+        ApiClient.__init__(self, httpclient, cache)
         self._repositories = None
         self._requests = None
 
@@ -382,12 +679,15 @@ class Api10Client(ApiClient):
 
     def repositories(self):
         if not self._repositories:
-            rsp = self._api_post('/api/json/repositories/')
-            self._repositories = [Repository(r['id'], r['name'], r['tool'],
-                                             r['path'])
-                                  for r in rsp['repositories']]
+            self._repositories = self._cached_repositories(
+                self._fetch_repositories)
         return self._repositories
 
+    def _fetch_repositories(self):
+        rsp = self._api_post('/api/json/repositories/')
+        return [Repository(r['id'], r['name'], r['tool'], r['path'])
+                for r in rsp['repositories']]
+
     def requests(self):
         if not self._requests:
             rsp = self._api_post('/api/json/reviewrequests/all/')
@@ -458,7 +758,42 @@ class Api10Client(ApiClient):
     def _save_draft(self, id):
         self._api_post("/api/json/reviewrequests/%s/draft/save/" % id )
 
-def make_rbclient(url, username, password, proxy=None, apiver=''):
+# The clients of this process, see `make_rbclient`.
+_clients = {}
+_clients_lock = threading.Lock()
+
+def _probe_api_version(httpclient):
+    """
+    Figures out whether the server supports API version 2.0.  Servers
+    without the 2.0 API answer with a 404 or a page which is not JSON;
+    any other error is raised.
+    """
+    try:
+        httpclient.api_request('GET', '/api/')
+    except urllib2.HTTPError, e:
+        if e.code != 404:
+            raise
+        return '1.0'
+    except ValueError:
+        return '1.0'
+    return '2.0'
+
+def make_rbclient(url, username, password, proxy=None, apiver='', cache=None):
+    """
+    Returns the client for the Review Board server at `url`.
+
+    Clients are shared within the process, so the credentials are only
+    asked for once.  The API version of the server and its repositories
+    are kept in `cache`, a :class:`ServerInfoCache`, for a day.
+    """
+    key = (url, username, apiver)
+    with _clients_lock:
+        if key not in _clients:
+            _clients[key] = _make_rbclient(url, username, password, proxy,
+                                           apiver, cache or ServerInfoCache())
+        return _clients[key]
+
+def _make_rbclient(url, username, password, proxy, apiver, cache):
     httpclient = HttpClient(url, proxy)
 
     if not httpclient.has_valid_cookie():
@@ -472,19 +807,19 @@ def make_rbclient(url, username, password, proxy=None, apiver=''):
         httpclient.set_credentials(username, password)
 
     if not apiver:
-        # Figure out whether the server supports API version 2.0
-        try:
-            httpclient.api_request('GET', '/api/')
-            apiver = '2.0'
-        except:
-            apiver = '1.0'
+        apiver = cache.get(httpclient.url, 'apiver')
+        if not apiver:
+            apiver = _probe_api_version(httpclient)
+            # Version 1.0 is only assumed from an error, which may as
+            # well have been a transient one, so it is probed again.
+            if apiver == '2.0':
+                cache.set(httpclient.url, 'apiver', apiver)
 
     if apiver == '2.0':
-        return Api20Client(httpclient)
+        return Api20Client(httpclient, cache)
     elif apiver == '1.0':
-        cli = Api10Client(httpclient)
+        cli = Api10Client(httpclient, cache)
         cli.login(username, password)
         return cli
     else:
         raise Exception("Unknown API version: %s" % apiver)
-
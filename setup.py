@@ -44,7 +44,8 @@ setup(
     platforms=["any"],
     license="BSD",
     packages=find_packages(),
-    package_data={'':['gitflow/busyflow/pivotal/tzmap.txt']},
+    package_data={'':['gitflow/busyflow/pivotal/tzmap.txt',
+                     'gitflow/busyflow/pivotal/fixtures/*.xml']},
     include_package_data=True,
     install_requires=install_requires,
     zip_safe=False,
@@ -5,8 +5,10 @@
 # Distributed under a BSD-like license. For full terms see the file LICENSE.txt
 #
 
+import os
 import sys
 import re
+import subprocess
 from functools import wraps
 try:
     from cStringIO import StringIO
@@ -70,6 +72,25 @@ class TestVersionCommand(TestCase):
         self.assertEqual(gitflow.__version__+'\n', stdout)
 
 
+class TestStartup(TestCase):
+
+    # Modules only needed by some sub commands, which must not be
+    # paid for by every invocation of `git flow`.
+    HEAVY_MODULES = ['gitflow.jenkins', 'gitflow.pivotal', 'gitflow.review',
+                     'jenkinsapi', 'requests', 'httplib2', 'colorama',
+                     'busyflow', 'dateutil', 'xmlbuilder', 'rbtools']
+
+    def test_import_budget(self):
+        script = ('import sys, gitflow.bin; '
+                  'print(\' \'.join(sorted(sys.modules)))')
+        root = os.path.dirname(os.path.abspath(gitflow.__path__[0]))
+        loaded = subprocess.check_output([sys.executable, '-c', script],
+                                         cwd=root)
+        loaded = set(m.split('.')[0] if not m.startswith('gitflow.') else m
+                     for m in loaded.split())
+        self.assertEqual([], [m for m in self.HEAVY_MODULES if m in loaded])
+
+
 class TestStatusCommand(TestCase):
 
     @copy_from_fixture('sample_repo')
@@ -159,6 +159,40 @@ class TestFeatureBranchManager(TestCase):
         self.assertRaises(PrefixNotUniqueError, mgr.by_name_prefix, 're')
         self.assertRaises(NoSuchBranchError, mgr.by_name_prefix, 'nonexisting')
 
+    @copy_from_fixture('sample_repo')
+    def test_list_sees_ref_changes(self):
+        gitflow = GitFlow()
+        mgr = FeatureBranchManager(gitflow)
+        self.assertItemsEqual(['feat/even', 'feat/recursion'],
+                              [b.name for b in mgr.list()])
+        self.repo.create_head('feat/nested/foo', 'feat/even')
+        self.assertItemsEqual(['feat/even', 'feat/nested/foo', 'feat/recursion'],
+                              [b.name for b in mgr.list()])
+        self.assertEquals('feat/nested/foo', mgr.by_name_prefix('n').name)
+        self.repo.delete_head('feat/even', force=True)
+        self.assertItemsEqual(['feat/nested/foo', 'feat/recursion'],
+                              [b.name for b in mgr.list()])
+        self.assertRaises(NoSuchBranchError, mgr.by_name_prefix, 'e')
+
+    @copy_from_fixture('sample_repo')
+    def test_ref_index_checks_only_the_looked_up_refs(self):
+        self.repo.create_tag('first')
+        index = GitFlow().ref_index
+        builds = []
+        build = index._build
+        index._build = lambda prefix='': (builds.append(prefix), build(prefix))
+        feat = ['refs/heads/feat/even', 'refs/heads/feat/recursion']
+        self.assertEquals(index.names('refs/heads/feat/'), feat)
+        self.assertEquals(index.names('refs/heads/feat/'), feat)
+        self.assertEquals(len(builds), 1)
+        self.repo.create_tag('unrelated')
+        self.assertEquals(index.names('refs/heads/feat/'), feat)
+        self.assertEquals(len(builds), 1)
+        self.assertEquals(index.names('refs/tags/unrel'), ['refs/tags/unrelated'])
+        self.assertEquals(len(builds), 2)
+        self.repo.create_head('feat/odd', 'feat/even')
+        self.assertEquals(index.names('refs/heads/feat/o'), ['refs/heads/feat/odd'])
+
     #--- create ---
 
     def test_create_new_feature_branch(self):
@@ -0,0 +1,115 @@
+#
+# This file is part of `gitflow`.
+# Copyright (c) 2010-2011 Vincent Driessen
+# Copyright (c) 2012 Hartmut Goebel
+# Distributed under a BSD-like license. For full terms see the file LICENSE.txt
+#
+
+import os
+from unittest2 import TestCase
+
+from git import Repo
+
+from gitflow.commitgraph import CommitGraph
+
+from tests.helpers import copy_from_fixture, fake_commit, all_commits
+
+__copyright__ = "2010-2011 Vincent Driessen; 2012 Hartmut Goebel"
+__license__ = "BSD"
+
+
+class TestCommitGraph(TestCase):
+
+    @copy_from_fixture('sample_repo')
+    def test_merge_bases_match_git(self):
+        graph = CommitGraph(self.repo)
+        shas = [c.hexsha for c in all_commits(self.repo)]
+        for sha1 in shas:
+            for sha2 in shas:
+                self.assertItemsEqual(
+                    graph.merge_bases(sha1, sha2),
+                    self.repo.git.merge_base('--all', sha1, sha2).split())
+
+    @copy_from_fixture('sample_repo')
+    def test_is_ancestor(self):
+        graph = CommitGraph(self.repo)
+        devel = self.repo.branches['devel'].commit.hexsha
+        feat = self.repo.branches['feat/even'].commit.hexsha
+        self.assertTrue(graph.is_ancestor(devel, feat))
+        self.assertFalse(graph.is_ancestor(feat, devel))
+        self.assertTrue(graph.is_ancestor(devel, devel))
+
+    @copy_from_fixture('sample_repo')
+    def test_graph_is_persisted_and_extended(self):
+        graph = CommitGraph(self.repo)
+        devel = self.repo.branches['devel'].commit.hexsha
+        graph.parents(devel)
+        self.assertTrue(os.path.exists(graph.path))
+        size = os.path.getsize(graph.path)
+
+        with open(graph.path) as fh:
+            old = fh.read()
+
+        self.repo.branches['devel'].checkout()
+        new = fake_commit(self.repo, 'Yet another commit').hexsha
+        graph = CommitGraph(self.repo)
+        # Recorded commits which still exist are not looked for.
+        graph._missing_objects = None
+        self.assertEqual(graph.parents(new), [devel])
+        self.assertTrue(graph.is_ancestor(devel, new))
+        # only the new commit has been appended
+        with open(graph.path) as fh:
+            content = fh.read()
+        self.assertGreater(os.path.getsize(graph.path), size)
+        self.assertTrue(content.startswith(old))
+        lines = content.splitlines()
+        self.assertEqual(lines[-1].split()[0], new)
+        self.assertEqual(len([l for l in lines if l.startswith(new)]), 1)
+
+    @copy_from_fixture('sample_repo')
+    def test_incomplete_lines_are_skipped(self):
+        graph = CommitGraph(self.repo)
+        devel = self.repo.branches['devel'].commit.hexsha
+        parents = graph.parents(devel)
+        # A writer got interrupted.
+        with open(graph.path, 'a') as fh:
+            fh.write('0123456789')
+        self.repo.branches['devel'].checkout()
+        new = fake_commit(self.repo, 'Yet another commit').hexsha
+        self.assertEqual(CommitGraph(self.repo).parents(new), [devel])
+        graph = CommitGraph(self.repo)
+        self.assertEqual(graph.parents(devel), parents)
+        self.assertEqual(graph.parents(new), [devel])
+        self.assertNotIn('0123456789', graph._parents)
+
+    @copy_from_fixture('sample_repo')
+    def test_graph_survives_pruned_commits(self):
+        self.repo.branches['devel'].checkout()
+        devel = self.repo.branches['devel'].commit.hexsha
+        old = fake_commit(self.repo, 'To be amended').hexsha
+        CommitGraph(self.repo).parents(old)
+        self.repo.git.reset('--hard', 'HEAD~1')
+        fake_commit(self.repo, 'Amended')
+        self.repo.git.reflog('expire', '--expire=now', '--all')
+        self.repo.git.gc('--prune=now')
+        amended = self.repo.git.rev_parse('HEAD')
+        new = fake_commit(Repo(self.repo.working_dir), 'After the amend').hexsha
+        graph = CommitGraph(self.repo)
+        self.assertEqual(graph.parents(new), [amended])
+        self.assertEqual(graph.parents(amended), [devel])
+        self.assertTrue(graph.is_ancestor(devel, new))
+
+    @copy_from_fixture('sample_repo')
+    def test_broken_graph_is_rebuilt(self):
+        graph = CommitGraph(self.repo)
+        devel = self.repo.branches['devel'].commit.hexsha
+        graph.parents(devel)
+        graph = CommitGraph(self.repo)
+        # Make git choke on the recorded commits.
+        graph._load()
+        graph._heads = set(['1' * 40])
+        graph._existing_heads = lambda: set(['1' * 40])
+        feat = self.repo.branches['feat/even'].commit.hexsha
+        self.assertTrue(graph.is_ancestor(devel, feat))
+        self.assertEqual(CommitGraph(self.repo).parents(feat),
+                         self.repo.git.rev_parse(feat + '^@').split())
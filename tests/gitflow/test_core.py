@@ -7,6 +7,7 @@
 
 from unittest2 import TestCase
 import os
+import time
 import sys
 try:
     import cStringIO as StringIO
@@ -16,7 +17,7 @@ from ConfigParser import NoOptionError, NoSectionError
 
 from git import GitCommandError
 
-from gitflow.core import GitFlow
+from gitflow.core import GitFlow, shared_gitflow
 from gitflow.branches import BranchManager
 from gitflow.exceptions import (BranchExistsError, NotInitialized, MergeError,
                                 NoSuchBranchError, NoSuchRemoteError,
@@ -43,6 +44,84 @@ class TestGitFlowBasics(TestCase):
         self.assertRaises(NoOptionError, gitflow.get, 'foo.nonexisting')
         self.assertEquals('qux', gitflow.get('foo.bar'))
 
+    @copy_from_fixture('custom_repo')
+    def test_config_reader_sees_external_changes(self):
+        gitflow = GitFlow(self.repo)
+        self.assertEquals('qux', gitflow.get('foo.bar'))
+        writer = self.repo.config_writer()
+        writer.set_value('foo', 'bar', 'quux')
+        del writer
+        self.assertEquals('quux', gitflow.get('foo.bar'))
+
+    @copy_from_fixture('custom_repo')
+    def test_config_set_and_delete(self):
+        gitflow = GitFlow(self.repo)
+        gitflow.set('foo.baz', 'some-value')
+        self.assertEquals('some-value', gitflow.get('foo.baz'))
+        self.assertEquals('some-value', GitFlow(self.repo).get('foo.baz'))
+        self.assertEquals(3, gitflow.get('foo.three', 3))
+        gitflow.set('foo.three', 3)
+        self.assertEquals(3, gitflow.get('foo.three'))
+        gitflow.delete('foo.baz')
+        self.assertRaises(NoOptionError, gitflow.get, 'foo.baz')
+        self.assertRaises(NoOptionError, GitFlow(self.repo).get, 'foo.baz')
+
+    @copy_from_fixture('custom_repo')
+    def test_config_batch_writes_on_exit(self):
+        gitflow = GitFlow(self.repo)
+        with gitflow.config_batch():
+            gitflow.set('foo.bar', 'quux')
+            GitFlow(self.repo).set('foo.baz', 'xyz')
+            gitflow.delete('foo.bar')
+            gitflow.set('foo.bar', 'corge')
+            self.assertEquals('corge', gitflow.get('foo.bar'))
+            self.assertEquals('xyz', GitFlow(self.repo).get('foo.baz'))
+            reader = self.repo.config_reader()
+            self.assertEquals('qux', reader.get_value('foo', 'bar'))
+            self.assertRaises(NoOptionError, reader.get_value, 'foo', 'baz')
+        reader = self.repo.config_reader()
+        self.assertEquals('corge', reader.get_value('foo', 'bar'))
+        self.assertEquals('xyz', reader.get_value('foo', 'baz'))
+
+    @copy_from_fixture('custom_repo')
+    def test_config_batch_survives_outside_writes(self):
+        gitflow = GitFlow(self.repo)
+        with gitflow.config_batch():
+            gitflow.set('foo.bar', 'quux')
+            # Make sure the config file stamps change.
+            time.sleep(0.01)
+            self.repo.git.config('foo.outside', 'written-by-git')
+        self.assertEquals('quux', gitflow.get('foo.bar'))
+        self.assertEquals('written-by-git', gitflow.get('foo.outside'))
+        self.assertEquals('quux', GitFlow(self.repo).get('foo.bar'))
+
+    @copy_from_fixture('custom_repo')
+    def test_config_batch_discards_changes_on_error(self):
+        gitflow = GitFlow(self.repo)
+        try:
+            with gitflow.config_batch():
+                gitflow.set('foo.bar', 'quux')
+                raise KeyError('foo')
+        except KeyError:
+            pass
+        self.assertEquals('qux', gitflow.get('foo.bar'))
+        self.assertEquals('qux',
+                self.repo.config_reader().get_value('foo', 'bar'))
+
+    @copy_from_fixture('sample_repo')
+    def test_shared_gitflow(self):
+        gitflow = shared_gitflow()
+        self.assertIs(gitflow, shared_gitflow())
+        self.assertEquals(os.path.realpath(self.repo.working_dir),
+                          os.path.realpath(gitflow.repo.working_dir))
+
+        class SubGitFlow(GitFlow):
+            pass
+        sub_gitflow = shared_gitflow(SubGitFlow)
+        self.assertIsInstance(sub_gitflow, SubGitFlow)
+        self.assertIs(sub_gitflow, shared_gitflow())
+        self.assertIs(sub_gitflow, shared_gitflow(SubGitFlow))
+
     @copy_from_fixture('custom_repo')
     def test_custom_branchnames(self):
         gitflow = GitFlow(self.repo).init()
@@ -460,6 +539,24 @@ class TestGitFlowMerges(TestCase):
         self.assertRaisesRegexp(BadObjectError, 'feat/ever',
                           gitflow.is_merged_into ,'feat/ever', 'devel')
 
+    @copy_from_fixture('sample_repo')
+    def test_gitflow_is_merged_into_non_existing_target(self):
+        gitflow = GitFlow(self.repo)
+        self.assertFalse(gitflow.is_merged_into('devel', 'feat/ever'))
+        # only branches can contain commits
+        self.assertFalse(gitflow.is_merged_into('devel', 'HEAD'))
+
+    @copy_from_fixture('sample_repo')
+    def test_gitflow_merge_bases(self):
+        gitflow = GitFlow(self.repo)
+        base = self.repo.branches['devel'].commit.hexsha
+        shas = [b.commit.hexsha for b in self.repo.branches]
+        merge_bases = gitflow._merge_bases(base, shas)
+        self.assertItemsEqual(merge_bases.keys(), shas)
+        for sha in shas:
+            self.assertEqual(merge_bases[sha],
+                             self.repo.git.merge_base(base, sha))
+
     @remote_clone_from_fixture('sample_repo')
     def test_gitflow_is_merged_into_remote(self):
         gitflow = GitFlow(self.repo).init()
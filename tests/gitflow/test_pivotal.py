@@ -0,0 +1,423 @@
+#
+# This file is part of `gitflow`.
+# Copyright (c) 2010-2011 Vincent Driessen
+# Copyright (c) 2012 Hartmut Goebel
+# Distributed under a BSD-like license. For full terms see the file LICENSE.txt
+#
+
+import datetime
+import json
+import os
+import sys
+from StringIO import StringIO
+from unittest2 import TestCase
+
+from gitflow.busyflow.pivotal import parse_lazy, RequestError
+
+from gitflow import pivotal
+from gitflow.core import GitFlow, shared_gitflow
+from gitflow.exceptions import GitflowError
+from gitflow.pivotal import (BacklogPrefetcher, Release, RateLimiter, Story,
+                             StoryBranchIndex, StoryCache, iter_backlog_stories,
+                             map_stories)
+
+from tests.helpers import copy_from_fixture
+
+__copyright__ = "2010-2011 Vincent Driessen; 2012 Hartmut Goebel"
+__license__ = "BSD"
+
+
+FIXTURES = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__)))), 'gitflow', 'busyflow', 'pivotal', 'fixtures')
+
+
+class FakeEndpoint(object):
+    def __init__(self, client, **handlers):
+        self._client = client
+        self._handlers = handlers
+
+    def __getattr__(self, name):
+        handler = self._handlers[name]
+
+        def call(*args, **kwargs):
+            self._client.calls.append(name)
+            return handler(*args, **kwargs)
+        return call
+
+
+def make_iterations(finish, *stories):
+    return {'iterations': [{'number': 5, 'finish': finish,
+                            'stories': [dict(story) for story in stories]}]}
+
+
+class FakeClient(object):
+    """
+    A stand-in for the Pivotal Tracker clients, which serves `iterations`
+    and records the names of the endpoints called.
+    """
+
+    def __init__(self, iterations):
+        self.calls = []
+        self.version = 1
+        self.activities = []
+        self.projects = FakeEndpoint(self, activities=self._activities)
+        self.iterations = FakeEndpoint(
+            self, current=lambda project_id: iterations['current'](),
+            backlog=lambda project_id, **kwargs: iterations['backlog'](**kwargs))
+        self.stories = FakeEndpoint(self, get=self._story,
+                                    update=self._update)
+        # The ids of the stories that may not be updated.
+        self.forbidden = set()
+        self.updated = []
+
+    def add_activity(self, event_type, **story):
+        self.version += 1
+        self.activities.append({'version': self.version,
+                                'event_type': event_type,
+                                'stories': [story]})
+
+    def _update(self, project_id, story_id, **fields):
+        if story_id in self.forbidden:
+            error = RequestError('Forbidden')
+            error.parsed_body = {'message': 'Forbidden'}
+            raise error
+        self.updated.append(story_id)
+
+    def _activities(self, project_id, limit=None, newer_than_version=None):
+        if newer_than_version is None:
+            return {'activities': [{'version': self.version}]}
+        return {'activities': [a for a in self.activities
+                               if a['version'] > newer_than_version][:limit]}
+
+    def _story(self, project_id, story_id):
+        return {'story': {'id': story_id, 'name': 'Downloaded'}}
+
+
+class TestStoryCache(TestCase):
+
+    @copy_from_fixture('sample_repo')
+    def test_lazy_payloads_are_cached_without_being_converted(self):
+        with open(os.path.join(FIXTURES, 'iterations.xml')) as fh:
+            content = fh.read()
+        client = FakeClient({'current': lambda: parse_lazy(content)})
+        cache = StoryCache(GitFlow(self.repo), client, 812345)
+        stories = cache.iterations('current')['iterations'][1]['stories']
+        story = stories[0]
+        # Only the attributes gitflow reads have been converted.
+        self.assertLessEqual(set(story._values), set(StoryCache.STORY_FIELDS))
+        self.assertIn('description', story._elements)
+        self.assertIn('notes', story._elements)
+        with open(cache.path) as fh:
+            stored = json.load(fh)['current']['iterations'][1]['stories'][0]
+        self.assertEqual(stored['name'], u'Archive old projects')
+        self.assertEqual(stored['labels'], ['release-1.2', 'ux'])
+        self.assertNotIn('notes', stored)
+
+    def _make_cache(self, client):
+        # A new instance, as a new process would create it.
+        return StoryCache(GitFlow(self.repo), client, 812345)
+
+    def _fill_cache(self, finish=None):
+        if finish is None:
+            finish = datetime.datetime.utcnow() + datetime.timedelta(days=1)
+        story = {'id': 1, 'name': 'One', 'story_type': 'feature',
+                 'current_state': 'started', 'estimate': 1, 'labels': []}
+        client = FakeClient({'current': lambda: make_iterations(finish, story)})
+        cache = self._make_cache(client)
+        if os.path.exists(cache.path):
+            os.remove(cache.path)
+        cache.iterations('current')
+        self.assertEqual(client.calls, ['activities', 'current'])
+        del client.calls[:]
+        return client
+
+    def _story(self, cache):
+        return cache.iterations('current')['iterations'][0]['stories'][0]
+
+    @copy_from_fixture('sample_repo')
+    def test_cache_is_checked_once_per_process(self):
+        client = self._fill_cache()
+        cache = self._make_cache(client)
+        cache.iterations('current')
+        cache.has_iterations('backlog')
+        cache.get_story(1)
+        self.assertEqual(client.calls, ['activities'])
+
+    @copy_from_fixture('sample_repo')
+    def test_comments_are_patched(self):
+        client = self._fill_cache()
+        client.add_activity('note_create', id=1)
+        cache = self._make_cache(client)
+        self.assertEqual(self._story(cache)['name'], 'Downloaded')
+        self.assertEqual(client.calls, ['activities', 'get'])
+
+    @copy_from_fixture('sample_repo')
+    def test_story_updates_are_patched(self):
+        client = self._fill_cache()
+        client.add_activity('story_update', id=1, name='Renamed')
+        client.add_activity('story_update', id=2, name='Not cached')
+        cache = self._make_cache(client)
+        self.assertEqual(self._story(cache)['name'], 'Downloaded')
+        self.assertEqual(client.calls, ['activities', 'get'])
+
+    @copy_from_fixture('sample_repo')
+    def test_moving_story_updates_invalidate_iterations(self):
+        for changes in ({'current_state': 'finished'}, {'estimate': 3}, {}):
+            client = self._fill_cache()
+            client.add_activity('story_update', id=1, **changes)
+            cache = self._make_cache(client)
+            self.assertEqual(self._story(cache)['name'], 'One')
+            self.assertEqual(client.calls, ['activities', 'current'])
+
+    @copy_from_fixture('sample_repo')
+    def test_too_many_activities_download_everything(self):
+        client = self._fill_cache()
+        for i in range(StoryCache.MAX_ACTIVITIES):
+            client.add_activity('note_create', id=1)
+        cache = self._make_cache(client)
+        self.assertEqual(self._story(cache)['name'], 'One')
+        self.assertEqual(client.calls, ['activities', 'activities', 'current'])
+        self.assertEqual(cache._data['version'], client.version)
+
+    @copy_from_fixture('sample_repo')
+    def test_finished_current_iteration_is_downloaded_again(self):
+        client = self._fill_cache(
+            datetime.datetime.utcnow() - datetime.timedelta(seconds=1))
+        cache = self._make_cache(client)
+        self.assertEqual(self._story(cache)['name'], 'One')
+        self.assertEqual(client.calls, ['activities', 'current'])
+
+    @copy_from_fixture('sample_repo')
+    def test_failed_label_update_leaves_cache_alone(self):
+        self.repo.git.config('gitflow.pt.projectid', '812345')
+        client = self._fill_cache()
+        client.forbidden.add(1)
+        get_client = pivotal.get_client
+        pivotal.get_client = lambda token=None: client
+        self.addCleanup(setattr, pivotal, 'get_client', get_client)
+        cache = self._make_cache(client)
+        pivotal._story_caches[shared_gitflow().repo.git_dir] = cache
+        self.addCleanup(pivotal._story_caches.clear)
+        story = Story.from_dict(self._story(cache))
+        self.assertRaises(GitflowError, story.add_label, 'qa+')
+        self.assertEqual(story.get_labels(), [])
+        with open(cache.path) as fh:
+            stored = json.load(fh)['current']['iterations'][0]['stories'][0]
+        self.assertEqual(stored['labels'], [])
+
+
+class TestStoryBranchIndex(TestCase):
+
+    def _index(self):
+        gitflow = GitFlow(self.repo)
+        for name in ('feat/123-foo', 'feat/1234-bar', 'base_feat/123'):
+            self.repo.git.branch(name, 'devel')
+        return StoryBranchIndex(gitflow)
+
+    @copy_from_fixture('sample_repo')
+    def test_branches_match_by_id_prefix(self):
+        index = self._index()
+        self.assertEqual([b.name for b in index.branches(123)],
+                         ['feat/123-foo', 'feat/1234-bar'])
+        self.assertEqual([b.name for b in index.branches(1234)],
+                         ['feat/1234-bar'])
+        self.assertEqual(index.branches(99), [])
+        self.assertEqual(index.branches(123, remote=True), [])
+
+    @copy_from_fixture('sample_repo')
+    def test_base_markers(self):
+        index = self._index()
+        self.assertEqual(index.base_marker(123).name, 'base_feat/123')
+        self.assertIsNone(index.base_marker(12))
+        self.assertIsNone(index.base_marker(1234))
+        self.assertIsNone(index.base_marker(123, remote=True))
+
+    @copy_from_fixture('sample_repo')
+    def test_lookup_follows_ref_changes(self):
+        index = self._index()
+        entry = index.lookup(123)
+        self.assertEqual([b.name for b in entry.local],
+                         ['feat/123-foo', 'feat/1234-bar'])
+        self.assertEqual(entry.remote, [])
+        self.assertEqual(entry.base_marker.name, 'base_feat/123')
+        self.repo.git.branch('-D', 'feat/1234-bar', 'base_feat/123')
+        entry = index.lookup(123)
+        self.assertEqual([b.name for b in entry.local], ['feat/123-foo'])
+        self.assertIsNone(entry.base_marker)
+
+
+class FakeClock(object):
+    def __init__(self, now):
+        self.now = now
+        self.sleeps = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+
+
+class TestRateLimiter(TestCase):
+
+    def _clock(self):
+        clock = FakeClock(100.0)
+        time = pivotal.time
+        pivotal.time = clock
+        self.addCleanup(setattr, pivotal, 'time', time)
+        return clock
+
+    def test_requests_are_spaced_out(self):
+        clock = self._clock()
+        limiter = RateLimiter(10)
+        for i in range(3):
+            limiter.wait()
+        self.assertEqual([round(s, 6) for s in clock.sleeps], [0.1, 0.2])
+        # Requests do not wait for the time that has passed.
+        clock.now += 1
+        limiter.wait()
+        self.assertEqual(len(clock.sleeps), 2)
+
+    def test_no_limit(self):
+        clock = self._clock()
+        limiter = RateLimiter(0)
+        for i in range(3):
+            limiter.wait()
+        self.assertEqual(clock.sleeps, [])
+
+
+def _release_story(story_id, state='finished'):
+    return Story.from_dict({'id': story_id, 'name': 'Story %d' % story_id,
+                            'url': 'http://pt/%d' % story_id,
+                            'story_type': 'feature', 'estimate': 1,
+                            'current_state': state,
+                            'labels': ['release-1.0']})
+
+
+class TestRelease(TestCase):
+
+    def _setup(self):
+        self.repo.git.config('gitflow.pt.projectid', '812345')
+        self.repo.git.config('gitflow.pt.workers', '1')
+        self.repo.git.config('gitflow.pt.ratelimit', '0')
+        self.repo.git.config('gitflow.release.versionmatcher', '[0-9.]+')
+        client = FakeClient({})
+        get_client = pivotal.get_client
+        pivotal.get_client = lambda token=None: client
+        self.addCleanup(setattr, pivotal, 'get_client', get_client)
+        cache = StoryCache(shared_gitflow(), client, 812345)
+        pivotal._story_caches[shared_gitflow().repo.git_dir] = cache
+        self.addCleanup(pivotal._story_caches.clear)
+        return client
+
+    @copy_from_fixture('sample_repo')
+    def test_map_stories_stops_after_an_error(self):
+        self._setup()
+        called = []
+        error = ValueError('boom')
+
+        def func(story):
+            called.append(story)
+            if story == 2:
+                raise error
+            return story * 10
+
+        results = map_stories(func, [1, 2, 3, 4])
+        self.assertEqual(called, [1, 2])
+        self.assertEqual(results,
+                         [(10, None), (None, error), (None, None), (None, None)])
+
+    @copy_from_fixture('sample_repo')
+    def test_stage_stops_delivering_after_an_error(self):
+        client = self._setup()
+        client.forbidden.add(2)
+        release = Release('1.0', _skip_story_download=True)
+        release._current_stories = [_release_story(i) for i in (1, 2, 3)]
+        release._iteration_stories = None
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        self.addCleanup(setattr, sys, 'stdout', stdout)
+        self.assertRaises(GitflowError, release.stage)
+        output = sys.stdout.getvalue()
+        self.assertEqual(client.updated, [1])
+        self.assertEqual([s.get_state() for s in release._current_stories],
+                         ['delivered', 'finished', 'finished'])
+        self.assertIn('delivering failed', output)
+        self.assertIn('Story 1', output)
+        self.assertNotIn('Story 3', output)
+
+    @copy_from_fixture('sample_repo')
+    def test_delivers_all_finished(self):
+        self._setup()
+        release = Release('1.0', _skip_story_download=True)
+        stories = [_release_story(1), _release_story(2)]
+        others = [_release_story(3, 'started'), _release_story(4, 'accepted')]
+        check = release._delivers_all_finished
+        self.assertTrue(check(stories, stories + others))
+        # The stories are not known.
+        self.assertFalse(check(stories, None))
+        # Another finished story would be delivered as well.
+        self.assertFalse(check(stories[:1], stories + others))
+        # Not all the stories are finished.
+        self.assertFalse(check(stories + others[:1], stories + others))
+
+
+def backlog_iteration(number):
+    return {'number': number,
+            'stories': [{'id': number * 10 + i, 'name': 'Story',
+                         'story_type': 'feature', 'current_state': 'unstarted',
+                         'estimate': 1, 'labels': []} for i in (1, 2)]}
+
+
+class TestBacklogPrefetcher(TestCase):
+
+    def _setup(self, fail_at_offset=None):
+        self.repo.git.config('gitflow.pt.projectid', '812345')
+        backlog = [backlog_iteration(n) for n in range(1, 6)]
+
+        def get_backlog(limit=None, offset=None):
+            if offset is None:
+                return {'iterations': backlog}
+            if offset == fail_at_offset:
+                raise RequestError('Service Unavailable')
+            return {'iterations': backlog[offset:offset + limit]}
+
+        client = FakeClient({'backlog': get_backlog})
+        get_client = pivotal.get_client
+        pivotal.get_client = lambda token=None: client
+        self.addCleanup(setattr, pivotal, 'get_client', get_client)
+        cache = StoryCache(shared_gitflow(), client, 812345)
+        if os.path.exists(cache.path):
+            os.remove(cache.path)
+        pivotal._story_caches[shared_gitflow().repo.git_dir] = cache
+        self.addCleanup(pivotal._story_caches.clear)
+        return client, cache
+
+    def _stories(self, cache):
+        # As iter_stories does, which starts the prefetcher.
+        self.assertFalse(cache.has_iterations('backlog'))
+        prefetcher = BacklogPrefetcher('token', 812345)
+        prefetcher.start()
+        return [s.get_id() for s in iter_backlog_stories(0, prefetcher)]
+
+    @copy_from_fixture('sample_repo')
+    def test_prefetched_backlog_is_used(self):
+        client, cache = self._setup()
+        self.assertEqual(self._stories(cache),
+                         [11, 12, 21, 22, 31, 32, 41, 42, 51, 52])
+        # Three pages of two iterations, the last one short.
+        self.assertEqual(client.calls, ['activities'] + ['backlog'] * 3)
+        del client.calls[:]
+        iterations = cache.iterations('backlog')['iterations']
+        self.assertEqual([i['number'] for i in iterations], [1, 2, 3, 4, 5])
+        self.assertEqual(client.calls, [])
+
+    @copy_from_fixture('sample_repo')
+    def test_failed_prefetch_falls_back_to_a_download(self):
+        client, cache = self._setup(fail_at_offset=2)
+        # The iterations passed on before the failure are not repeated.
+        self.assertEqual(self._stories(cache),
+                         [11, 12, 21, 22, 31, 32, 41, 42, 51, 52])
+        self.assertEqual(client.calls,
+                         ['activities', 'backlog', 'backlog', 'backlog'])
+        self.assertTrue(cache.has_iterations('backlog'))
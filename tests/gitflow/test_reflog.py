@@ -0,0 +1,52 @@
+#
+# This file is part of `gitflow`.
+# Copyright (c) 2010-2011 Vincent Driessen
+# Copyright (c) 2012 Hartmut Goebel
+# Distributed under a BSD-like license. For full terms see the file LICENSE.txt
+#
+
+import os
+from unittest2 import TestCase
+
+from gitflow.reflog import iter_lines_reversed, iter_reflog
+
+from tests.helpers import copy_from_fixture, sandboxed
+
+__copyright__ = "2010-2011 Vincent Driessen; 2012 Hartmut Goebel"
+__license__ = "BSD"
+
+
+class TestReflog(TestCase):
+
+    @sandboxed
+    def test_iter_lines_reversed(self):
+        for content, lines in [('', []),
+                               ('a\n', ['a']),
+                               ('a\nbc\n\nd', ['d', 'bc', 'a']),
+                               ('\na\r\nb\n', ['b', 'a'])]:
+            with open('file', 'wb') as fh:
+                fh.write(content)
+            self.assertEqual(list(iter_lines_reversed('file')), lines)
+
+    @copy_from_fixture('sample_repo')
+    def test_reflog_matches_git(self):
+        for branch in self.repo.branches:
+            shas = self.repo.git.reflog('show', '--format=%H',
+                                        branch.name).split()
+            entries = list(iter_reflog(self.repo.git_dir, branch.name))
+            self.assertEqual([e.new for e in entries], shas)
+            self.assertEqual(
+                list(iter_reflog(self.repo.git_dir, branch.name,
+                                 reverse=False)),
+                entries[::-1])
+        entry = list(iter_reflog(self.repo.git_dir, 'devel'))[-1]
+        self.assertEqual(entry.old, '0' * 40)
+        self.assertEqual(entry.message, 'branch: Created from master')
+
+    @copy_from_fixture('sample_repo')
+    def test_missing_reflog(self):
+        os.remove(os.path.join(self.repo.git_dir, 'logs', 'refs', 'heads',
+                               'devel'))
+        self.assertEqual(list(iter_reflog(self.repo.git_dir, 'devel')), [])
+        self.assertEqual(list(iter_reflog(self.repo.git_dir, 'nonexistent',
+                                          reverse=False)), [])
@@ -0,0 +1,127 @@
+#
+# This file is part of `gitflow`.
+# Copyright (c) 2010-2011 Vincent Driessen
+# Copyright (c) 2012 Hartmut Goebel
+# Distributed under a BSD-like license. For full terms see the file LICENSE.txt
+#
+
+import sys
+import traceback
+from StringIO import StringIO
+from unittest2 import TestCase
+
+from gitflow import review
+from gitflow.reviewboard.extensions import PendingRequests
+from gitflow.exceptions import EmptyDiff
+
+from tests.helpers import copy_from_fixture
+
+__copyright__ = "2010-2011 Vincent Driessen; 2012 Hartmut Goebel"
+__license__ = "BSD"
+
+
+class TestDiffs(TestCase):
+
+    @copy_from_fixture('sample_repo')
+    def test_diffs_are_written_to_files(self):
+        rev_range = ('devel', 'feat/even')
+        patch, parent_patch = review._make_diffs(rev_range)
+        self.assertEqual(patch.read(), self.repo.git.diff(
+            *(review._DIFF_OPTIONS + ['devel..feat/even'])) + '\n')
+        # Without a remote develop branch there is no parent diff.
+        self.assertEqual(parent_patch, '')
+
+    @copy_from_fixture('sample_repo')
+    def test_empty_diff(self):
+        self.assertRaises(EmptyDiff, review._make_diffs, ('devel', 'devel'))
+
+
+class FakeStory(object):
+    def __init__(self, story_id, *labels):
+        self._id = story_id
+        self._labels = labels
+
+    def get_id(self):
+        return self._id
+
+    def is_labeled(self, label):
+        return label in self._labels
+
+
+class FakeClient(object):
+    """
+    A stand-in for the Review Board client, which serves pending review
+    requests of feature branches, with ids ten times their story id, and
+    answers whether they have been shipped with `ship_its`, which maps
+    review request ids to True, False or an exception to raise.
+    """
+
+    def __init__(self, ship_its):
+        self._ship_its = ship_its
+
+    def iter_review_requests(self, options=None):
+        for rid in sorted(self._ship_its):
+            yield {'id': rid, 'branch': 'feat/%d-story' % (rid / 10),
+                   'status': 'pending'}
+
+    def get_pending_requests(self, repository=None):
+        return PendingRequests(self, repository)
+
+    def get_reviews_for_review_request(self, rid):
+        ship_it = self._ship_its[rid]
+        if isinstance(ship_it, Exception):
+            raise ship_it
+        return [{'ship_it': ship_it}]
+
+
+class TestRelease(TestCase):
+
+    def _release(self, ship_its, *stories):
+        self.repo.git.config('gitflow.rb.repoid', '1')
+        client = FakeClient(ship_its)
+        get_client = review._get_client
+        review._get_client = lambda: client
+        self.addCleanup(setattr, review, '_get_client', get_client)
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        self.addCleanup(setattr, sys, 'stdout', stdout)
+        return review.Release(list(stories))
+
+    @copy_from_fixture('sample_repo')
+    def test_reviews_are_reported_in_story_order(self):
+        release = self._release(dict((rid, True) for rid in range(10, 100, 10)),
+                                *[FakeStory(i) for i in (5, 3, 9, 1, 7)])
+        release.try_stage(False)
+        self.assertEqual([r.get_id() for r in release._reviews],
+                         [50, 30, 90, 10, 70])
+        self.assertEqual(sys.stdout.getvalue().split(),
+                         ['50', '30', '90', '10', '70'])
+
+    @copy_from_fixture('sample_repo')
+    def test_missing_reviews(self):
+        release = self._release({10: True, 20: False},
+                                FakeStory(1), FakeStory(2), FakeStory(3),
+                                FakeStory(4, 'no review'))
+        self.assertRaises(SystemExit, release.try_stage, False)
+        release.try_stage(True)
+        self.assertEqual([r.get_id() for r in release._reviews], [10])
+        output = sys.stdout.getvalue()
+        self.assertIn('Review 20 has not been accepted yet', output)
+        self.assertIn('No review request found for branch prefixed with '
+                      'feat/3', output)
+        self.assertIn("Story 4 labeled 'no review'", output)
+
+    @copy_from_fixture('sample_repo')
+    def test_errors_are_raised_with_their_traceback(self):
+        error = ValueError('Connection lost')
+        release = self._release({10: True, 20: error},
+                                FakeStory(1), FakeStory(2))
+        results = release._verify_reviews(['feat/1', 'feat/2'])
+        self.assertEqual(results['feat/1'].get_id(), 10)
+        exc_type, exc_value, tb = results['feat/2']
+        self.assertIs(exc_value, error)
+        self.assertEqual(traceback.extract_tb(tb)[-1][2],
+                         'get_reviews_for_review_request')
+        with self.assertRaises(SystemExit) as cm:
+            release.try_stage(True)
+        self.assertEqual(str(cm.exception), 'Connection lost')
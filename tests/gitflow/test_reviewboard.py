@@ -0,0 +1,331 @@
+#
+# This file is part of `gitflow`.
+# Copyright (c) 2010-2011 Vincent Driessen
+# Copyright (c) 2012 Hartmut Goebel
+# Distributed under a BSD-like license. For full terms see the file LICENSE.txt
+#
+
+import httplib
+import os
+import shutil
+import tempfile
+import urllib2
+from StringIO import StringIO
+from unittest2 import TestCase
+
+from gitflow.reviewboard import rb
+from gitflow.reviewboard.extensions import PendingRequests
+
+__copyright__ = "2010-2011 Vincent Driessen; 2012 Hartmut Goebel"
+__license__ = "BSD"
+
+
+URL = 'http://rb.example.com/'
+
+
+def http_error(code):
+    return urllib2.HTTPError(URL + 'api/', code, 'Error', {}, StringIO(''))
+
+
+class FakeHttpClient(object):
+    """
+    A stand-in for :class:`rb.HttpClient`, which answers GET /api/ by
+    raising `error`, if given, and records the requests made.
+    """
+    error = None
+    requests = []
+
+    def __init__(self, url, proxy=None):
+        self.url = url
+
+    def has_valid_cookie(self):
+        return True
+
+    def set_credentials(self, username, password):
+        pass
+
+    def api_request(self, method, url, fields=None, files=None):
+        FakeHttpClient.requests.append((method, url))
+        if url == '/api/' and FakeHttpClient.error is not None:
+            raise FakeHttpClient.error
+        return {'stat': 'ok'}
+
+
+class TestServerInfoCache(TestCase):
+
+    def setUp(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.path = os.path.join(tmpdir, 'cache.json')
+
+    def test_values_are_stored_per_server(self):
+        rb.ServerInfoCache(self.path).set(URL, 'apiver', '2.0')
+        cache = rb.ServerInfoCache(self.path)
+        self.assertEqual(cache.get(URL, 'apiver'), '2.0')
+        self.assertIsNone(cache.get(URL, 'repositories'))
+        self.assertIsNone(cache.get('http://other/', 'apiver'))
+
+    def test_values_expire(self):
+        rb.ServerInfoCache(self.path).set(URL, 'apiver', '2.0')
+        self.assertIsNone(rb.ServerInfoCache(self.path, ttl=0).get(URL, 'apiver'))
+
+    def test_broken_files_are_ignored(self):
+        with open(self.path, 'w') as fh:
+            fh.write('{"')
+        cache = rb.ServerInfoCache(self.path)
+        self.assertIsNone(cache.get(URL, 'apiver'))
+        cache.set(URL, 'apiver', '2.0')
+        self.assertEqual(cache.get(URL, 'apiver'), '2.0')
+
+
+class TestMakeRBClient(TestCase):
+
+    def setUp(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.cache = rb.ServerInfoCache(os.path.join(tmpdir, 'cache.json'))
+        http_client = rb.HttpClient
+        rb.HttpClient = FakeHttpClient
+        self.addCleanup(setattr, rb, 'HttpClient', http_client)
+        FakeHttpClient.error = None
+        FakeHttpClient.requests = []
+        rb._clients.clear()
+        self.addCleanup(rb._clients.clear)
+
+    def _make(self):
+        return rb.make_rbclient(URL, 'user', 'secret', cache=self.cache)
+
+    def _probes(self):
+        return FakeHttpClient.requests.count(('GET', '/api/'))
+
+    def test_clients_are_shared(self):
+        client = self._make()
+        self.assertIsInstance(client, rb.Api20Client)
+        self.assertIs(self._make(), client)
+        self.assertIsNot(rb.make_rbclient(URL, 'other', 'secret',
+                                          cache=self.cache), client)
+        # The other user's client finds the API version in the cache.
+        self.assertEqual(self._probes(), 1)
+
+    def test_api_version_is_cached(self):
+        self._make()
+        # As a new process would do.
+        rb._clients.clear()
+        self.assertIsInstance(self._make(), rb.Api20Client)
+        self.assertEqual(self._probes(), 1)
+        self.assertEqual(self.cache.get(URL, 'apiver'), '2.0')
+
+    def test_old_servers_are_not_cached(self):
+        for error in (http_error(404), ValueError('No JSON object')):
+            rb._clients.clear()
+            FakeHttpClient.error = error
+            self.assertIsInstance(self._make(), rb.Api10Client)
+            self.assertIsNone(self.cache.get(URL, 'apiver'))
+
+    def test_other_errors_are_raised(self):
+        for error in (http_error(500), http_error(403),
+                      urllib2.URLError('refused')):
+            FakeHttpClient.error = error
+            self.assertRaises(urllib2.URLError, self._make)
+            self.assertEqual(rb._clients, {})
+            self.assertIsNone(self.cache.get(URL, 'apiver'))
+
+
+class FakeResponse(object):
+    status = 200
+    reason = 'OK'
+    will_close = False
+
+    def __init__(self, data):
+        self.msg = httplib.HTTPMessage(StringIO(''))
+        self._data = data
+
+    def read(self):
+        return self._data
+
+
+class FakeConnection(object):
+    """
+    A stand-in for :class:`httplib.HTTPSConnection`, which answers every
+    request with its method, unless it is `stale`, i.e. closed by the
+    server.
+    """
+    instances = []
+    stale_when_new = False
+
+    def __init__(self, host, **kwargs):
+        self.kwargs = kwargs
+        self.requests = []
+        self.stale = FakeConnection.stale_when_new
+        self.closed = False
+        FakeConnection.instances.append(self)
+
+    def request(self, method, selector, data, headers):
+        self.requests.append(method)
+
+    def getresponse(self):
+        if self.stale:
+            raise httplib.BadStatusLine("''")
+        return FakeResponse(self.requests[-1])
+
+    def close(self):
+        self.closed = True
+
+
+class TestKeepAliveHTTPSHandler(TestCase):
+
+    def setUp(self):
+        connection = httplib.HTTPSConnection
+        httplib.HTTPSConnection = FakeConnection
+        self.addCleanup(setattr, httplib, 'HTTPSConnection', connection)
+        FakeConnection.instances = []
+        FakeConnection.stale_when_new = False
+        self.context = object()
+        self.handler = rb.KeepAliveHTTPSHandler(context=self.context)
+
+    def _open(self, method):
+        req = rb.ApiRequest(method, 'https://rb.example.com/api/',
+                            'data' if method == 'POST' else None)
+        req.timeout = 10
+        return self.handler.https_open(req)
+
+    def test_connections_are_kept_and_use_the_context(self):
+        self.assertEqual(self._open('GET').read(), 'GET')
+        self.assertEqual(self._open('GET').read(), 'GET')
+        conn, = FakeConnection.instances
+        self.assertEqual(conn.requests, ['GET', 'GET'])
+        self.assertIs(conn.kwargs['context'], self.context)
+
+    def test_stale_get_is_sent_again(self):
+        self._open('GET')
+        FakeConnection.instances[0].stale = True
+        self.assertEqual(self._open('GET').read(), 'GET')
+        stale, fresh = FakeConnection.instances
+        self.assertTrue(stale.closed)
+        self.assertEqual(stale.requests, ['GET', 'GET'])
+        self.assertEqual(fresh.requests, ['GET'])
+
+    def test_post_is_never_sent_again(self):
+        self._open('GET')
+        kept = FakeConnection.instances[0]
+        # A POST gets a connection of its own ...
+        self.assertEqual(self._open('POST').read(), 'POST')
+        self.assertTrue(kept.closed)
+        self.assertEqual(kept.requests, ['GET'])
+        # ... and is not sent again if that fails.
+        FakeConnection.stale_when_new = True
+        self.assertRaises(urllib2.URLError, self._open, 'POST')
+        self.assertEqual(len(FakeConnection.instances), 3)
+        self.assertEqual(FakeConnection.instances[2].requests, ['POST'])
+
+
+def review_request(id, branch, status='pending'):
+    return {'id': id, 'branch': branch, 'status': status}
+
+
+class PagedHttpClient(object):
+    """
+    A stand-in for :class:`rb.HttpClient`, which serves `pages` of review
+    requests, linking each page to the next one.
+    """
+    url = URL
+
+    def __init__(self, *pages):
+        self.requests = []
+        self._pages = pages
+
+    def api_request(self, method, url, fields=None, files=None):
+        self.requests.append(url)
+        if url.startswith('/api/review-requests/?'):
+            page = 0
+        else:
+            page = int(url[len(URL + 'api/review-requests/?start='):])
+        rsp = {'stat': 'ok', 'review_requests': self._pages[page]}
+        if page + 1 < len(self._pages):
+            rsp['links'] = {'next': {
+                'href': URL + 'api/review-requests/?start=%d' % (page + 1)}}
+        return rsp
+
+
+class TestPendingRequests(TestCase):
+
+    def _client(self):
+        return rb.Api20Client(PagedHttpClient(
+            [review_request(1, 'feat/12-a'), review_request(2, 'feat/2-b')],
+            [review_request(3, 'feat/123-c'),
+             review_request(4, 'feat/12-a', 'discarded')],
+            [review_request(5, 'feat/12-a')]))
+
+    def test_iter_review_requests_follows_next_links(self):
+        client = self._client()
+        requests = client.iter_review_requests({'status': 'pending'})
+        self.assertEqual([r['id'] for r in requests], [1, 2, 3, 4, 5])
+        self.assertEqual(client._httpclient.requests, [
+            '/api/review-requests/?status=pending',
+            URL + 'api/review-requests/?start=1',
+            URL + 'api/review-requests/?start=2'])
+
+    def test_iter_review_requests_of_branch(self):
+        client = self._client()
+        requests = client.get_review_requests(branch='feat/12-a')
+        self.assertEqual([r['id'] for r in requests], [1, 4, 5])
+        self.assertEqual(client._httpclient.requests[0],
+                         '/api/review-requests/?branch=feat%2F12-a')
+
+    def test_lookups(self):
+        pending = PendingRequests(self._client(), repository=7)
+        self.assertEqual([r['id'] for r in pending.by_branch('feat/12-a')],
+                         [1, 5])
+        self.assertEqual(pending.by_branch('feat/12'), [])
+        self.assertEqual([r['id'] for r in pending.by_prefix('feat/12')],
+                         [1, 5, 3])
+        self.assertEqual([r['id'] for r in pending.by_prefix('feat/2')], [2])
+        self.assertEqual(pending.by_prefix('feat/3'), [])
+        self.assertEqual(pending.by_prefix('feat/9'), [])
+        self.assertEqual(len(pending.by_prefix('')), 4)
+
+    def test_add_replaces_previous_versions(self):
+        pending = PendingRequests(self._client())
+        pending.add(review_request(2, 'feat/21-d'))
+        pending.add(review_request(6, 'feat/12-a'))
+        self.assertEqual(pending.by_branch('feat/2-b'), [])
+        self.assertEqual([r['id'] for r in pending.by_prefix('feat/2')], [2])
+        self.assertEqual(pending.by_branch('feat/21-d')[0]['branch'],
+                         'feat/21-d')
+        self.assertEqual([r['id'] for r in pending.by_branch('feat/12-a')],
+                         [1, 5, 6])
+
+    def test_pending_requests_are_downloaded_once(self):
+        client = self._client()
+        pending = client.get_pending_requests(7)
+        self.assertIs(client.get_pending_requests('7'), pending)
+        self.assertEqual(len(client._httpclient.requests), 3)
+        self.assertIsNot(client.get_pending_requests(), pending)
+
+
+class TestMultipartFormData(TestCase):
+
+    def test_body_is_streamed_from_files(self):
+        diff = tempfile.TemporaryFile()
+        diff.write('--- a\n+++ b\n' * 1000)
+        diff.seek(0)
+        body = rb.MultipartFormData({'basedir': '/'},
+                                    {'path': {'filename': 'diff',
+                                              'content': diff}})
+        boundary = body.content_type.split('boundary=')[1]
+        expected = ('--%s\r\n'
+                    'Content-Disposition: form-data; name="basedir"\r\n'
+                    '\r\n/\r\n'
+                    '--%s\r\n'
+                    'Content-Disposition: form-data; name="path"; '
+                    'filename="diff"\r\n'
+                    '\r\n%s\r\n'
+                    '--%s--\r\n\r\n'
+                    % (boundary, boundary, '--- a\n+++ b\n' * 1000, boundary))
+        # The Content-Length header is taken from len().
+        self.assertEqual(len(body), len(expected))
+        self.assertEqual(body.read(), expected)
+        # The body is sent again after a rewind, e.g. for authentication.
+        body.seek(0)
+        chunks = iter(lambda: body.read(100), '')
+        self.assertEqual(''.join(chunks), expected)